@@ -0,0 +1,190 @@
+# beipack - Remote bootloader for Python
+#
+# Copyright (C) 2023 Allison Karlitskaya <allison.karlitskaya@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures the whole beiboot path, over a simulated slow link.
+
+Packs of various sizes are booted with beiboot into a local `python3 -i`,
+through a proxy which stands in for ssh: it delays everything by the given
+latency, in each direction, and limits it to the given bandwidth.  The
+proxy is this script, run with --proxy.
+
+Each pack prints the time when its first line runs, and when its main()
+runs.  Both are reported relative to starting beiboot, along with the time
+until beiboot exits.  Times are the best of --rounds runs.
+
+    python3 bench/bench_boot.py [--bandwidth MBIT] [--latency MS]
+                                [--sizes MIB,...] [--case CASE...]
+
+The cases other than `script` and `framed` use the bootloader gadgets, which
+need ferny.
+"""
+
+import argparse
+import importlib.util
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from bench_framing import make_pack
+
+from bei import compression
+
+# The arguments given to beiboot for each case ({} is the pack)
+CASES = {
+    'script': ['--script', '{}'],
+    'framed': ['--script', '{}', '--framed'],
+    'none': ['--script', '{}', '--compression', 'none'],
+    'zlib': ['--xz', '{}.xz', '--compression', 'zlib'],
+    'bz2': ['--xz', '{}.xz', '--compression', 'bz2'],
+    'xz': ['--xz', '{}.xz'],
+    'auto': ['--xz', '{}.xz', '--compression', 'auto'],
+}
+GADGET_CASES = {'none', 'zlib', 'bz2', 'xz', 'auto'}
+
+# The proxy sends at most this much at once
+PROXY_BLOCK_SIZE = 1 << 14
+
+FIRST_LINE = b'import time; print("first", time.perf_counter(), flush=True)\n'
+MAIN = (b'import time\n'
+        b'def main():\n'
+        b'    print("main", time.perf_counter(), flush=True)\n')
+
+
+def throttle(src: int, dst: int, bandwidth: float, latency: float) -> None:
+    """Copies `src` to `dst` as if over a link with `bandwidth` (bytes/s) and
+    `latency` (s), then closes `dst`."""
+    pending: 'queue.Queue[Tuple[float, bytes]]' = queue.Queue()
+
+    def deliver() -> None:
+        while True:
+            deliver_at, data = pending.get()
+            time.sleep(max(deliver_at - time.monotonic(), 0))
+            if not data:
+                break
+            while data:
+                data = data[os.write(dst, data):]
+        os.close(dst)
+
+    thread = threading.Thread(target=deliver)
+    thread.start()
+    link_free = 0.0
+    while True:
+        data = os.read(src, PROXY_BLOCK_SIZE)
+        # each block has to wait for the ones before it to get through
+        link_free = max(time.monotonic(), link_free) + len(data) / bandwidth
+        pending.put((link_free + latency, data))
+        if not data:
+            break
+    thread.join()
+
+
+def proxy(bandwidth: float, latency: float, command: List[str]) -> None:
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    assert process.stdin is not None
+    assert process.stdout is not None and process.stderr is not None
+
+    # stdin is never closed if beiboot doesn't exit first, so don't wait for it
+    threading.Thread(target=throttle,
+                     args=(0, process.stdin.fileno(), bandwidth, latency),
+                     daemon=True).start()
+    outputs = [threading.Thread(target=throttle,
+                                args=(pipe.fileno(), fd, bandwidth, latency))
+               for pipe, fd in [(process.stdout, 1), (process.stderr, 2)]]
+    for thread in outputs:
+        thread.start()
+    for thread in outputs:
+        thread.join()
+    sys.exit(process.wait())
+
+
+def boot_times(args: List[str], bandwidth: float,
+               latency: float) -> Tuple[float, float, float]:
+    proxy_command = [sys.executable, os.path.abspath(__file__),
+                     '--proxy', str(bandwidth), str(latency)]
+    # perf_counter() is CLOCK_MONOTONIC on Linux, so we can compare
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-m', 'bei.beiboot', *args,
+                              '--', *proxy_command],
+                             stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, check=True)
+    total = time.perf_counter() - start
+    times = dict(line.split() for line in process.stdout.decode().splitlines())
+    return float(times['first']) - start, float(times['main']) - start, total
+
+
+def main() -> None:
+    if sys.argv[1:2] == ['--proxy']:
+        proxy(float(sys.argv[2]), float(sys.argv[3]), sys.argv[4:])
+
+    parser = argparse.ArgumentParser(description="Benchmark beiboot over a slow link")
+    parser.add_argument('--bandwidth', metavar='MBIT', type=float, default=10,
+                        help="the bandwidth of the link, in Mbit/s, in each direction "
+                             "(default: 10)")
+    parser.add_argument('--latency', metavar='MS', type=float, default=20,
+                        help="the latency of the link, in milliseconds, in each "
+                             "direction (default: 20)")
+    parser.add_argument('--sizes', metavar='MIB,...', default='0.1,1',
+                        help="the sizes of the packs to measure, in MiB "
+                             "(default: 0.1,1)")
+    parser.add_argument('--case', action='append', choices=CASES,
+                        help="only run the given case (default: all of them)")
+    parser.add_argument('--rounds', type=int, default=1,
+                        help="run everything this many times, and report the fastest")
+    args = parser.parse_args()
+
+    cases = args.case or list(CASES)
+    gadget_cases = sorted(GADGET_CASES.intersection(cases))
+    if importlib.util.find_spec('ferny') is None and gadget_cases:
+        sys.stderr.write(f'ferny is needed for {", ".join(gadget_cases)}: skipping\n')
+        cases = [case for case in cases if case not in GADGET_CASES]
+
+    bandwidth, latency = args.bandwidth * 1e6 / 8, args.latency / 1000
+    print(f'{"size":>10} {"xz":>10} {"case":8} '
+          f'{"first":>10} {"main":>10} {"total":>10}')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in (int(float(size) * (1 << 20)) for size in args.sizes.split(',')):
+            # the first line reports the time too
+            pack = FIRST_LINE + make_pack(size, MAIN)
+            filename = os.path.join(tmpdir, f'pack-{size}.py')
+            with open(filename, 'wb') as file:
+                file.write(pack)
+            xz = compression.compress(pack, 'xz')
+            with open(f'{filename}.xz', 'wb') as file:
+                file.write(xz)
+
+            for case in cases:
+                best: Optional[Tuple[float, float, float]] = None
+                for _ in range(args.rounds):
+                    case_args = [arg.format(filename) for arg in CASES[case]]
+                    times = boot_times(case_args, bandwidth, latency)
+                    if best is None or times[1] < best[1]:
+                        best = times
+                assert best is not None
+                first, entrypoint, total = best
+                print(f'{len(pack):10} {len(xz):10} {case:8} '
+                      f'{first * 1000:8.0f}ms {entrypoint * 1000:8.0f}ms '
+                      f'{total * 1000:8.0f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# beipack - Remote bootloader for Python
+#
+# Copyright (C) 2023 Allison Karlitskaya <allison.karlitskaya@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures the throughput of `beiboot.forward()`.
+
+It's compared with the thread which beiboot used before: 1MiB reads, each
+written to a buffered file and flushed.  The data comes from a `cat`
+process (via a pipe) or from a file, and goes to another `cat` process
+which throws it away (via a pipe or a socket).  The reported CPU time is
+only ours.
+
+    python3 bench/bench_forward.py [--size MIB] [--rounds N]
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Tuple
+
+from bei import beiboot
+
+
+def forward_thread(src: int, dst: int) -> None:
+    # The old splice_in_thread(), but waiting for it to finish
+    def _thread() -> None:
+        with open(dst, 'wb', closefd=False) as file:
+            while True:
+                data = os.read(src, 1 << 20)
+                if not data:
+                    break
+                file.write(data)
+                file.flush()
+
+    thread = threading.Thread(target=_thread)
+    thread.start()
+    thread.join()
+
+
+def forward_asyncio(src: int, dst: int) -> None:
+    os.set_blocking(dst, False)
+    asyncio.run(beiboot.forward(src, dst))
+
+
+def cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(forwarder: Callable[[int, int], None], source: str, sink: str,
+            filename: str) -> Tuple[float, float]:
+    if source == 'pipe':
+        writer = subprocess.Popen(['cat', filename], stdout=subprocess.PIPE)
+        assert writer.stdout is not None
+        src = writer.stdout.fileno()
+    else:
+        src = os.open(filename, os.O_RDONLY)
+
+    if sink == 'pipe':
+        reader = subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+                                  stdout=subprocess.DEVNULL)
+        assert reader.stdin is not None
+        dst = reader.stdin.fileno()
+        ours = None
+    else:
+        ours, theirs = socket.socketpair()
+        reader = subprocess.Popen(['cat'], stdin=theirs.fileno(),
+                                  stdout=subprocess.DEVNULL)
+        theirs.close()
+        dst = ours.fileno()
+
+    start, start_cpu = time.perf_counter(), cpu_time()
+    forwarder(src, dst)
+    elapsed, cpu = time.perf_counter() - start, cpu_time() - start_cpu
+
+    if ours is not None:
+        ours.close()
+    else:
+        assert reader.stdin is not None
+        reader.stdin.close()
+    reader.wait()
+    if source == 'pipe':
+        writer.wait()
+    else:
+        os.close(src)
+
+    return elapsed, cpu
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark beiboot's stdin forwarding")
+    parser.add_argument('--size', metavar='MIB', type=int, default=512,
+                        help="the amount of data to forward (default: 512)")
+    parser.add_argument('--rounds', type=int, default=3,
+                        help="run everything this many times, and report the fastest")
+    args = parser.parse_args()
+
+    forwarders: Dict[str, Callable[[int, int], None]] = {
+        'thread': forward_thread,
+        'forward': forward_asyncio,
+    }
+
+    with tempfile.NamedTemporaryFile() as file:
+        block = os.urandom(1 << 20)
+        for _ in range(args.size):
+            file.write(block)
+        file.flush()
+
+        print(f'{"source":8} {"sink":8} {"method":8} {"MiB/s":>8} {"cpu":>8}')
+        for source, sink in [('pipe', 'pipe'), ('file', 'pipe'), ('pipe', 'socket')]:
+            for name, forwarder in forwarders.items():
+                elapsed, cpu = min(measure(forwarder, source, sink, file.name)
+                                   for _ in range(args.rounds))
+                print(f'{source:8} {sink:8} {name:8} '
+                      f'{args.size / elapsed:8.0f} {cpu * 1000:6.0f}ms')
+
+
+if __name__ == '__main__':
+    main()
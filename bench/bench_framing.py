@@ -0,0 +1,88 @@
+# beipack - Remote bootloader for Python
+#
+# Copyright (C) 2023 Allison Karlitskaya <allison.karlitskaya@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the time to start a pack typed into the REPL, and a framed one.
+
+Packs of various sizes are fed to the stdin of the interpreter (started the
+way beiboot starts it) either as they are, or after the stub from
+`make_framed()`.  The time is measured from starting the interpreter until
+the pack's main function runs, and is the best of --rounds runs.
+
+    python3 bench/bench_framing.py [--python INTERPRETER] [--sizes MIB,...]
+"""
+
+import argparse
+import random
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+from bei import beiboot, beipack
+from bei.bootloader import make_framed
+
+MAIN = b'import time\ndef main():\n    print(time.perf_counter())\n'
+
+
+def make_pack(size: int, main: bytes = MAIN) -> bytes:
+    # 8KiB modules, full of long-ish lines of code, like real programs
+    rng = random.Random(size)
+    contents: Dict[str, bytes] = {'bench/__init__.py': b'', 'bench/main.py': main}
+    for i in range(size // 8192):
+        lines = [f'VALUE_{j} = {rng.getrandbits(64)} + '
+                 f'len({"x" * rng.randrange(40)!r})\n'
+                 for j in range(150)]
+        contents[f'bench/module_{i}.py'] = ''.join(lines).encode()
+    return beipack.pack(contents, 'bench.main:main').encode()
+
+
+def start_time(command: List[str], data: bytes, rounds: int) -> float:
+    best = float('inf')
+    for _ in range(rounds):
+        # perf_counter() is CLOCK_MONOTONIC on Linux, so we can compare
+        start = time.perf_counter()
+        process = subprocess.run(command, input=data, stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL, check=True)
+        best = min(best, float(process.stdout) - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark framed boots against the REPL")
+    parser.add_argument('--python', metavar='INTERPRETER', default=sys.executable,
+                        help="the target interpreter (default: this one)")
+    parser.add_argument('--sizes', metavar='MIB,...', default='0,1,5,20',
+                        help="the sizes of the packs to measure, in MiB "
+                             "(default: 0,1,5,20)")
+    parser.add_argument('--rounds', type=int, default=5,
+                        help="run everything this many times, and report the fastest")
+    args = parser.parse_args()
+
+    command = [args.python, *beiboot.get_python_command()[1:]]
+
+    print(f'{"size":>10} {"repl":>10} {"framed":>10} {"speedup":>8}')
+    for size in (int(float(size) * (1 << 20)) for size in args.sizes.split(',')):
+        pack = make_pack(size)
+        repl = start_time(command, pack, args.rounds)
+        framed = start_time(command, make_framed(pack), args.rounds)
+        print(f'{len(pack):10} {repl * 1000:8.1f}ms {framed * 1000:8.1f}ms '
+              f'{repl / framed:7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# beipack - Remote bootloader for Python
+#
+# Copyright (C) 2023 Allison Karlitskaya <allison.karlitskaya@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures what `beipack --minify` saves on a wheel.
+
+For the original sources, the minified sources, and the minified sources
+without annotations, this reports the size of the pack (raw and compressed)
+and the time the target interpreter needs to compile all of the modules.
+
+    python3 bench/bench_minify.py [--python INTERPRETER] [WHEEL]
+
+The default wheel is the copy of pip bundled with ensurepip.
+"""
+
+import argparse
+import glob
+import marshal
+import os
+import subprocess
+import sys
+from typing import Dict
+
+from bei import beipack, compression
+
+# Compiles everything on stdin, a few times, and prints the best time
+COMPILE_SCRIPT = '''
+import marshal
+import sys
+import time
+sources = marshal.load(sys.stdin.buffer)
+best = None
+for _ in range(int(sys.argv[1])):
+    start = time.perf_counter()
+    for filename, source in sources.items():
+        try:
+            compile(source, filename, 'exec', dont_inherit=True)
+        except SyntaxError:
+            pass  # too new for this interpreter
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+print(best)
+'''
+
+
+def default_wheel() -> str:
+    import ensurepip
+    bundled = os.path.join(os.path.dirname(ensurepip.__file__), '_bundled')
+    wheels = glob.glob(os.path.join(bundled, 'pip-*.whl'))
+    if not wheels:
+        sys.exit('no wheel given, and no pip wheel bundled with ensurepip')
+    return wheels[0]
+
+
+def compile_time(interpreter: str, contents: Dict[str, bytes], rounds: int) -> float:
+    sources = {filename: data for filename, data in contents.items()
+               if filename.endswith('.py')}
+    process = subprocess.run([interpreter, '-c', COMPILE_SCRIPT, str(rounds)],
+                             input=marshal.dumps(sources), stdout=subprocess.PIPE,
+                             check=True)
+    return float(process.stdout)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measure the effect of beipack --minify")
+    parser.add_argument('--python', metavar='INTERPRETER', default=sys.executable,
+                        help="the interpreter to measure compile times with "
+                             "(default: this one)")
+    parser.add_argument('--compress', metavar='FORMAT[:LEVEL]', default='xz',
+                        help="the compression format to report sizes for "
+                             "(default: xz)")
+    parser.add_argument('--rounds', type=int, default=5,
+                        help="compile everything this many times, and report the "
+                             "fastest")
+    parser.add_argument('wheel', nargs='?',
+                        help="the wheel to measure")
+    args = parser.parse_args()
+
+    original = beipack.collect_zip(args.wheel or default_wheel())
+    variants = {
+        'original': original,
+        'minify': dict(beipack.minify_contents(original.items())),
+        'minify-annotations': dict(beipack.minify_contents(original.items(),
+                                                           annotations=True)),
+    }
+
+    print(f'{"variant":20} {"pack":>10} {args.compress:>10} {"compile":>10}')
+    for name, contents in variants.items():
+        pack = beipack.pack(contents).encode()
+        compressed = compression.compress(pack, args.compress)
+        elapsed = compile_time(args.python, contents, args.rounds)
+        print(f'{name:20} {len(pack):10} {len(compressed):10} {elapsed * 1000:8.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
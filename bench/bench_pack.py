@@ -0,0 +1,316 @@
+# beipack - Remote bootloader for Python
+#
+# Copyright (C) 2023 Allison Karlitskaya <allison.karlitskaya@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for building packs, and for loading them on the target.
+
+Each corpus is collected from a zipfile, encoded, packed and compressed, and
+then the pack is fed to the stdin of the target interpreter's REPL, which
+imports all of the modules and reads all of the other files.  The results can
+be written to a JSON file (--json) and compared with the results from another
+revision (--compare):
+
+    python3 bench/bench_pack.py --json before.json
+    git checkout ...
+    python3 bench/bench_pack.py --compare before.json
+
+Times are the best of --rounds runs.  The exec time includes starting the
+interpreter.  Peak memory is measured separately with tracemalloc, so it only
+counts allocations made by Python.
+"""
+
+import argparse
+import glob
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from typing import Callable, Dict, List, Tuple, TypeVar
+
+from bei import beipack, compression
+
+T = TypeVar('T')
+
+# Fed to the target's REPL after the pack: loads everything
+LOAD_SCRIPT = '''
+import importlib, time; middle = time.perf_counter()
+for name in {}: importlib.import_module(name)
+
+for filename in list(sys.meta_path[0].contents):
+    filename.endswith('.py') or sys.meta_path[0].get_data(filename)
+
+print(middle, time.perf_counter())
+'''
+
+WORDS = ('import', 'return', 'self', 'data', 'value', 'result', 'None', 'for', 'in',
+         'if', 'else', 'len')
+ASCII = 'abcdefghijklmnopqrstuvwxyz '
+NON_ASCII = 'äöüßéèêçñøåłśžčřπλΩжлдяфщ中文字符日本語한국어'
+
+
+def python_module(rng: random.Random, size: int, alphabet: str) -> bytes:
+    lines: List[str] = []
+    length = 0
+    while length < size:
+        i = len(lines)
+        text = ' '.join(rng.choice(WORDS) for _ in range(8))
+        text += ''.join(rng.choice(alphabet) for _ in range(24))
+        line = (f'def function_{i}(value):\n'
+                f'    """{text}"""\n'
+                f'    return value + {rng.randrange(1000)}\n\n')
+        lines.append(line)
+        length += len(line.encode())
+    return ''.join(lines).encode()
+
+
+def add_packages(contents: Dict[str, bytes]) -> Dict[str, bytes]:
+    # the loader doesn't do namespace packages
+    for filename in list(contents):
+        directory = os.path.dirname(filename)
+        while directory:
+            contents.setdefault(f'{directory}/__init__.py', b'')
+            directory = os.path.dirname(directory)
+    return contents
+
+
+def corpus_ascii(rng: random.Random) -> Dict[str, bytes]:
+    return {f'corpus/module_{i}.py': python_module(rng, 8192, ASCII)
+            for i in range(200)}
+
+
+def corpus_utf8(rng: random.Random) -> Dict[str, bytes]:
+    return {f'corpus/module_{i}.py': python_module(rng, 8192, NON_ASCII)
+            for i in range(200)}
+
+
+def corpus_binary(rng: random.Random) -> Dict[str, bytes]:
+    # half random, half runs: compressible, but not too compressible
+    contents = {}
+    for i in range(50):
+        contents[f'corpus/data_{i}.bin'] = b''.join(
+            rng.getrandbits(8 * 64).to_bytes(64, 'little')
+            + bytes([rng.randrange(256)]) * 64
+            for _ in range(512)
+        )
+    return contents
+
+
+def corpus_small(rng: random.Random) -> Dict[str, bytes]:
+    return {f'corpus/sub_{i // 100}/module_{i}.py': python_module(rng, 200, 'abcdef ')
+            for i in range(3000)}
+
+
+def corpus_large(rng: random.Random) -> Dict[str, bytes]:
+    return {f'corpus/module_{i}.py': python_module(rng, 2 << 20, ASCII)
+            for i in range(4)}
+
+
+SYNTHETIC: Dict[str, Callable[[random.Random], Dict[str, bytes]]] = {
+    'ascii': corpus_ascii,
+    'utf8': corpus_utf8,
+    'binary': corpus_binary,
+    'small': corpus_small,
+    'large': corpus_large,
+}
+
+
+def default_wheel() -> str:
+    import ensurepip
+    bundled = os.path.join(os.path.dirname(ensurepip.__file__), '_bundled')
+    wheels = glob.glob(os.path.join(bundled, 'pip-*.whl'))
+    return wheels[0] if wheels else ''
+
+
+def best_of(rounds: int, func: Callable[[], T]) -> Tuple[float, T]:
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    assert best is not None
+    return best, result
+
+
+def peak_memory(func: Callable[[], object]) -> int:
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def load_times(interpreter: str, pack: bytes, imports: List[str],
+               rounds: int) -> Tuple[float, float]:
+    best_exec, best_import = float('inf'), float('inf')
+    script = pack + LOAD_SCRIPT.format(imports).encode()
+    for _ in range(rounds):
+        # perf_counter() is CLOCK_MONOTONIC on Linux, so we can compare
+        start = time.perf_counter()
+        process = subprocess.run([interpreter, '-iq'], input=script,
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                 check=True)
+        middle, end = map(float, process.stdout.split()[-2:])
+        best_exec = min(best_exec, middle - start)
+        best_import = min(best_import, end - middle)
+    return best_exec, best_import
+
+
+def measure(zip_filename: str, imports: List[str],
+            args: argparse.Namespace) -> Dict[str, float]:
+    results: Dict[str, float] = {}
+
+    results['collect_zip'], contents = best_of(
+        args.rounds, lambda: beipack.collect_zip(zip_filename))
+    results['files'] = len(contents)
+    results['input_size'] = sum(len(data) for data in contents.values())
+
+    results['bytes_repr'], _ = best_of(
+        args.rounds, lambda: beipack.dict_repr(contents, set()))
+    results['base64_bytes_repr'], _ = best_of(
+        args.rounds,
+        lambda: beipack.dict_repr(contents, set(), beipack.base64_bytes_repr))
+
+    def make_pack() -> bytes:
+        stream = io.BytesIO()
+        beipack.pack_to(stream, contents.items(), blob=args.blob)
+        return stream.getvalue()
+
+    results['pack'], data = best_of(args.rounds, make_pack)
+    results['pack_peak_memory'] = peak_memory(make_pack)
+    results['pack_size'] = len(data)
+
+    results['compress'], compressed = best_of(
+        args.rounds, lambda: compression.compress(data, args.compress))
+    results['compressed_size'] = len(compressed)
+
+    results['exec'], results['import'] = load_times(args.python, data, imports,
+                                                    args.rounds)
+
+    return results
+
+
+def write_zip(directory: str, name: str, contents: Dict[str, bytes]) -> str:
+    filename = os.path.join(directory, f'{name}.zip')
+    with zipfile.ZipFile(filename, 'w') as file:
+        for path, data in contents.items():
+            file.writestr(path, data)
+    return filename
+
+
+def modules(filenames: List[str]) -> List[str]:
+    return sorted(beipack.module_name(filename) for filename in filenames
+                  if filename.endswith('.py'))
+
+
+def revision() -> str:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              cwd=os.path.dirname(__file__), stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True,
+                              universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def report(results: Dict[str, Dict[str, float]],
+           previous: Dict[str, Dict[str, float]]) -> None:
+    out = io.StringIO()
+    for corpus, metrics in results.items():
+        out.write(f'{corpus}\n')
+        for metric, value in metrics.items():
+            if isinstance(value, float):
+                line = f'  {metric:20} {value:14.4f}'
+            else:
+                line = f'  {metric:20} {value:14}'
+            old = previous.get(corpus, {}).get(metric)
+            if old:
+                line += f'  {(value - old) / old:+8.1%}'
+            out.write(line + '\n')
+    sys.stdout.write(out.getvalue())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark beipack")
+    parser.add_argument('--python', metavar='INTERPRETER', default=sys.executable,
+                        help="the target interpreter (default: this one)")
+    parser.add_argument('--compress', metavar='FORMAT[:LEVEL]', default='xz',
+                        help="the compression format to measure (default: xz)")
+    parser.add_argument('--rounds', type=int, default=3,
+                        help="run everything this many times, and report the fastest")
+    parser.add_argument('--blob', action='store_true',
+                        help="measure packs in the blob format (see beipack --blob)")
+    parser.add_argument('--corpus', action='append', choices=[*SYNTHETIC, 'wheel'],
+                        help="only run the given corpus (default: all of them)")
+    parser.add_argument('--wheel', default=default_wheel(),
+                        help="the wheel to use as a real-world corpus "
+                             "(default: pip from ensurepip)")
+    parser.add_argument('--wheel-import', metavar='MODULE', action='append',
+                        help="the modules to import from the wheel "
+                             "(default: its top-level packages)")
+    parser.add_argument('--json', metavar='FILE',
+                        help="write the results to FILE")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare with results previously written with --json")
+    args = parser.parse_args()
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as file:
+            compare = json.load(file)
+        if (compare['python'], compare['compress']) != (args.python, args.compress):
+            sys.stderr.write(f'warning: comparing with {compare["python"]} '
+                             f'and {compare["compress"]}\n')
+        previous = compare['results']
+
+    results: Dict[str, Dict[str, float]] = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in args.corpus or [*SYNTHETIC, 'wheel']:
+            if name == 'wheel':
+                if not args.wheel:
+                    sys.stderr.write('no --wheel given, and no wheel bundled with '
+                                     'ensurepip: skipping\n')
+                    continue
+                filename = args.wheel
+                filenames = zipfile.ZipFile(filename).namelist()
+                imports = args.wheel_import or [name for name in modules(filenames)
+                                                if '.' not in name]
+            else:
+                contents = add_packages(SYNTHETIC[name](random.Random(name)))
+                filename = write_zip(tmpdir, name, contents)
+                imports = modules(list(contents))
+
+            results[name] = measure(filename, imports, args)
+
+    report(results, previous)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'revision': revision(), 'python': args.python,
+                       'compress': args.compress, 'blob': args.blob,
+                       'results': results}, file, indent=2)
+            file.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -17,14 +17,61 @@
 
 import argparse
 import asyncio
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
 import os
 import shlex
+import socket
+import stat
+import struct
 import subprocess
 import sys
-import threading
-from typing import IO, List, Sequence, Tuple
+import time
+import uuid
+from typing import (
+    Any,
+    Awaitable,
+    BinaryIO,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
-from .bootloader import make_bootloader
+from .beipack import pack_skeleton, positive_int, unpack
+from .bootloader import make_bootloader, make_framed, make_relay_bootloader
+from .compression import MODULES, compress, decompress, detect_format, parse_format
+
+# Candidates for --compression=auto, and the size of the sample of the program
+# which is used to measure the link and the remote CPU.
+AUTO_FORMATS = ('none', 'zlib:6', 'bz2', 'xz:6', 'xz')
+AUTO_SAMPLE_SIZE = 1 << 15
+
+# The largest amount of data which forward() moves at once
+FORWARD_BLOCK_SIZE = 1 << 20
+
+# boot_hosts() reads the output of each host in blocks of this size
+COPY_BLOCK_SIZE = 1 << 16
+
+# boot() writes the script in slices of this size (see write_shared())
+SHARED_WRITE_SIZE = 1 << 16
+
+# Messages to and from the agent gadget are a type and a size, then the data.
+# Once the program is running, the client sends its stdin as a plain stream.
+AGENT_HEADER = struct.Struct('!BI')
+AGENT_READY = b'beiboot.agent ready\n'
+
+# How often the bootloader reports its progress with --progress, in seconds
+PROGRESS_INTERVAL = 0.1
+PROGRESS_BAR_WIDTH = 30
+
+# With --cache, the remote keeps at most this much in ~/.cache/beipack/
+CACHE_LIMIT = 256 << 20
 
 
 def get_python_command(local: bool = False,
@@ -66,35 +113,349 @@ def get_command(*args: str, tty: bool = False, sh: bool = False) -> Sequence[str
     return (*args, *get_python_command(local=True, tty=tty, sh=sh))
 
 
-def splice_in_thread(src: int, dst: IO[bytes]) -> None:
-    def _thread() -> None:
-        # os.splice() only in Python 3.10
-        with dst:
-            block_size = 1 << 20
-            while True:
-                data = os.read(src, block_size)
-                if not data:
-                    break
-                dst.write(data)
-                dst.flush()
+def forward_method(src: int, dst: int) -> str:
+    """Chooses how `forward()` moves data: 'splice', 'sendfile' or 'copy'."""
+    src_mode, dst_mode = os.fstat(src).st_mode, os.fstat(dst).st_mode
+    if hasattr(os, 'splice') and (stat.S_ISFIFO(src_mode) or stat.S_ISFIFO(dst_mode)):
+        return 'splice'
+    elif hasattr(os, 'sendfile') and stat.S_ISREG(src_mode):
+        return 'sendfile'
+    else:
+        return 'copy'
+
+
+def forward_copy(src: int, dst: int, block_size: int) -> Tuple[int, memoryview]:
+    """Reads a block from `src` and writes as much of it as fits in `dst`.
+
+    Returns the size of the block, and the part of it which is still to be
+    written.
+    """
+    data = os.read(src, block_size)
+    try:
+        written = os.write(dst, data) if data else 0
+    except BlockingIOError:
+        written = 0
+    return len(data), memoryview(data)[written:]
+
+
+def forward_block(method: str,
+                  src: int,
+                  dst: int,
+                  block_size: int) -> Tuple[int, memoryview]:
+    """Moves a block from `src` to `dst` with `method`, like `forward_copy()`."""
+    if method == 'splice':
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        return os.splice(src, dst, block_size, flags=flags), memoryview(b'')
+    elif method == 'sendfile':
+        return os.sendfile(dst, src, None, block_size), memoryview(b'')
+    else:
+        return forward_copy(src, dst, block_size)
+
 
-    threading.Thread(target=_thread, daemon=True).start()
+class Forwarder:
+    """The state of a `forward()`, driven by callbacks from the event loop."""
+    def __init__(self, src: int, dst: int, block_size: int) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.done: 'asyncio.Future[int]' = self.loop.create_future()
+        self.src, self.dst, self.block_size = src, dst, block_size
+        self.method = forward_method(src, dst)
+        self.pending = memoryview(b'')
+        self.total = 0
+        self.polled = True
 
+    def transfer(self) -> int:
+        try:
+            count, self.pending = forward_block(self.method, self.src, self.dst,
+                                                self.block_size)
+            return count
+        except OSError as exc:
+            # eg: splice() from a terminal
+            if exc.errno != errno.EINVAL or self.method == 'copy':
+                raise
+            self.method = 'copy'
+            return self.transfer()
 
-def send_and_splice(command: Sequence[str], script: bytes) -> None:
+    def watch_src(self) -> None:
+        try:
+            self.loop.add_reader(self.src, self.readable)
+        except PermissionError:
+            # regular files can't be polled, but are always readable
+            self.polled = False
+            self.loop.call_soon(self.readable)
+
+    def readable(self) -> None:
+        if self.done.done():
+            return
+        try:
+            count = self.transfer()
+        except BlockingIOError:
+            # dst is full (or src was empty after all: splice() can't tell us which)
+            count = -1
+        except OSError as exc:
+            self.loop.remove_reader(self.src)
+            self.done.set_exception(exc)
+            return
+
+        if count == 0:
+            self.loop.remove_reader(self.src)
+            self.done.set_result(self.total)
+        elif count < 0 or self.pending:
+            self.total += max(count, 0)
+            self.loop.remove_reader(self.src)
+            self.loop.add_writer(self.dst, self.writable)
+        else:
+            self.total += count
+            if not self.polled:
+                self.loop.call_soon(self.readable)
+
+    def writable(self) -> None:
+        try:
+            self.pending = self.pending[os.write(self.dst, self.pending):]
+        except BlockingIOError:
+            return
+        except OSError as exc:
+            self.loop.remove_writer(self.dst)
+            self.done.set_exception(exc)
+            return
+        if not self.pending:
+            self.loop.remove_writer(self.dst)
+            self.watch_src()
+
+    async def run(self) -> int:
+        self.watch_src()
+        try:
+            return await self.done
+        finally:
+            self.loop.remove_reader(self.src)
+            self.loop.remove_writer(self.dst)
+
+
+async def forward(src: int, dst: int, block_size: int = FORWARD_BLOCK_SIZE) -> int:
+    """Copies everything from `src` to `dst`, and returns the number of bytes.
+
+    If either side is a pipe, the data is moved with `os.splice()`, without
+    copying it through userspace.  From a regular file, `os.sendfile()` is
+    used.  Otherwise (or if the kernel refuses), it's `os.read()` and
+    `os.write()`.  While `dst` is full, we stop reading from `src`, so a slow
+    reader of `dst` slows down the writer of `src`.  If `dst` is a pipe, it's
+    grown to `block_size` (if allowed), to wake us up less often.
+
+    `dst` should be non-blocking, or else the event loop may be blocked.  It
+    is not closed.
+    """
+    if stat.S_ISFIFO(os.fstat(dst).st_mode) and hasattr(fcntl, 'F_SETPIPE_SZ'):
+        with contextlib.suppress(OSError):
+            fcntl.fcntl(dst, fcntl.F_SETPIPE_SZ, block_size)
+    return await Forwarder(src, dst, block_size).run()
+
+
+async def forward_stdin(proc: 'subprocess.Popen[bytes]',
+                        before: Optional[Awaitable[None]] = None) -> int:
+    """Forwards our stdin to `proc` until it exits, and returns its exit status.
+
+    If `before` is given, it's awaited first (ie: the bootloader's interaction
+    with us).  The stdin of `proc` is closed at EOF.
+    """
+    assert proc.stdin is not None
+    loop = asyncio.get_running_loop()
+
+    if before is not None:
+        await before
+
+    async def forward_and_close() -> None:
+        assert proc.stdin is not None
+        proc.stdin.flush()
+        os.set_blocking(proc.stdin.fileno(), False)
+        with proc.stdin, contextlib.suppress(OSError):
+            await forward(0, proc.stdin.fileno())
+
+    forwarding = asyncio.ensure_future(forward_and_close())
+    status = await loop.run_in_executor(None, proc.wait)
+    forwarding.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await forwarding
+    return status
+
+
+def send_and_splice(command: Sequence[str],
+                    script: bytes,
+                    framed: bool = False) -> None:
+    """Types `script` into the REPL of `command`, or sends it `make_framed()`."""
     with subprocess.Popen(command, stdin=subprocess.PIPE) as proc:
         assert proc.stdin is not None
-        proc.stdin.write(script)
+        proc.stdin.write(make_framed(script) if framed else script)
+
+        sys.exit(asyncio.run(forward_stdin(proc)))
+
+
+def format_profile(records: List[Dict[str, Any]]) -> str:
+    """Formats the import profile sent by the loader as a table.
+
+    The modules are sorted by their own time: the time to find, decompress,
+    compile and execute them, excluding the nested imports.  All times are in
+    milliseconds.
+    """
+    nested: Dict[str, float] = {}
+    for record in records:
+        if record['parent'] is not None:
+            parent = record['parent']
+            nested[parent] = nested.get(parent, 0.0) + record['find'] + record['exec']
+
+    def own_time(record: Dict[str, Any]) -> float:
+        return float(record['find'] + record['exec'] - nested.get(record['name'], 0.0))
+
+    lines = [f'{"self":>8} {"total":>8} {"find":>7} {"decomp":>7} {"compile":>7} '
+             f'{"size":>9}  module']
+    for record in sorted(records, key=own_time, reverse=True):
+        total = record['find'] + record['exec']
+        lines.append(f'{own_time(record) * 1000:8.2f} {total * 1000:8.2f} '
+                     f'{record["find"] * 1000:7.2f} '
+                     f'{record["decompress"] * 1000:7.2f} '
+                     f'{record["compile"] * 1000:7.2f} {record["size"]:9}  '
+                     f'{record["name"]}'
+                     + (f' (from {record["parent"]})' if record['parent'] else ''))
+    return ''.join(f'{line}\n' for line in lines)
+
+
+def format_progress(received: int, size: int, elapsed: float) -> str:
+    """Formats a progress report from the bootloader as a progress bar."""
+    fraction = received / size if size else 1.0
+    filled = int(fraction * PROGRESS_BAR_WIDTH)
+    rate = received / elapsed if elapsed > 0 else 0.0
+    return (f'[{"#" * filled}{"." * (PROGRESS_BAR_WIDTH - filled)}] {fraction:4.0%} '
+            f'{received / 1e6:.1f}/{size / 1e6:.1f}MB {rate / 1e6:.1f}MB/s')
+
+
+def write_progress(received: int, size: int, elapsed: float) -> None:
+    sys.stderr.write(f'\rbeiboot: {format_progress(received, size, elapsed)}'
+                     + ('\n' if received == size else ''))
+    sys.stderr.flush()
+
+
+def write_profile(records: List[Dict[str, Any]], filename: str) -> None:
+    if filename == '-':
+        sys.stderr.write(format_profile(records))
+    else:
+        with open(filename, 'w') as file:
+            json.dump(records, file, indent=2)
+
+
+def send_xz_and_splice(command: Sequence[str],
+                       script: bytes,
+                       cache: bool = False) -> None:
+    send_compressed_and_splice(command, script, 'xz', cache=cache)
+
+
+def boot_step(script: bytes, fmt: str, args: Sequence[str], profile: bool,
+              progress: bool, cache: bool,
+              trace: bool = False) -> Tuple[str, Sequence[object]]:
+    """The bootloader step to send `script`, via the remote cache if `cache`."""
+    filename = f'script.py.{fmt}'
+    if cache:
+        if profile or progress or trace:
+            raise ValueError('the remote cache can not be used with profiling, '
+                             'progress reports or tracing')
+        digest = hashlib.sha256(script).hexdigest()
+        return 'boot_cached', (filename, fmt, len(script), digest, list(args), True,
+                               CACHE_LIMIT)
+    interval = PROGRESS_INTERVAL if progress else None
+    return 'boot_compressed', (filename, fmt, len(script), list(args), True, None,
+                               profile, interval, trace)
+
+
+def clock_offset(ping_sent: float,
+                 ping_received: float,
+                 pong_received: float) -> float:
+    """Estimates what to add to the remote's clock to get ours, from a round trip.
+
+    The remote sends the ping at `ping_sent` and gets our reply at
+    `pong_received` (by its clock), and we get the ping at `ping_received`.
+    This assumes that the delay is the same in both directions.
+    """
+    return ping_received - (ping_sent + pong_received) / 2
+
+
+def make_trace(launcher: Sequence[Tuple[str, float, float]],
+               remote: Sequence[Sequence[Any]],
+               offset: float) -> Dict[str, Any]:
+    """Builds a Chrome trace of a boot (for https://ui.perfetto.dev, for example).
+
+    `launcher` and `remote` are the phases on each side, as (name, start, end)
+    wall clock times.  The remote ones can also have a dictionary of details.
+    `offset` is added to the remote times (see `clock_offset()`).  Times in
+    the trace are in microseconds from the start of the first phase.
+    """
+    origin = min(start for _name, start, *_rest in launcher)
+    events: List[Dict[str, Any]] = []
+    sides = [(1, 'beiboot', launcher, 0.0), (2, 'remote', remote, offset)]
+    for pid, side, phases, shift in sides:
+        events.append({'ph': 'M', 'name': 'process_name', 'pid': pid, 'tid': pid,
+                       'args': {'name': side}})
+        for name, start, end, *details in phases:
+            events.append({'ph': 'X', 'name': name, 'pid': pid, 'tid': pid,
+                           'ts': round((start + shift - origin) * 1e6),
+                           'dur': round((end - start) * 1e6),
+                           'args': details[0] if details else {}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms',
+            'otherData': {'clock_offset': offset}}
+
 
-        splice_in_thread(0, proc.stdin)
-        sys.exit(proc.wait())
+def format_trace(trace: Dict[str, Any]) -> str:
+    """Formats a trace from `make_trace()` as a table, in order of start time.
 
+    All times are in milliseconds.
+    """
+    events = trace['traceEvents']
+    sides = {event['pid']: event['args']['name']
+             for event in events if event['ph'] == 'M'}
+    phases = sorted((event for event in events if event['ph'] == 'X'),
+                    key=lambda event: event['ts'])
+    lines = [f'{"start":>9} {"time":>9}  {"side":8} phase']
+    for event in phases:
+        lines.append(f'{event["ts"] / 1000:9.1f} {event["dur"] / 1000:9.1f}  '
+                     f'{sides[event["pid"]]:8} {event["name"]}')
+    return ''.join(f'{line}\n' for line in lines)
 
-def send_xz_and_splice(command: Sequence[str], script: bytes) -> None:
+
+def write_trace(trace: Dict[str, Any], filename: str) -> None:
+    if filename == '-':
+        sys.stderr.write(format_trace(trace))
+    else:
+        with open(filename, 'w') as file:
+            json.dump(trace, file, indent=2)
+
+
+def send_compressed_and_splice(command: Sequence[str], script: bytes, fmt: str,
+                               profile: Optional[str] = None,
+                               progress: bool = False,
+                               cache: bool = False,
+                               hops: Sequence[Sequence[str]] = (),
+                               trace: Optional[str] = None) -> None:
+    """Sends the compressed `script` via the boot_compressed gadget.
+
+    If `profile` is given, the imports done by the script's entrypoint are
+    profiled, and the results are written to `profile` as JSON (or as a table
+    to stderr, for '-').  If `progress` is set, a progress bar is shown on
+    stderr while the script is being sent.  If `cache` is set, the script is
+    sent via the boot_cached gadget instead, which keeps it in the remote's
+    ~/.cache/beipack/ and only asks for it if it isn't there already.
+
+    If `hops` are given, `command` only reaches the first of a chain of
+    relays, which run each of the `hops` in turn to reach the next one (see
+    `make_relay_bootloader()`).  The script is booted at the end.
+
+    If `trace` is given, the time taken by each phase of the boot, on both
+    sides, is written to `trace` as a Chrome trace (or as a table to stderr,
+    for '-').
+    """
     import ferny
 
+    timestamps: Dict[str, float] = {}
+    remote_phases: List[List[Any]] = []
+
     class Responder(ferny.InteractionResponder):
-        commands = ('beiboot.provide',)
+        commands = ('beiboot.ping', 'beiboot.provide', 'beiboot.profile',
+                    'beiboot.progress', 'beiboot.trace')
 
         async def do_custom_command(self,
                                     command: str,
@@ -102,34 +463,682 @@ def send_xz_and_splice(command: Sequence[str], script: bytes) -> None:
                                     fds: List[int],
                                     stderr: str) -> None:
             assert proc.stdin is not None
-            if command == 'beiboot.provide':
+            if command == 'beiboot.ping':
+                timestamps['ping'] = time.time()
+                proc.stdin.write(b'\n')
+                proc.stdin.flush()
+            elif command == 'beiboot.provide':
+                timestamps['provide'] = time.time()
                 proc.stdin.write(script)
                 proc.stdin.flush()
+                timestamps['sent'] = time.time()
+            elif command == 'beiboot.profile' and profile is not None:
+                write_profile(args[0], profile)
+            elif command == 'beiboot.progress':
+                write_progress(*args)
+            elif command == 'beiboot.trace':
+                remote_phases.extend(args[0])
+
+    async def communicate() -> None:
+        await agent.communicate()
+        timestamps['end'] = time.time()
+        if trace is not None and remote_phases:
+            phases = {phase[0]: phase for phase in remote_phases}
+            _name, ping_sent, pong_received, _details = phases['clock sync']
+            offset = clock_offset(ping_sent, timestamps['ping'], pong_received)
+            write_trace(make_trace([
+                ('spawn', timestamps['start'], timestamps['spawned']),
+                ('send bootloader', timestamps['spawned'], timestamps['bootloader']),
+                ('wait for remote', timestamps['bootloader'], timestamps['ping']),
+                ('send script', timestamps['provide'], timestamps['sent']),
+                ('wait for entrypoint', timestamps['sent'], timestamps['end']),
+            ], remote_phases, offset), trace)
+
+    step = boot_step(script, fmt, [], profile is not None, progress, cache,
+                     trace is not None)
+    agent = ferny.InteractionAgent(Responder())
+    timestamps['start'] = time.time()
+    with subprocess.Popen(command, stdin=subprocess.PIPE, stderr=agent) as proc:
+        assert proc.stdin is not None
+        timestamps['spawned'] = time.time()
+        bootloader = make_relay_bootloader(hops, [step], gadgets=ferny.BEIBOOT_GADGETS)
+        proc.stdin.write(bootloader.encode())
+        proc.stdin.flush()
+        timestamps['bootloader'] = time.time()
+
+        sys.exit(asyncio.run(forward_stdin(proc, communicate())))
+
+
+def choose_compression(size: int,
+                       samples: Dict[str, Tuple[int, int, float, float]],
+                       bandwidth: float) -> str:
+    """Picks the format which will get a program of `size` bytes running soonest.
+
+    `samples` maps each candidate format to the size of a sample of the
+    program before and after compression, and the time taken to compress it
+    locally and to decompress it remotely.  `bandwidth` is in bytes per second.
+    """
+    def boot_time(fmt: str) -> float:
+        sample_size, compressed_size, compress_time, decompress_time = samples[fmt]
+        scale = size / sample_size
+        return (compress_time + compressed_size / bandwidth + decompress_time) * scale
+
+    return min(samples, key=boot_time)
+
+
+def send_auto_and_splice(command: Sequence[str],
+                         program: bytes,
+                         profile: Optional[str] = None,
+                         progress: bool = False) -> None:
+    import ferny
+
+    middle = len(program) // 2
+    sample = program[max(middle - AUTO_SAMPLE_SIZE // 2, 0):][:AUTO_SAMPLE_SIZE]
+    compressed_samples: Dict[str, bytes] = {}
+    compress_times: Dict[str, float] = {}
+    for fmt in AUTO_FORMATS:
+        if fmt != 'none':
+            start = time.monotonic()
+            compressed_samples[fmt] = compress(sample, fmt)
+            compress_times[fmt] = time.monotonic() - start
+
+    timestamps: Dict[str, float] = {}
+
+    class Responder(ferny.InteractionResponder):
+        commands = ('beiboot.ping', 'beiboot.probe', 'beiboot.provide',
+                    'beiboot.profile', 'beiboot.progress')
+
+        async def do_custom_command(self,
+                                    command: str,
+                                    args: Tuple,
+                                    fds: List[int],
+                                    stderr: str) -> None:
+            assert proc.stdin is not None
+            now = time.monotonic()
+
+            if command == 'beiboot.ping':
+                # the remote waits for a newline before sending the probe
+                # request: this gives us the round trip time
+                proc.stdin.write(b'\n')
+                proc.stdin.flush()
+                timestamps['ping'] = time.monotonic()
+
+            elif command == 'beiboot.probe':
+                timestamps['rtt'] = now - timestamps['ping']
+                proc.stdin.write(b''.join(compressed_samples.values()))
+                proc.stdin.flush()
+                timestamps['probe'] = now
+
+            elif command == 'beiboot.provide':
+                # strict= needs Python 3.10
+                decompress_times = dict(zip(compressed_samples, args[0]))  # noqa: B905
+                elapsed = (now - timestamps['probe'] - timestamps['rtt']
+                           - sum(decompress_times.values()))
+                sent = sum(len(data) for data in compressed_samples.values())
+                bandwidth = sent / max(elapsed, 1e-3)
+
+                candidates = {'none': (len(sample), len(sample), 0.0, 0.0)}
+                for fmt, data in compressed_samples.items():
+                    candidates[fmt] = (len(sample), len(data),
+                                       compress_times[fmt], decompress_times[fmt])
+                fmt = choose_compression(len(program), candidates, bandwidth)
+
+                script = compress(program, fmt)
+                header = f'{parse_format(fmt)[0]} {len(script)}\n'
+                proc.stdin.write(header.encode('ascii') + script)
+                proc.stdin.flush()
+
+            elif command == 'beiboot.profile' and profile is not None:
+                write_profile(args[0], profile)
 
+            elif command == 'beiboot.progress':
+                write_progress(*args)
+
+    interval = PROGRESS_INTERVAL if progress else None
+    samples = [(parse_format(fmt)[0], len(data))
+               for fmt, data in compressed_samples.items()]
     agent = ferny.InteractionAgent(Responder())
     with subprocess.Popen(command, stdin=subprocess.PIPE, stderr=agent) as proc:
         assert proc.stdin is not None
         proc.stdin.write(make_bootloader([
-            ('boot_xz', ('script.py.xz', len(script), [], True)),
+            ('boot_compressed', ('script.py', None, 0, [], True, samples,
+                                 profile is not None, interval)),
         ], gadgets=ferny.BEIBOOT_GADGETS).encode())
         proc.stdin.flush()
 
-        asyncio.run(agent.communicate())
-        splice_in_thread(0, proc.stdin)
-        sys.exit(proc.wait())
+        sys.exit(asyncio.run(forward_stdin(proc, agent.communicate())))
 
 
-def main() -> None:
+def send_sync_and_splice(command: Sequence[str],
+                         contents: Dict[str, bytes],
+                         code: str,
+                         fmt: str = 'xz') -> None:
+    """Sends the files in `contents` via the boot_sync gadget, then runs `code`.
+
+    The remote keeps the files in a content-addressed store in its
+    ~/.cache/beipack/files/, and only asks for the ones which it doesn't have
+    yet.  Those are compressed together in the format `fmt`.  `code` is run
+    after a loader for the files has been installed (see `beipack.unpack()`).
+    """
+    import ferny
+
+    files = {hashlib.sha256(data).hexdigest(): data for data in contents.values()}
+    manifest = {filename: hashlib.sha256(data).hexdigest()
+                for filename, data in contents.items()}
+
+    class Responder(ferny.InteractionResponder):
+        commands = ('beiboot.sync',)
+
+        async def do_custom_command(self,
+                                    command: str,
+                                    args: Tuple,
+                                    fds: List[int],
+                                    stderr: str) -> None:
+            assert proc.stdin is not None
+            if command == 'beiboot.sync':
+                missing = [files[digest] for digest in args[0]]
+                data = compress(b''.join(missing), fmt)
+                sizes = (str(len(file)) for file in missing)
+                header = ' '.join([parse_format(fmt)[0], str(len(data)), *sizes])
+                proc.stdin.write(f'{header}\n'.encode('ascii') + data)
+                proc.stdin.flush()
+
+    agent = ferny.InteractionAgent(Responder())
+    with subprocess.Popen(command, stdin=subprocess.PIPE, stderr=agent) as proc:
+        assert proc.stdin is not None
+        proc.stdin.write(make_bootloader([
+            ('boot_sync', ('script.py', manifest, pack_skeleton(code), [], True,
+                           CACHE_LIMIT)),
+        ], gadgets=ferny.BEIBOOT_GADGETS).encode())
+        proc.stdin.flush()
+
+        sys.exit(asyncio.run(forward_stdin(proc, agent.communicate())))
+
+
+class BootError(Exception):
+    """The bootloader failed on the remote side (the traceback is the message)."""
+
+
+class BootedProcess:
+    """A program which was started with `boot()`.
+
+    `stdin` is an `asyncio.StreamWriter`, and `stdout` is an
+    `asyncio.StreamReader` (or None, if it wasn't piped).  `boot_time` is the
+    number of seconds from starting the command until the program was running.
+    """
+    def __init__(self, process: asyncio.subprocess.Process, boot_time: float) -> None:
+        assert process.stdin is not None
+        self.process = process
+        self.stdin = process.stdin
+        self.stdout = process.stdout
+        self.boot_time = boot_time
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self.process.returncode
+
+    async def wait(self) -> int:
+        return await self.process.wait()
+
+    def terminate(self) -> None:
+        self.process.terminate()
+
+
+async def write_shared(writer: asyncio.StreamWriter, data: bytes) -> None:
+    # The transport copies whatever it can't write at once: keep that small,
+    # so that many processes can be sent the same data.
+    view = memoryview(data)
+    for offset in range(0, len(view), SHARED_WRITE_SIZE):
+        writer.write(view[offset:offset + SHARED_WRITE_SIZE])
+        await writer.drain()
+
+
+async def boot(command: Sequence[str],
+               script: bytes,
+               fmt: str = 'none',
+               args: Sequence[str] = (),
+               stdout: Optional[int] = asyncio.subprocess.PIPE,
+               profile: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
+               progress: Optional[Callable[[int, int, float], None]] = None,
+               cache: bool = False) -> BootedProcess:
+    """Runs `command` and boots the compressed `script` in it.
+
+    This is the asynchronous version of `send_compressed_and_splice()`: it
+    returns as soon as the script is running.  The same `script` can be sent
+    to any number of processes at once without being copied.  `args` are
+    given to the script as `sys.argv[1:]`.  If `profile` is given, it's
+    called with the profile of the imports done by the script's entrypoint.
+    If `progress` is given, it's called every so often while the script is
+    being sent, with the number of bytes received so far, the total, and the
+    time elapsed.  If `cache` is set, the remote keeps the script in its
+    ~/.cache/beipack/, and it's only sent if it isn't there already (this
+    can't be combined with `profile` or `progress`).
+
+    Raises BootError if the bootloader fails on the remote side.  The command
+    is terminated if it didn't boot.
+    """
+    import ferny
+
+    errors: List[str] = []
+
+    class Responder(ferny.InteractionResponder):
+        commands = ('beiboot.provide', 'beiboot.profile', 'beiboot.progress',
+                    'beiboot.exc')
+
+        async def do_custom_command(self,
+                                    command: str,
+                                    args: Tuple,
+                                    fds: List[int],
+                                    stderr: str) -> None:
+            assert process.stdin is not None
+            if command == 'beiboot.provide':
+                await write_shared(process.stdin, script)
+            elif command == 'beiboot.profile' and profile is not None:
+                profile(args[0])
+            elif command == 'beiboot.progress' and progress is not None:
+                progress(*args)
+            elif command == 'beiboot.exc':
+                errors.append(args[0])
+
+    step = boot_step(script, fmt, args, profile is not None, progress is not None,
+                     cache)
+    start = time.monotonic()
+    agent = ferny.InteractionAgent(Responder())
+    process = await asyncio.create_subprocess_exec(*command,
+                                                   stdin=asyncio.subprocess.PIPE,
+                                                   stdout=stdout, stderr=agent)
+    assert process.stdin is not None
+    try:
+        bootloader = make_bootloader([step], gadgets=ferny.BEIBOOT_GADGETS)
+        process.stdin.write(bootloader.encode())
+        await process.stdin.drain()
+        await agent.communicate()
+        if errors:
+            raise BootError(errors[0])
+    except BaseException:
+        # don't leave the command running (or unreaped) behind
+        process.stdin.close()
+        with contextlib.suppress(ProcessLookupError):
+            process.terminate()
+        await process.wait()
+        raise
+    return BootedProcess(process, time.monotonic() - start)
+
+
+async def relay(command: Sequence[str],
+                args: Sequence[str] = (),
+                stdout: Optional[int] = asyncio.subprocess.PIPE) -> BootedProcess:
+    """Boots the running program again, via `command` (ie: on the next host).
+
+    This only works in a program which was itself booted with its compressed
+    source (ie: it has a `__self_source__`).  That's sent on exactly as it
+    was received, without being decompressed and compressed again.  `args`
+    and `stdout` are as for `boot()`.
+    """
+    for finder in sys.meta_path:
+        source = getattr(finder, 'self_source', None)
+        if source is not None:
+            break
+    else:
+        raise BootError('this program was not booted with its source')
+    return await boot(command, source, detect_format(source), args, stdout)
+
+
+def read_hosts(filename: str) -> List[str]:
+    """Reads one host per line from `filename` ('-' for stdin), skipping comments."""
+    with open(0 if filename == '-' else filename, closefd=filename != '-') as file:
+        lines = (line.partition('#')[0].strip() for line in file)
+        return [line for line in lines if line]
+
+
+async def copy_prefixed(stream: asyncio.StreamReader, prefix: bytes) -> None:
+    """Copies `stream` to stdout, with `prefix` at the start of each line.
+
+    Lines are written whole, however long they are, so that they don't get
+    mixed up with the output of other hosts.
+    """
+    partial: List[bytes] = []
+    while True:
+        data = await stream.read(COPY_BLOCK_SIZE)
+        if not data:
+            break
+        *lines, last = data.split(b'\n')
+        if lines:
+            lines[0] = b''.join((*partial, lines[0]))
+            sys.stdout.buffer.write(b''.join(prefix + line + b'\n' for line in lines))
+            sys.stdout.buffer.flush()
+            partial = []
+        partial.append(last)
+    if any(partial):
+        sys.stdout.buffer.write(prefix + b''.join(partial) + b'\n')
+        sys.stdout.buffer.flush()
+
+
+async def boot_on_host(host: str, command: Sequence[str], script: bytes, fmt: str,
+                       semaphore: asyncio.Semaphore,
+                       cache: bool = False) -> Tuple[int, float]:
+    """Boots `script` on `host` via `command`, and prefixes its output with `host`.
+
+    Returns the exit status (255 if it failed to boot) and the total time.
+    """
+    async with semaphore:
+        start = time.monotonic()
+        try:
+            booted = await boot(command, script, fmt, cache=cache)
+        except Exception as exc:
+            sys.stderr.write(f'beiboot: {host}: failed to boot: {str(exc).strip()}\n')
+            return 255, time.monotonic() - start
+        sys.stderr.write(f'beiboot: {host}: running after {booted.boot_time:.2f}s\n')
+
+        booted.stdin.close()
+        assert booted.stdout is not None
+        try:
+            await copy_prefixed(booted.stdout, f'{host}: '.encode())
+            status = await booted.wait()
+        except Exception as exc:
+            sys.stderr.write(f'beiboot: {host}: {exc}\n')
+            if booted.returncode is None:
+                booted.terminate()
+            await booted.wait()
+            return 255, time.monotonic() - start
+        elapsed = time.monotonic() - start
+        sys.stderr.write(f'beiboot: {host}: exited with status {status} '
+                         f'after {elapsed:.2f}s\n')
+        return status, elapsed
+
+
+async def boot_hosts(hosts: Sequence[str], ssh_args: Sequence[str], script: bytes,
+                     fmt: str, parallel: int, cache: bool = False) -> int:
+    """Boots `script` on all of the `hosts` via ssh, at most `parallel` at once.
+
+    Returns 0 if it succeeded everywhere, and 1 otherwise.
+    """
+    semaphore = asyncio.Semaphore(parallel)
+    statuses = await asyncio.gather(*(
+        boot_on_host(host, get_ssh_command(*ssh_args, host), script, fmt, semaphore,
+                     cache)
+        for host in hosts
+    ))
+    # gather() keeps the order of the hosts (and strict= needs Python 3.10)
+    results = list(zip(hosts, statuses))  # noqa: B905
+    failed = [host for host, (status, _elapsed) in results if status != 0]
+    slowest, (_status, elapsed) = max(results, key=lambda result: result[1][1])
+    sys.stderr.write(f'beiboot: succeeded on {len(hosts) - len(failed)} of '
+                     f'{len(hosts)} hosts (slowest: {slowest}, {elapsed:.2f}s)\n')
+    if failed:
+        sys.stderr.write(f'beiboot: failed on: {" ".join(failed)}\n')
+    return 1 if failed else 0
+
+
+def agent_send(sock: socket.socket, kind: str, data: bytes = b'') -> None:
+    sock.sendall(AGENT_HEADER.pack(ord(kind), len(data)))
+    if data:
+        sock.sendall(data)
+
+
+def agent_recv(file: BinaryIO) -> Tuple[str, bytes]:
+    header = file.read(AGENT_HEADER.size)
+    if len(header) != AGENT_HEADER.size:
+        raise EOFError('the agent closed the connection')
+    kind, size = AGENT_HEADER.unpack(header)
+    data = file.read(size)
+    if len(data) != size:
+        raise EOFError('the agent closed the connection')
+    return chr(kind), data
+
+
+def start_agent(command: Sequence[str],
+                path: str,
+                remote_path: str,
+                timeout: float) -> None:
+    """Starts the agent gadget with `command`, and waits until it's ready.
+
+    The agent listens on `remote_path`, which `command` is expected to make
+    available locally as `path` (ie: `ssh -L`), unless they're the same.  It
+    exits when it's been idle for `timeout` seconds, or when its stdin is
+    closed.  That's held open by a detached child process, which also removes
+    `path` at the end.
+    """
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+
+    ready_read, ready_write = os.pipe()
+    if os.fork() == 0:
+        try:
+            os.close(ready_read)
+            os.setsid()
+            # don't keep anybody waiting for EOF on our stdout and stderr
+            devnull = os.open(os.devnull, os.O_RDWR)
+            os.dup2(devnull, 0)
+            os.dup2(devnull, 1)
+            with subprocess.Popen(command, stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE) as proc:
+                assert proc.stdin is not None
+                bootloader = make_bootloader([('agent', (remote_path, timeout))])
+                proc.stdin.write(bootloader.encode())
+                proc.stdin.flush()
+
+                async def run() -> None:
+                    assert proc.stdout is not None and proc.stderr is not None
+                    loop = asyncio.get_running_loop()
+                    # ...but show errors while starting up
+                    os.set_blocking(proc.stderr.fileno(), False)
+                    stderr = proc.stderr.fileno()
+                    forwarding = asyncio.ensure_future(forward(stderr, 2))
+                    ready = await loop.run_in_executor(None, proc.stdout.readline)
+                    os.write(ready_write, ready)
+                    os.close(ready_write)
+                    os.dup2(devnull, 2)
+                    await loop.run_in_executor(None, proc.wait)
+                    forwarding.cancel()
+
+                asyncio.run(run())
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+            os._exit(0)
+
+    os.close(ready_write)
+    with open(ready_read, 'rb') as file:
+        if file.read() != AGENT_READY:
+            sys.exit('beiboot: failed to start the agent')
+
+
+async def agent_recv_async(sock: socket.socket) -> Tuple[str, bytes]:
+    """Like `agent_recv()`, but from a non-blocking socket, in the event loop."""
+    loop = asyncio.get_running_loop()
+
+    async def recv_exactly(size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = await loop.sock_recv(sock, size - len(data))
+            if not chunk:
+                raise EOFError('the agent closed the connection')
+            data += chunk
+        return bytes(data)
+
+    kind, size = AGENT_HEADER.unpack(await recv_exactly(AGENT_HEADER.size))
+    return chr(kind), await recv_exactly(size)
+
+
+async def agent_session(sock: socket.socket,
+                        request: Dict[str, Any],
+                        script: bytes) -> int:
+    """Sends `request` to the agent, and then forwards our stdio until it exits."""
+    loop = asyncio.get_running_loop()
+
+    async def send(kind: str, data: bytes = b'') -> None:
+        await loop.sock_sendall(sock, AGENT_HEADER.pack(ord(kind), len(data)))
+        if data:
+            await loop.sock_sendall(sock, data)
+
+    async def forward_and_shutdown() -> None:
+        # our stdin goes to the program as it is, until EOF
+        with contextlib.suppress(OSError):
+            await forward(0, sock.fileno())
+            sock.shutdown(socket.SHUT_WR)
+
+    await send('R', json.dumps(request).encode())
+    kind, data = await agent_recv_async(sock)
+    if kind == 'N':
+        await send('P', script)
+        kind, data = await agent_recv_async(sock)
+
+    forwarding = asyncio.ensure_future(forward_and_shutdown()) if kind == 'S' else None
+    try:
+        if kind == 'S':
+            kind, data = await agent_recv_async(sock)
+        while kind != 'X':
+            output = sys.stdout.buffer if kind == 'O' else sys.stderr.buffer
+            output.write(data)
+            output.flush()
+            kind, data = await agent_recv_async(sock)
+    finally:
+        if forwarding is not None:
+            forwarding.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await forwarding
+
+    return int(data)
+
+
+def run_in_agent(path: str, script: bytes, fmt: str, args: Sequence[str] = ()) -> int:
+    """Runs the compressed `script` in the agent listening at `path`.
+
+    The script is only sent if the agent doesn't have it yet.  Our stdin is
+    forwarded to it with `forward()`, and its output is written to our stdout
+    and stderr.  Returns the exit status.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.setblocking(False)
+        request = {'digest': hashlib.sha256(script).hexdigest(), 'fmt': fmt,
+                   'filename': f'script.py.{fmt}', 'args': list(args)}
+        return asyncio.run(agent_session(sock, request, script))
+
+
+def stop_agent(path: str) -> None:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        agent_send(sock, 'Q')
+
+
+def read_script(args: argparse.Namespace) -> Tuple[bytes, str]:
+    """Reads --script or --xz, and (re)compresses it according to --compression."""
+    with open(args.script or args.xz, 'rb') as file:
+        script = file.read()
+    fmt = 'none' if args.script else detect_format(script)
+    if args.compression is not None:
+        script = compress(decompress(script, fmt), args.compression)
+        fmt = parse_format(args.compression)[0]
+    return script, fmt
+
+
+# The options which need a script (--script or --xz), and the options which
+# can't be used with each of them
+SCRIPT_OPTIONS: Dict[str, Tuple[str, ...]] = {
+    'profile_imports': (),
+    'progress': (),
+    'cache': ('compression=auto', 'profile_imports', 'progress', 'agent'),
+    'trace': ('compression=auto', 'cache', 'sync', 'agent', 'hosts'),
+    'via': ('compression=auto', 'sync', 'agent', 'hosts'),
+    'sync': ('compression=auto', 'profile_imports', 'progress', 'cache', 'agent',
+             'hosts'),
+    'hosts': ('compression=auto', 'profile_imports', 'progress', 'agent'),
+    'agent': ('compression=auto', 'profile_imports', 'progress'),
+    # only the plain REPL path can send the script framed
+    'framed': ('compression', 'profile_imports', 'progress', 'cache', 'trace', 'via',
+               'sync', 'hosts', 'agent'),
+}
+
+
+def make_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     parser.add_argument('--sh', action='store_true',
                         help='Pass Python interpreter command as shell-script')
-    parser.add_argument('--xz', help="the xz to run remotely")
+    parser.add_argument('--xz',
+                        help="the compressed script to run remotely (xz, zlib or bz2)")
     parser.add_argument('--script',
-                        help="the script to run remotely (must be repl-friendly)")
+                        help="the script to run remotely (must be repl-friendly, "
+                             "unless --framed)")
+    parser.add_argument('--framed', action='store_true',
+                        help="send the script after a stub which reads it in one go, "
+                             "instead of typing it into the REPL (much faster for "
+                             "large scripts)")
+    parser.add_argument('--compression', metavar='FORMAT[:LEVEL]',
+                        help="(re)compress the script before sending it: "
+                             f"{', '.join(MODULES)}, or 'auto' to choose according "
+                             "to the speed of the link and the remote CPU")
+    parser.add_argument('--profile-imports', metavar='FILE', nargs='?', const='-',
+                        help="report the time taken to import each module of the "
+                             "script (as JSON, to FILE)")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="write the time taken by each phase of the boot to FILE, "
+                             "as a Chrome trace ('-' for a table on stderr)")
+    parser.add_argument('--progress', action='store_true',
+                        help="show a progress bar while the script is being sent")
+    parser.add_argument('--cache', action='store_true',
+                        help="keep the script in the remote's ~/.cache/beipack/, "
+                             "and only send it if it isn't there")
+    parser.add_argument('--sync', action='store_true',
+                        help="keep the files of the script (a beipack) in the "
+                             "remote's ~/.cache/beipack/, and only send the ones "
+                             "which changed")
+    parser.add_argument('--agent', metavar='SOCKET',
+                        help="run the script in a persistent agent, reached via "
+                             "SOCKET (started if needed)")
+    parser.add_argument('--agent-timeout', metavar='SECONDS', type=float, default=600,
+                        help="stop the agent after it's been idle for this long "
+                             "(default: 600)")
+    parser.add_argument('--agent-exit', action='store_true',
+                        help="stop the agent at --agent SOCKET")
+    parser.add_argument('--via', metavar='HOST', action='append',
+                        help="relay the script via HOST (with ssh) before running "
+                             "the command there (repeatable)")
+    parser.add_argument('--hosts', metavar='FILE',
+                        help="run the script on each host listed in FILE ('-' for "
+                             "stdin) via ssh, all at once (the command is "
+                             "`ssh [SSH-OPTIONS...]`)")
+    parser.add_argument('--parallel', metavar='N', type=positive_int, default=32,
+                        help="with --hosts, connect to at most N hosts at once "
+                             "(default: 32)")
     parser.add_argument('command', nargs='*')
+    return parser
 
-    args = parser.parse_args()
-    tty = not args.script and os.isatty(0)
+
+def check_options(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    """Rejects the combinations of options which don't work together."""
+    def given(option: str) -> bool:
+        name, _, value = option.partition('=')
+        return getattr(args, name) == value if value else bool(getattr(args, name))
+
+    def flags(options: Sequence[str]) -> str:
+        names = ['--' + option.replace('_', '-') for option in options]
+        if len(names) == 1:
+            return names[0]
+        return f'{", ".join(names[:-1])} or {names[-1]}'
+
+    if args.compression not in (None, 'auto'):
+        try:
+            parse_format(args.compression)
+        except ValueError as exc:
+            parser.error(str(exc))
+    if args.framed and not args.script:
+        parser.error('--framed requires --script')
+
+    for option, conflicts in SCRIPT_OPTIONS.items():
+        if given(option) and not (args.script or args.xz):
+            parser.error(f'{flags([option])} requires --script or --xz')
+        if given(option) and any(given(conflict) for conflict in conflicts):
+            parser.error(f'{flags([option])} can not be used with {flags(conflicts)}')
+
+
+def get_target_command(
+    args: argparse.Namespace,
+) -> Tuple[Sequence[str], List[Sequence[str]]]:
+    """Returns the command to run, and the hops after it for --via."""
+    tty = not args.script and not args.via and os.isatty(0)
 
     if args.command == []:
         command = get_python_command(tty=tty)
@@ -140,17 +1149,105 @@ def main() -> None:
     else:
         command = get_command(*args.command, tty=tty, sh=args.sh)
 
-    if args.script:
-        with open(args.script, 'rb') as file:
-            script = file.read()
+    # With --via, we reach the first relay, and the command is run by the last
+    if args.via:
+        hops = [get_ssh_command(host) for host in args.via[1:]]
+        return get_ssh_command(args.via[0]), [*hops, command]
+    return command, []
+
+
+def run_hosts(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    if args.command[:1] not in ([], ['ssh']):
+        parser.error('--hosts only works with ssh')
+
+    hosts = read_hosts(args.hosts)
+    if not hosts:
+        parser.error(f'no hosts in {args.hosts}')
+    # everybody gets the same copy
+    script, fmt = read_script(args)
+    sys.exit(asyncio.run(boot_hosts(hosts, args.command[1:], script, fmt,
+                                    args.parallel, args.cache)))
+
+
+def run_agent(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    # The agent is reached via an ssh forward, or directly
+    if args.command[:1] == ['ssh']:
+        remote_path = f'/tmp/beiboot-agent-{uuid.uuid4().hex}.sock'
+        agent_command = get_ssh_command('-L', f'{args.agent}:{remote_path}',
+                                        '-o', 'ExitOnForwardFailure=yes',
+                                        *args.command[1:])
+    elif args.command[:1] == ['container']:
+        parser.error('--agent can not be used with containers')
+    else:
+        remote_path = os.path.abspath(args.agent)
+        if args.command:
+            agent_command = get_command(*args.command, sh=args.sh)
+        else:
+            agent_command = get_python_command()
+
+    script, fmt = read_script(args)
+
+    try:
+        sys.exit(run_in_agent(args.agent, script, fmt))
+    except (FileNotFoundError, ConnectionRefusedError):
+        start_agent(agent_command, args.agent, remote_path, args.agent_timeout)
+        sys.exit(run_in_agent(args.agent, script, fmt))
+
+
+def run_script(parser: argparse.ArgumentParser, args: argparse.Namespace,
+               command: Sequence[str], hops: Sequence[Sequence[str]]) -> None:
+    with open(args.script or args.xz, 'rb') as file:
+        script = file.read()
+
+    fmt = 'none' if args.script else detect_format(script)
+    if args.sync:
+        try:
+            contents, code = unpack(decompress(script, fmt).decode())
+        except (SyntaxError, ValueError) as exc:
+            parser.error(f'--sync needs a beipack: {exc}')
+        send_sync_and_splice(command, contents, code, args.compression or 'xz')
+    elif args.compression == 'auto':
+        send_auto_and_splice(command, decompress(script, fmt), args.profile_imports,
+                             args.progress)
+    elif args.compression is not None:
+        script = compress(decompress(script, fmt), args.compression)
+        send_compressed_and_splice(command, script, parse_format(args.compression)[0],
+                                   args.profile_imports, args.progress, args.cache,
+                                   hops, args.trace)
+    elif args.script and not (args.profile_imports or args.progress or args.cache
+                              or hops or args.trace):
+        send_and_splice(command, script, args.framed)
+    else:
+        # profiling, progress, caching, relays and tracing need a gadget, even
+        # for an uncompressed script
+        send_compressed_and_splice(command, script, fmt, args.profile_imports,
+                                   args.progress, args.cache, hops, args.trace)
+
+
+def main() -> None:
+    parser = make_parser()
+    args = parser.parse_args()
+
+    if args.agent_exit:
+        if not args.agent:
+            parser.error('--agent-exit requires --agent')
+        try:
+            stop_agent(args.agent)
+        except OSError as exc:
+            sys.exit(f'beiboot: no agent at {args.agent}: {exc.strerror}')
+        return
+
+    check_options(parser, args)
+    command, hops = get_target_command(args)
 
-        send_and_splice(command, script)
+    if args.hosts:
+        run_hosts(parser, args)
 
-    elif args.xz:
-        with open(args.xz, 'rb') as file:
-            script = file.read()
+    elif args.agent:
+        run_agent(parser, args)
 
-        send_xz_and_splice(command, script)
+    elif args.script or args.xz:
+        run_script(parser, args, command, hops)
 
     else:
         # If we're streaming from stdin then this is a lot easier...
@@ -16,14 +16,36 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import ast
 import binascii
-import lzma
+import bisect
+import concurrent.futures
+import hashlib
+import io
+import marshal
 import os
+import re
+import subprocess
 import sys
 import tempfile
+import time
+import tokenize
 import zipfile
-from typing import Dict, Iterable, List, Optional, Set, Tuple
+from typing import (
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
+from .compression import MODULES, CompressingWriter, compress, decompress, parse_format
 from .data import read_data_file
 
 
@@ -75,16 +97,155 @@ def bytes_repr(data: bytes, imports: Set[str]) -> str:
     return base64_bytes_repr(data, imports)
 
 
-def dict_repr(contents: Dict[str, bytes], imports: Set[str]) -> str:
+Encoder = Callable[[bytes, Set[str]], str]
+
+
+def dict_repr(contents: Dict[str, bytes],
+              imports: Set[str],
+              encoder: Encoder = bytes_repr) -> str:
     return ('{\n' +
-            ''.join(f'  {repr(k)}: {bytes_repr(v, imports)},\n'
+            ''.join(f'  {repr(k)}: {encoder(v, imports)},\n'
                     for k, v in contents.items()) +
             '}')
 
 
+def compress_values(contents: Dict[str, bytes], fmt: str) -> Dict[str, bytes]:
+    return {key: compress(value, fmt) for key, value in contents.items()}
+
+
+def bytecode_repr(bytecode: Dict[bytes, Dict[str, bytes]], imports: Set[str],
+                  encoder: Encoder = bytes_repr) -> str:
+    return ('{\n' +
+            ''.join(f'  {repr(magic)}: {dict_repr(code, imports, encoder)},\n'
+                    for magic, code in bytecode.items()) +
+            '}')
+
+
+# This runs under the target interpreter, which might be quite old.
+COMPILE_SCRIPT = '''
+import importlib.util
+import marshal
+import sys
+result = {}
+for filename, source in marshal.load(sys.stdin.buffer).items():
+    try:
+        code = compile(source, filename, 'exec', dont_inherit=True)
+    except SyntaxError:
+        continue  # the loader will fall back to the source
+    result[filename] = marshal.dumps(code)
+marshal.dump((importlib.util.MAGIC_NUMBER, result), sys.stdout.buffer)
+'''
+
+
+def compile_chunk(interpreter: str,
+                  sources: Dict[str, bytes]) -> Tuple[bytes, Dict[str, bytes]]:
+    process = subprocess.run([interpreter, '-c', COMPILE_SCRIPT],
+                             input=marshal.dumps(sources),
+                             stdout=subprocess.PIPE, check=True)
+    magic, code = marshal.loads(process.stdout)
+    return magic, code
+
+
+def compile_bytecode(contents: Dict[str, bytes],
+                     interpreters: Sequence[str],
+                     jobs: Optional[int] = None) -> Dict[bytes, Dict[str, bytes]]:
+    """Precompiles the modules in `contents` for each of the `interpreters`.
+
+    The result maps the `importlib.util.MAGIC_NUMBER` of each interpreter to a
+    dictionary of marshalled code objects, keyed by filename, suitable for
+    passing as the `bytecode` argument to `pack()`.  Files which fail to
+    compile are skipped.  The sources are split into `jobs` chunks (default:
+    the number of CPUs) per interpreter and compiled in parallel.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    filenames = sorted(filename for filename in contents if filename.endswith('.py'))
+    chunks = [{filename: contents[filename] for filename in filenames[i::jobs]}
+              for i in range(jobs)]
+
+    bytecode: Dict[bytes, Dict[str, bytes]] = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(compile_chunk, interpreter, chunk)
+                   for interpreter in interpreters for chunk in chunks if chunk]
+        for future in futures:
+            magic, code = future.result()
+            bytecode.setdefault(magic, {}).update(code)
+
+    return bytecode
+
+
+# Every import which might be needed by the output of bytes_repr()
+PACK_IMPORTS = ('import sys', 'from binascii import a2b_base64')
+
+# Smaller duplicate files are cheaper to store than to alias
+MIN_ALIAS_SIZE = 64
+
+
+class FileAliases:
+    """Finds the files which `pack_to()` can write as aliases of earlier ones.
+
+    A file which is written again replaces the earlier copy (as it would in a
+    dict), so only the last copy of each file can be the target of an alias.
+    The data of each target is kept, in case it's replaced after all.
+    """
+    def __init__(self) -> None:
+        self.aliases: Dict[str, str] = {}
+        self.targets: Dict[str, bytes] = {}
+        self.digests: Dict[str, bytes] = {}
+        self.originals: Dict[bytes, str] = {}
+
+    def add(self, filename: str, data: bytes) -> List[Tuple[str, bytes]]:
+        """Records a file, and returns the files which need to be written for it.
+
+        That's the file itself, or nothing if it's an alias.  If it replaces a
+        file which has aliases, one of the aliases is also written, as a copy of
+        the old data, and the others become aliases of that copy.
+        """
+        digest = hashlib.sha256(data).digest()
+        previous = self.digests.get(filename)
+        if previous == digest:
+            # the same file again: the first copy will do
+            return []
+        writes = []
+        self.aliases.pop(filename, None)
+        if previous is not None and self.originals.get(previous) == filename:
+            del self.originals[previous]
+            if filename in self.targets:
+                writes.extend(self.retarget(filename, previous))
+
+        self.digests[filename] = digest
+        if len(data) < MIN_ALIAS_SIZE:
+            writes.append((filename, data))
+        elif digest in self.originals:
+            self.aliases[filename] = self.originals[digest]
+            self.targets.setdefault(self.originals[digest], data)
+        else:
+            self.originals[digest] = filename
+            writes.append((filename, data))
+        return writes
+
+    def retarget(self, target: str, digest: bytes) -> List[Tuple[str, bytes]]:
+        # The first alias of `target` (if any are left) gets a copy of its data
+        data = self.targets.pop(target)
+        aliases = [alias for alias, original in self.aliases.items()
+                   if original == target]
+        if not aliases:
+            return []
+        copy, *others = aliases
+        del self.aliases[copy]
+        for alias in others:
+            self.aliases[alias] = copy
+        self.originals[digest] = copy
+        self.targets[copy] = data
+        return [(copy, data)]
+
+
 def pack(contents: Dict[str, bytes],
          entrypoint: Optional[str] = None,
-         args: str = '') -> str:
+         args: str = '',
+         bytecode: Optional[Dict[bytes, Dict[str, bytes]]] = None,
+         compression: Optional[str] = None,
+         encoder: Encoder = bytes_repr,
+         evict: bool = False) -> str:
     """Creates a beipack with the given `contents`.
 
     If `entrypoint` is given, it should be an entry point which is run as the
@@ -92,45 +253,485 @@ def pack(contents: Dict[str, bytes],
     the following code is emitted:
 
         from package.module import func as main
+        BeipackLoader.report_profile()
         main()
 
+    (The middle line sends the import profile, if the bootloader asked for one.)
+
     Additionally, if `args` is given, it is written verbatim between the parens
     of the call to main (ie: it should already be in Python syntax).
+
+    If `bytecode` is given (see `compile_bytecode()`), the precompiled code is
+    used in place of the source on interpreters with a matching magic number.
+
+    If `compression` is given (a format from `bei.compression`, other than
+    'none'), each file is compressed separately, and only decompressed by the
+    loader when it is first used.
+
+    `encoder` is used in place of `bytes_repr()` to encode each file (see
+    `PackCache.bytes_repr()`).  It must give the same result.
+
+    If `evict` is True, the loader drops each file from memory after it's
+    read (ie: after a module is imported), and finds it again in its own
+    source if it's needed again (for example, for a traceback).  That only
+    works when the pack is run by a bootloader which provides the source (as
+    `__self_source__`), on Python 3.8 or later.  Otherwise, nothing is
+    evicted.
     """
+    stream = io.BytesIO()
+    pack_to(stream, contents.items(), entrypoint, args, bytecode, compression, encoder,
+            evict=evict)
+    return stream.getvalue().decode('utf-8')
+
+
+def loader_options(bytecode: Optional[Dict[bytes, Dict[str, bytes]]],
+                   compression: Optional[str],
+                   aliases: Dict[str, str],
+                   evict: bool,
+                   imports: Set[str],
+                   encoder: Encoder) -> str:
+    """Returns the keyword arguments for `BeipackLoader()` after the files."""
+    options = ''
+    if bytecode:
+        if compression is not None:
+            bytecode = {magic: compress_values(code, compression)
+                        for magic, code in bytecode.items()}
+        options += f', bytecode={bytecode_repr(bytecode, imports, encoder)}'
+    if compression is not None:
+        options += f', compression={repr(MODULES[parse_format(compression)[0]])}'
+    if aliases:
+        options += f', aliases={repr(aliases)}'
+    if evict:
+        options += ', evict=True'
+    return options
+
+
+def pack_to(stream: BinaryIO,
+            contents: Iterable[Tuple[str, bytes]],
+            entrypoint: Optional[str] = None,
+            args: str = '',
+            bytecode: Optional[Dict[bytes, Dict[str, bytes]]] = None,
+            compression: Optional[str] = None,
+            encoder: Encoder = bytes_repr,
+            blob: bool = False,
+            evict: bool = False) -> Dict[str, str]:
+    """Writes a beipack with the given `contents` to `stream`.
+
+    This is the streaming version of `pack()`: `contents` is an iterable of
+    (filename, data) pairs (for example, from the `iter_*()` collectors) and
+    each file is encoded and written to `stream` before the next one is
+    requested.  Wrap `stream` in a `CompressingWriter` to compress the output
+    without keeping it in memory.  The other arguments are as for `pack()`.
+
+    Files with the same content as an earlier file are written as an alias to
+    that file.  The aliases are returned (as a dictionary mapping the alias to
+    the original file).  If a filename is repeated, the last copy wins (see
+    `FileAliases`).
+
+    If `blob` is True, the files are written as raw bytes, one after another,
+    directly after the line of code which reads them from stdin, along with an
+    index of where each file is.  The loader slices the files out on demand.
+    The interpreter doesn't need to parse the data at all, so this is a lot
+    faster to load, but the result is only usable when it is fed to the stdin
+    of an interactive interpreter (ie: `python3 -i`), and is not text.  The
+    files are kept in memory until the end.  It can't be combined with `evict`.
+    """
+    if blob and evict:
+        raise ValueError('files in a blob pack can not be evicted')
+
+    def write(text: str) -> None:
+        stream.write(text.encode('utf-8'))
 
     loader = read_data_file('beipack_loader.py')
-    lines = [line for line in loader.splitlines() if line]
-    lines.append('')
+    write(''.join(f'{line}\n' for line in loader.splitlines() if line))
+    write('\n')
+
+    # We need to write the imports before we know which ones are needed
+    imports = set(PACK_IMPORTS)
+    write(''.join(f'{line}\n' for line in PACK_IMPORTS))
+
+    write('sys.meta_path.insert(0, BeipackLoader({' + ('' if blob else '\n'))
+    files = FileAliases()
+    index: Dict[str, Tuple[int, int]] = {}
+    payload: List[bytes] = []
+    size = 0
+    for filename, data in (entry for item in contents for entry in files.add(*item)):
+        if compression is not None:
+            data = compress(data, compression)
 
-    imports = {'import sys'}
-    contents_txt = dict_repr(contents, imports)
-    lines.extend(imports)
-    lines.append(f'sys.meta_path.insert(0, BeipackLoader({contents_txt}))')
+        if blob:
+            index[filename] = (size, size + len(data))
+            payload.append(data)
+            size += len(data)
+        else:
+            write(f'  {repr(filename)}: {encoder(data, imports)},\n')
+    write('}')
+
+    if blob:
+        write(f', index={repr(index)}, blob=BeipackLoader.read_blob({size})')
+    write(loader_options(bytecode, compression, files.aliases, evict, imports,
+                         encoder))
+    write('))\n')
+    assert imports == set(PACK_IMPORTS)
+
+    for data in payload:
+        stream.write(data)
 
     if entrypoint:
         package, main = entrypoint.split(':')
-        lines.append(f'from {package} import {main} as main')
-        lines.append(f'main({args})')
+        write(f'from {package} import {main} as main\n')
+        write('BeipackLoader.report_profile()\n')
+        write(f'main({args})\n')
 
-    return ''.join(f'{line}\n' for line in lines)
+    return files.aliases
 
 
-def collect_contents(filenames: List[str],
-                     relative_to: Optional[str] = None) -> Dict[str, bytes]:
-    contents: Dict[str, bytes] = {}
+def pack_skeleton(code: str = '') -> str:
+    """Creates a beipack without any files, followed by `code`.
+
+    The files are taken from the `__beipack_contents__` global when the
+    skeleton is run (see the boot_sync gadget).  `code` is usually the code
+    which `unpack()` found after the files in an existing pack.
+    """
+    loader = read_data_file('beipack_loader.py')
+    return ''.join(f'{line}\n' for line in [
+        *(line for line in loader.splitlines() if line), '',
+        *PACK_IMPORTS, 'sys.meta_path.insert(0, BeipackLoader(__beipack_contents__))'
+    ]) + code
+
+
+def unpack(source: str) -> Tuple[Dict[str, bytes], str]:
+    """Finds the files in a beipack written by `pack_to()`.
+
+    Returns the files (decompressed, and with aliases expanded) and the code
+    which follows them (ie: the call to the entrypoint).  Precompiled bytecode
+    is dropped.  Packs written with `blob=True` or `evict=True` can't be
+    unpacked: the loader which `pack_skeleton()` creates can't do either.
+    """
+    module = ast.parse(source)
+    calls = ((i, node)
+             for i, statement in enumerate(module.body)
+             for node in ast.walk(statement)
+             if isinstance(node, ast.Call)
+             and getattr(node.func, 'id', None) == 'BeipackLoader')
+    found = next(calls, None)
+    if found is None:
+        raise ValueError('not a beipack')
+
+    i, call = found
+    keywords = {keyword.arg: keyword.value for keyword in call.keywords}
+    unsupported = set(keywords) - {'bytecode', 'compression', 'aliases'}
+    if unsupported:
+        names = ', '.join(sorted(str(arg) for arg in unsupported))
+        raise ValueError(f'packs with {names} can not be unpacked')
+
+    expression = compile(ast.Expression(call.args[0]), '<beipack>', 'eval')
+    contents = eval(expression, {'a2b_base64': binascii.a2b_base64})
+    if 'compression' in keywords:
+        formats = {module: name for name, module in MODULES.items()}
+        fmt = formats[ast.literal_eval(keywords['compression'])]
+        contents = {filename: decompress(data, fmt)
+                    for filename, data in contents.items()}
+    if 'aliases' in keywords:
+        for alias, target in ast.literal_eval(keywords['aliases']).items():
+            contents[alias] = contents[target]
+
+    lines = source.splitlines(keepends=True)
+    if i + 1 < len(module.body):
+        code = ''.join(lines[module.body[i + 1].lineno - 1:])
+    else:
+        code = ''
+    return contents, code
+
+
+def sort_contents(contents: Dict[str, bytes]) -> Dict[str, bytes]:
+    """Reorders `contents` to help the compressor.
+
+    Files are grouped by extension and, within each group, by directory.  For
+    Python packages, keeping neighbouring modules together turns out to work
+    better than grouping by filename or by content fingerprints.
+    """
+    def key(filename: str) -> Tuple[str, str]:
+        return os.path.splitext(filename)[1], filename
+
+    return {filename: contents[filename] for filename in sorted(contents, key=key)}
+
+
+def module_name(filename: str) -> str:
+    assert filename.endswith('.py')
+    name = filename[:-3]
+    if name.endswith('/__init__'):
+        name = name[:-9]
+    return name.replace('/', '.')
+
+
+def string_constant(node: ast.AST) -> Optional[str]:
+    if sys.version_info < (3, 8) and isinstance(node, ast.Str):
+        return node.s
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    return None
+
+
+def find_imports(source: bytes, name: str, is_package: bool) -> Iterable[str]:
+    """Yields the names of the modules which might be imported by a module.
+
+    This is a static analysis of the `import` and `from ... import` statements
+    in the `source` of module `name`, plus calls to `import_module()` or
+    `__import__()` with a constant string argument.  Names imported with `from`
+    are yielded as potential submodules: it's up to the caller to ignore the
+    names which are not modules.
+    """
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return
+
+    package = name if is_package else name.rpartition('.')[0]
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                yield alias.name
+
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                parts = package.split('.')
+                base = '.'.join(parts[:len(parts) - node.level + 1])
+                module = f'{base}.{node.module}' if node.module else base
+            else:
+                module = node.module or ''
+            yield module
+            for alias in node.names:
+                yield f'{module}.{alias.name}'
+
+        elif isinstance(node, ast.Call) and node.args:
+            func = node.func
+            func_name = (func.attr if isinstance(func, ast.Attribute)
+                         else getattr(func, 'id', None))
+            target = string_constant(node.args[0])
+            if func_name in ('import_module', '__import__') and target is not None:
+                yield target
+
+
+def prune_contents(contents: Dict[str, bytes],
+                   roots: Iterable[str]) -> Dict[str, bytes]:
+    """Removes files which are unreachable from the `roots` modules.
+
+    A module is reachable if it is a root, or a submodule of one, or if it
+    is imported by a reachable module (see `find_imports()`), or if it is
+    the parent package of a reachable module.  Any other file (ie: a
+    resource) is kept if the package containing it is reachable, or if it
+    isn't inside of a package at all.
+    """
+    modules = {module_name(filename): filename
+               for filename in contents if filename.endswith('.py')}
+
+    todo = [name for name in modules for root in roots
+            if name == root or name.startswith(f'{root}.')]
+    reachable: Set[str] = set()
+    while todo:
+        name = todo.pop()
+        if name in reachable or name not in modules:
+            continue
+        reachable.add(name)
+
+        filename = modules[name]
+        is_package = filename.endswith('/__init__.py')
+        for imported in find_imports(contents[filename], name, is_package):
+            # importing a module also imports all of its parents
+            parts = imported.split('.')
+            todo.extend('.'.join(parts[:i]) for i in range(1, len(parts) + 1))
+        todo.extend('.'.join(name.split('.')[:i])
+                    for i in range(1, name.count('.') + 1))
+
+    def is_reachable(filename: str) -> bool:
+        if filename.endswith('.py'):
+            return module_name(filename) in reachable
+
+        directory = os.path.dirname(filename)
+        while directory:
+            if f'{directory}/__init__.py' in contents:
+                return module_name(f'{directory}/__init__.py') in reachable
+            directory = os.path.dirname(directory)
+        return True
+
+    return {filename: data for filename, data in contents.items()
+            if is_reachable(filename)}
+
+
+# Python keeps the coding cookie in a comment, so we need to keep it, too
+CODING_COOKIE = re.compile(r'^[ \t\f]*#.*?coding[:=][ \t]*([-\w.]+)')
+SEMICOLON = re.compile(r'[ \t]*;')
+
+# The nodes which can have a docstring, or annotations
+DocumentedNode = Union[ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef]
+FunctionNode = Union[ast.FunctionDef, ast.AsyncFunctionDef]
+
 
+class SourceEditor:
+    """Removes parts of a Python source file, by their positions in the text.
+
+    Positions come either from ast (in UTF-8 bytes) or from tokenize (in
+    characters): both are converted to offsets into `text`.
+    """
+    def __init__(self, text: str, tokens: List[tokenize.TokenInfo]) -> None:
+        self.text = text
+        self.tokens = tokens
+        # only \n ends a line for tokenize (unlike for str.splitlines())
+        self.lines = io.StringIO(text).readlines()
+        self.line_offsets = [0]
+        for line in self.lines:
+            self.line_offsets.append(self.line_offsets[-1] + len(line))
+        # (start, end, replacement)
+        self.edits: List[Tuple[int, int, str]] = []
+        self.arrows, self.colons = self.find_ops('->'), self.find_ops(':')
+        self.opens, self.closes = self.find_ops('('), self.find_ops(')')
+
+    def offset(self, lineno: int, col: int) -> int:
+        # tokenize counts columns in characters, but ast counts bytes
+        prefix = self.lines[lineno - 1].encode()[:col].decode()
+        return self.line_offsets[lineno - 1] + len(prefix)
+
+    def token_offset(self, position: Tuple[int, int]) -> int:
+        return self.line_offsets[position[0] - 1] + position[1]
+
+    def find_ops(self, string: str) -> List[int]:
+        return [self.token_offset(token.start) for token in self.tokens
+                if token.type == tokenize.OP and token.string == string]
+
+    def remove_comments(self) -> None:
+        for token in self.tokens:
+            if token.type == tokenize.COMMENT and not (
+                    token.start[0] <= 2 and CODING_COOKIE.match(token.line)):
+                start = self.token_offset(token.start)
+                self.edits.append((start, self.token_offset(token.end), ''))
+
+    def remove_docstring(self, node: DocumentedNode) -> None:
+        first = node.body[0] if node.body else None
+        if isinstance(first, ast.Expr) and string_constant(first.value) is not None:
+            end_lineno, end_col = first.end_lineno, first.end_col_offset
+            end = self.offset(end_lineno, end_col)  # type: ignore[arg-type]
+            if not SEMICOLON.match(self.text, end):  # too complicated
+                start = self.offset(first.lineno, first.col_offset)
+                self.edits.append((start, end, 'pass' if len(node.body) == 1 else ''))
+
+    def remove_annotations(self, node: FunctionNode) -> None:
+        arguments = node.args
+        for arg in [*getattr(arguments, 'posonlyargs', []), *arguments.args,
+                    arguments.vararg, *arguments.kwonlyargs, arguments.kwarg]:
+            if arg is not None and arg.annotation is not None:
+                annotation = arg.annotation
+                start = self.offset(arg.lineno, arg.col_offset + len(arg.arg.encode()))
+                end_lineno, end_col = annotation.end_lineno, annotation.end_col_offset
+                end = self.offset(end_lineno, end_col)  # type: ignore[arg-type]
+                # the annotation doesn't include its brackets
+                first = self.offset(annotation.lineno, annotation.col_offset)
+                brackets = bisect.bisect_left(self.opens, first)
+                brackets -= bisect.bisect_left(self.opens, start)
+                if brackets:
+                    close = bisect.bisect_left(self.closes, end) + brackets - 1
+                    end = self.closes[close] + 1
+                self.edits.append((start, end, ''))
+
+        returns = node.returns
+        if returns is not None:
+            start = self.offset(returns.lineno, returns.col_offset)
+            end_lineno, end_col = returns.end_lineno, returns.end_col_offset
+            end = self.offset(end_lineno, end_col)  # type: ignore[arg-type]
+            arrow = self.arrows[bisect.bisect_left(self.arrows, start) - 1]
+            colon = self.colons[bisect.bisect_left(self.colons, end)]
+            # we'd leave a newline outside of the brackets
+            if '\n' not in self.text[arrow:colon]:
+                self.edits.append((arrow, colon, ''))
+
+    def apply(self) -> str:
+        """Returns the text with the edits applied.
+
+        Edits inside of another edit (ie: comments inside of annotations) are
+        skipped.  We keep the newlines, and remove any whitespace which would
+        be left at the end of a line.
+        """
+        chunks: List[str] = []
+        position = 0
+        edits = sorted(self.edits, key=lambda edit: (edit[0], -edit[1]))
+        for start, end, replacement in edits:
+            if start >= position:
+                if not replacement:
+                    while start > position and self.text[start - 1] in ' \t':
+                        start -= 1
+                newlines = '\n' * self.text.count('\n', start, end)
+                chunks.extend((self.text[position:start], replacement, newlines))
+                position = end
+        chunks.append(self.text[position:])
+        return ''.join(chunks)
+
+
+def minify_source(source: bytes,
+                  docstrings: bool = True,
+                  annotations: bool = False) -> bytes:
+    """Removes things from Python source code which don't affect how it runs.
+
+    Comments are always removed, and docstrings are removed if `docstrings` is
+    True.  If `annotations` is True, the annotations on function arguments and
+    return values are removed as well: that breaks code which inspects them.
+    Line numbers are kept, so tracebacks still point at the right lines.
+
+    Sources which can't be parsed are returned unchanged.
+    """
+    try:
+        tree = ast.parse(source)
+        encoding, _ = tokenize.detect_encoding(io.BytesIO(source).readline)
+        text = source.decode(encoding)
+        tokens = list(tokenize.generate_tokens(io.StringIO(text).readline))
+    except (SyntaxError, UnicodeDecodeError, tokenize.TokenError):
+        return source
+
+    editor = SourceEditor(text, tokens)
+    editor.remove_comments()
+    for node in ast.walk(tree):
+        if docstrings and isinstance(node, (ast.Module, ast.ClassDef,
+                                            ast.FunctionDef, ast.AsyncFunctionDef)):
+            editor.remove_docstring(node)
+        if annotations and isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            editor.remove_annotations(node)
+
+    return editor.apply().encode(encoding)
+
+
+def minify_contents(contents: Iterable[Tuple[str, bytes]],
+                    annotations: bool = False,
+                    keep_docstrings: Sequence[str] = ()
+                    ) -> Iterator[Tuple[str, bytes]]:
+    """Applies `minify_source()` to each Python source file in `contents`.
+
+    Docstrings are kept in the modules named in `keep_docstrings`, for modules
+    which read their own `__doc__`.
+    """
+    for filename, data in contents:
+        if filename.endswith('.py'):
+            docstrings = module_name(filename) not in keep_docstrings
+            data = minify_source(data, docstrings, annotations)
+        yield filename, data
+
+
+def iter_contents(filenames: Iterable[str],
+                  relative_to: Optional[str] = None) -> Iterator[Tuple[str, bytes]]:
     for filename in filenames:
         with open(filename, 'rb') as file:
-            contents[os.path.relpath(filename, start=relative_to)] = file.read()
+            yield os.path.relpath(filename, start=relative_to), file.read()
+
 
-    return contents
+def collect_contents(filenames: List[str],
+                     relative_to: Optional[str] = None) -> Dict[str, bytes]:
+    return dict(iter_contents(filenames, relative_to))
 
 
-def collect_module(name: str, *, recursive: bool) -> Dict[str, bytes]:
+def iter_module(name: str, *, recursive: bool) -> Iterator[Tuple[str, bytes]]:
     import importlib.resources
     from importlib.resources.abc import Traversable
 
-    def walk(path: str, entry: Traversable) -> Iterable[Tuple[str, bytes]]:
+    def walk(path: str, entry: Traversable) -> Iterator[Tuple[str, bytes]]:
         for item in entry.iterdir():
             itemname = f'{path}/{item.name}'
             if item.is_file():
@@ -138,35 +739,193 @@ def collect_module(name: str, *, recursive: bool) -> Dict[str, bytes]:
             elif recursive and item.name != '__pycache__':
                 yield from walk(itemname, item)
 
-    return dict(walk(name.replace('.', '/'), importlib.resources.files(name)))
+    return walk(name.replace('.', '/'), importlib.resources.files(name))
 
 
-def collect_zip(filename: str) -> Dict[str, bytes]:
-    contents = {}
+def collect_module(name: str, *, recursive: bool) -> Dict[str, bytes]:
+    return dict(iter_module(name, recursive=recursive))
+
 
+def iter_zip(filename: str) -> Iterator[Tuple[str, bytes]]:
     with zipfile.ZipFile(filename) as file:
         for entry in file.filelist:
             if '.dist-info/' in entry.filename:
                 continue
-            contents[entry.filename] = file.read(entry)
+            yield entry.filename, file.read(entry)
+
+
+def collect_zip(filename: str) -> Dict[str, bytes]:
+    return dict(iter_zip(filename))
+
 
-    return contents
+def build_wheel(path: str, outdir: str) -> str:
+    import build
+    builder = build.ProjectBuilder(path)
+    return builder.build('wheel', outdir)
 
 
-def collect_pep517(path: str) -> Dict[str, bytes]:
+def iter_pep517(path: str,
+                cache: Optional['PackCache'] = None) -> Iterator[Tuple[str, bytes]]:
+    if cache is not None:
+        yield from iter_zip(cache.build_wheel(path))
+        return
+
     with tempfile.TemporaryDirectory() as tmpdir:
-        import build
-        builder = build.ProjectBuilder(path)
-        wheel = builder.build('wheel', tmpdir)
-        return collect_zip(wheel)
+        yield from iter_zip(build_wheel(path, tmpdir))
+
+
+def collect_pep517(path: str, cache: Optional['PackCache'] = None) -> Dict[str, bytes]:
+    return dict(iter_pep517(path, cache))
+
+
+def scan_tree(path: str) -> Iterable[Tuple[str, int, int]]:
+    """Yields (filename, mtime, size) for all source files at or below `path`.
+
+    Version control, build output and cache directories are skipped.
+    """
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        yield path, stat.st_mtime_ns, stat.st_size
+        return
+
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted(name for name in dirnames
+                             if not name.startswith('.')
+                             and not name.endswith('.egg-info')
+                             and name not in ('__pycache__', 'build', 'dist'))
+        for name in sorted(filenames):
+            filename = os.path.join(dirpath, name)
+            stat = os.stat(filename)
+            yield filename, stat.st_mtime_ns, stat.st_size
+
+
+class PackCache:
+    """A cache for the slow steps of building a beipack.
+
+    Built wheels (keyed by the names, modification times and sizes of the
+    files in the source tree) and compressed output (keyed by the hash of its
+    input) are stored on disk.  Encoded file contents are cached in memory,
+    keyed by the hash of their content, which helps when rebuilding with
+    `--watch`.  The output is identical to a build without the cache.
+    """
+    reprs: Dict[bytes, Tuple[str, Tuple[str, ...]]]
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        if path is None:
+            cache_home = (os.environ.get('XDG_CACHE_HOME')
+                          or os.path.expanduser('~/.cache'))
+            path = os.path.join(cache_home, 'beipack', 'build')
+        self.path = path
+        self.reprs = {}
+
+    def _filename(self, kind: str, key: str) -> str:
+        return os.path.join(self.path, kind, key)
+
+    def _store(self, kind: str, key: str, data: bytes, keep: int = 16) -> None:
+        directory = os.path.join(self.path, kind)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as file:
+            file.write(data)
+        os.replace(file.name, self._filename(kind, key))
+
+        # Keep only the most recently used entries
+        entries = sorted(os.scandir(directory),
+                         key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in entries[keep:]:
+            os.unlink(entry.path)
+
+    def _lookup(self, kind: str, key: str) -> Optional[str]:
+        filename = self._filename(kind, key)
+        try:
+            os.utime(filename)
+        except FileNotFoundError:
+            return None
+        return filename
+
+    def build_wheel(self, path: str) -> str:
+        tree_hash = hashlib.sha256()
+        for filename, mtime, size in scan_tree(path):
+            name = os.path.relpath(filename, path)
+            tree_hash.update(f'{name}\0{mtime}\0{size}\0'.encode())
+        key = tree_hash.hexdigest() + '.whl'
+
+        wheel = self._lookup('wheel', key)
+        if wheel is None:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                with open(build_wheel(path, tmpdir), 'rb') as file:
+                    self._store('wheel', key, file.read())
+            wheel = self._filename('wheel', key)
+
+        return wheel
+
+    def compress(self, data: bytes, fmt: str, jobs: int = 1) -> bytes:
+        # xz output depends on the number of blocks, and thus on `jobs`
+        key = f'{hashlib.sha256(data).hexdigest()}-{fmt}-{jobs}'
+
+        filename = self._lookup('compressed', key)
+        if filename is not None:
+            with open(filename, 'rb') as file:
+                return file.read()
+
+        result = compress(data, fmt, jobs)
+        self._store('compressed', key, result)
+        return result
+
+    def bytes_repr(self, data: bytes, imports: Set[str]) -> str:
+        key = hashlib.sha256(data).digest()
+        try:
+            text, needed = self.reprs[key]
+        except KeyError:
+            needed_set: Set[str] = set()
+            text = bytes_repr(data, needed_set)
+            needed = tuple(needed_set)
+            self.reprs[key] = text, needed
+        imports.update(needed)
+        return text
+
+
+def compression_format(fmt: str) -> str:
+    try:
+        parse_format(fmt)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc)) from exc
+    return fmt
+
+
+def positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(f'invalid int value: {value!r}') from exc
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1: {value!r}')
+    return number
 
 
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument('--python', '-p',
                         help="add a #!python3 interpreter line using the given path")
-    parser.add_argument('--xz', '-J', action='store_true',
-                        help="compress the output with `xz`")
+    parser.add_argument('--xz', '-J', dest='compress', action='store_const',
+                        const='xz', default='none',
+                        help="compress the output with `xz` (same as --compress=xz)")
+    parser.add_argument('--compress', metavar='FORMAT[:LEVEL]',
+                        type=compression_format, default='none',
+                        help=f"compress the output: {', '.join(MODULES)} "
+                             "(default: none)")
+    parser.add_argument('--jobs', '-j', metavar='N', type=positive_int, default=1,
+                        help="compress `xz` output in up to N parallel streams "
+                             "(default: 1)")
+    parser.add_argument('--blob', action='store_true',
+                        help="store the files as raw bytes after the code "
+                             "(faster, but only works with python3 -i)")
+    parser.add_argument('--evict', action='store_true',
+                        help="drop files from memory after use, and reload them "
+                             "from __self_source__ if needed")
+    parser.add_argument('--compress-files', metavar='FORMAT[:LEVEL]',
+                        type=compression_format,
+                        help="compress each file separately "
+                             "(decompressed on first use)")
     parser.add_argument('--topdir',
                         help="toplevel directory (paths are stored relative to this)")
     parser.add_argument('--output', '-o',
@@ -175,42 +934,196 @@ def main() -> None:
                         help="use FUNC from MODULE as the main function")
     parser.add_argument('--main-args', metavar='ARGS',
                         help="arguments to main() in Python syntax", default='')
+    parser.add_argument('--prune', action='store_true',
+                        help="remove modules which can't be imported from the "
+                             "--main module")
+    parser.add_argument('--keep', metavar='MODULE', action='append', default=[],
+                        help="don't prune MODULE (and its submodules) if it's only "
+                             "imported dynamically")
+    parser.add_argument('--minify', action='store_true',
+                        help="remove comments and docstrings from Python sources "
+                             "(keeping line numbers)")
+    parser.add_argument('--minify-annotations', action='store_true',
+                        help="also remove function annotations (implies --minify)")
+    parser.add_argument('--keep-docstrings', metavar='MODULE', action='append',
+                        default=[],
+                        help="don't remove the docstrings from MODULE, if it uses "
+                             "its own __doc__")
+    parser.add_argument('--sort', action='store_true',
+                        help="group similar files together, to improve compression")
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help="write statistics about the output to stderr")
+    parser.add_argument('--bytecode', metavar='PYTHON', action='append', default=[],
+                        help="include bytecode precompiled by the given interpreter "
+                             "(repeatable)")
     parser.add_argument('--module', action='append', default=[],
                         help="collect installed modules (recursively)")
     parser.add_argument('--zip', '-z', action='append', default=[],
                         help="include files from a zipfile (or wheel)")
     parser.add_argument('--build', metavar='DIR', action='append', default=[],
                         help="PEP-517 from a given source directory")
+    parser.add_argument('--cache', action='store_true',
+                        help="cache built wheels and compressed output in "
+                             "~/.cache/beipack")
+    parser.add_argument('--watch', action='store_true',
+                        help="rebuild the output whenever the inputs change "
+                             "(implies --cache)")
     parser.add_argument('files', nargs='*',
                         help="files to include in the beipack")
     args = parser.parse_args()
 
-    contents = collect_contents(args.files, relative_to=args.topdir)
+    if args.prune and not args.main:
+        parser.error('--prune requires --main')
+    if args.evict and args.blob:
+        parser.error('--evict can not be used with --blob')
+    if args.blob and args.compress != 'none':
+        parser.error('--blob can not be used with --compress or --xz')
+    if args.watch and not args.output:
+        parser.error('--watch requires --output')
+    if (args.minify or args.minify_annotations) and sys.version_info < (3, 8):
+        parser.error('--minify requires Python 3.8')
+
+    cache = PackCache() if args.cache or args.watch else None
+
+    if args.watch:
+        watch(args, cache)
+    elif args.output:
+        with open(args.output, 'wb') as file:
+            build(args, file, cache)
+    else:
+        if args.compress != 'none' and os.isatty(1):
+            sys.exit('refusing to write compressed output to a terminal')
+        build(args, sys.stdout.buffer, cache)
+
+
+def collect(args: argparse.Namespace,
+            cache: Optional[PackCache] = None) -> Iterator[Tuple[str, bytes]]:
+    yield from iter_contents(args.files, relative_to=args.topdir)
 
     for file in args.zip:
-        contents.update(collect_zip(file))
+        yield from iter_zip(file)
 
     for name in args.module:
-        contents.update(collect_module(name, recursive=True))
+        yield from iter_module(name, recursive=True)
 
     for path in args.build:
-        contents.update(collect_pep517(path))
+        yield from iter_pep517(path, cache)
 
-    result = pack(contents, args.main, args.main_args).encode('utf-8')
 
-    if args.python:
-        result = b'#!' + args.python.encode('ascii') + b'\n' + result
+def process_files(
+    args: argparse.Namespace, files: Dict[str, bytes],
+) -> Tuple[Dict[str, bytes], Optional[Dict[bytes, Dict[str, bytes]]]]:
+    """Applies the options which need to see all of the files at once.
 
-    if args.xz:
-        result = lzma.compress(result, preset=lzma.PRESET_EXTREME)
+    Returns the files, and their bytecode if --bytecode was given.
+    """
+    bytecode = None
 
-    if args.output:
-        with open(args.output, 'wb') as file:
-            file.write(result)
+    if args.prune:
+        pruned = prune_contents(files, [args.main.split(':')[0], *args.keep])
+        total_size = sum(len(data) for data in files.values())
+        pruned_size = sum(len(data) for data in pruned.values())
+        sys.stderr.write(f'beipack: pruned {len(files) - len(pruned)} '
+                         f'of {len(files)} files, saving '
+                         f'{total_size - pruned_size} of {total_size} bytes\n')
+        files = pruned
+
+    if args.bytecode:
+        bytecode = compile_bytecode(files, args.bytecode)
+
+    if args.sort:
+        def packed_size() -> int:
+            result = pack(files, bytecode=bytecode, compression=args.compress_files)
+            return len(compress(result.encode(), args.compress, args.jobs))
+
+        if args.verbose:
+            unsorted_size = packed_size()
+        files = sort_contents(files)
+        if args.verbose:
+            sorted_size = packed_size()
+            sys.stderr.write(f'beipack: sorting changed the {args.compress} size '
+                             f'of the pack from {unsorted_size} to {sorted_size} '
+                             'bytes\n')
+
+    return files, bytecode
+
+
+def build(args: argparse.Namespace,
+          output: BinaryIO,
+          cache: Optional[PackCache] = None) -> None:
+    contents: Iterable[Tuple[str, bytes]] = collect(args, cache)
+    bytecode = None
+
+    if args.minify or args.minify_annotations:
+        contents = minify_contents(contents, args.minify_annotations,
+                                   args.keep_docstrings)
+
+    if args.prune or args.bytecode or args.sort:
+        files, bytecode = process_files(args, dict(contents))
+        contents = files.items()
+
+    def write_pack(stream: BinaryIO) -> None:
+        if args.python:
+            stream.write(b'#!' + args.python.encode('ascii') + b'\n')
+        aliases = pack_to(stream, contents, args.main, args.main_args,
+                          bytecode=bytecode, compression=args.compress_files,
+                          encoder=cache.bytes_repr if cache else bytes_repr,
+                          blob=args.blob, evict=args.evict)
+        if args.verbose:
+            sys.stderr.write(f'beipack: stored {len(aliases)} duplicate files '
+                             'as aliases\n')
+
+    if cache is not None or args.jobs > 1:
+        # Caching or compressing in parallel requires the entire pack
+        buffer = io.BytesIO()
+        write_pack(buffer)
+        result = buffer.getvalue()
+        if cache is not None:
+            output.write(cache.compress(result, args.compress, args.jobs))
+        else:
+            output.write(compress(result, args.compress, args.jobs))
     else:
-        if args.xz and os.isatty(1):
-            sys.exit('refusing to write compressed output to a terminal')
-        sys.stdout.buffer.write(result)
+        with CompressingWriter(output, args.compress) as writer:
+            write_pack(writer)  # type: ignore[arg-type]
+
+
+def watch(args: argparse.Namespace, cache: Optional[PackCache]) -> None:
+    import importlib.util
+
+    paths = [*args.files, *args.zip, *args.build]
+    for name in args.module:
+        spec = importlib.util.find_spec(name)
+        assert spec is not None and spec.origin is not None
+        paths.extend(spec.submodule_search_locations or [spec.origin])
+
+    def snapshot() -> List[Tuple[str, int, int]]:
+        entries: List[Tuple[str, int, int]] = []
+        for path in paths:
+            try:
+                entries.extend(scan_tree(path))
+            except OSError:
+                # deleted, or being replaced by an editor: that's a change too
+                entries.append((path, -1, -1))
+        return entries
+
+    result = None
+    while True:
+        state = snapshot()
+        buffer = io.BytesIO()
+        try:
+            build(args, buffer, cache)
+        except Exception as exc:  # keep watching: the next change might fix it
+            sys.stderr.write(f'beipack: build failed: {exc}\n')
+        else:
+            if buffer.getvalue() != result:
+                result = buffer.getvalue()
+                with open(args.output, 'wb') as file:
+                    file.write(result)
+                size = len(result)
+                sys.stderr.write(f'beipack: wrote {args.output} ({size} bytes)\n')
+
+        while snapshot() == state:
+            time.sleep(0.5)
 
 
 if __name__ == '__main__':
@@ -42,8 +42,24 @@ GADGETS = {
         import sys
         def boot_xz(filename, size, args=[], send_end=False):
             command('beiboot.provide', size)
-            src_xz = sys.stdin.buffer.read(size)
-            src = lzma.decompress(src_xz)
+            # decompress while we receive
+            chunks = []
+            src = []
+            decompressor = lzma.LZMADecompressor()
+            while size:
+                chunk = sys.stdin.buffer.read1(min(size, 1 << 16))
+                if not chunk:
+                    raise EOFError('script truncated')
+                size -= len(chunk)
+                chunks.append(chunk)
+                while chunk:
+                    src.append(decompressor.decompress(chunk))
+                    chunk = b''
+                    if decompressor.eof:
+                        chunk = decompressor.unused_data
+                        decompressor = lzma.LZMADecompressor()
+            src_xz = b''.join(chunks)
+            src = b''.join(src)
             sys.argv = [filename, *args]
             if send_end:
                 end()
@@ -53,9 +69,533 @@ GADGETS = {
                 '__file__': filename})
             sys.exit()
     """,
+    "boot_compressed": r"""
+        import contextlib
+        import importlib
+        import os
+        import sys
+        import time
+        def boot_compressed(filename, fmt, size, args=[], send_end=False, samples=None,
+                            profile=False, progress=None, trace=False):
+            # with `trace`, we report the (wall clock) times of each phase, and a
+            # round trip to compare clocks
+            events = []
+            started = time.time()
+            if trace:
+                with contextlib.suppress(Exception):
+                    with open('/proc/self/stat') as file:
+                        ticks = int(file.read().rpartition(')')[2].split()[19])
+                    boottime = time.clock_gettime(time.CLOCK_BOOTTIME)
+                    age = boottime - ticks / os.sysconf('SC_CLK_TCK')
+                    events.append(
+                        ('interpreter and bootloader', started - age, started, {}))
+            if samples is not None or trace:
+                ping = time.time()
+                command('beiboot.ping')
+                sys.stdin.buffer.readline()
+                events.append(('clock sync', ping, time.time(), {}))
+            requested = time.time()
+            if samples is not None:
+                command('beiboot.probe')
+                timings = []
+                for sample_fmt, sample_size in samples:
+                    sample = sys.stdin.buffer.read(sample_size)
+                    start = time.monotonic()
+                    sample_module = {'xz': 'lzma'}.get(sample_fmt, sample_fmt)
+                    importlib.import_module(sample_module).decompress(sample)
+                    timings.append(time.monotonic() - start)
+                requested = time.time()
+                command('beiboot.provide', timings)
+                fmt, size = sys.stdin.buffer.readline().decode('ascii').split()
+                size = int(size)
+            else:
+                command('beiboot.provide', size)
+            # decompress while we receive, and report our progress every
+            # `progress` seconds
+            new_decompressor = None
+            if fmt != 'none':
+                factories = {
+                    'xz': 'LZMADecompressor',
+                    'bz2': 'BZ2Decompressor',
+                    'zlib': 'decompressobj'}
+                module = importlib.import_module({'xz': 'lzma'}.get(fmt, fmt))
+                new_decompressor = getattr(module, factories[fmt])
+                decompressor = new_decompressor()
+            chunks = []
+            src = []
+            received = 0
+            decompressing = 0.0
+            first = None
+            start = reported_at = time.monotonic()
+            while received < size:
+                chunk = sys.stdin.buffer.read1(min(size - received, 1 << 16))
+                if not chunk:
+                    raise EOFError('script truncated')
+                if first is None:
+                    first = time.time()
+                received += len(chunk)
+                chunks.append(chunk)
+                # concatenated streams (ie: from `beipack --jobs`) need a new
+                # decompressor
+                before = time.monotonic()
+                while new_decompressor is not None and chunk:
+                    src.append(decompressor.decompress(chunk))
+                    chunk = b''
+                    if decompressor.eof:
+                        chunk = decompressor.unused_data
+                        decompressor = new_decompressor()
+                now = time.monotonic()
+                decompressing += now - before
+                if progress is not None and (
+                        now - reported_at >= progress or received == size):
+                    command('beiboot.progress', received, size, now - start)
+                    reported_at = now
+            src_compressed = b''.join(chunks)
+            src = src_compressed if new_decompressor is None else b''.join(src)
+            events.append(('wait for script', requested, first or requested, {}))
+            events.append((
+                'receive and decompress', first or requested, time.time(),
+                {'decompress': decompressing}))
+            sys.argv = [filename, *args]
+            env = {
+                '__name__': '__main__',
+                '__self_source__': src_compressed,
+                '__file__': filename}
+            reported = []
+            if profile or trace:
+                # report the import of the entrypoint, before ending
+                def report(records, imported=True):
+                    if not reported:
+                        reported.append(True)
+                        if profile:
+                            command('beiboot.profile', records)
+                        if trace and imported:
+                            events.append((
+                                'exec and import entrypoint',
+                                executed, time.time(), {}))
+                        if trace:
+                            command('beiboot.trace', events)
+                        if send_end:
+                            end()
+                env['__beipack_profile__'] = report
+            elif send_end:
+                end()
+            executed = time.time()
+            if (profile or trace) and b'\nBeipackLoader.report_profile()\n' not in src:
+                # nothing will call report() until the script exits, and its
+                # stdin waits for end()
+                report([], False)
+            exec(src, env)
+            if (profile or trace) and send_end and not reported:
+                report([])
+            sys.exit()
+    """,
+    "trim_cache": r"""
+        import os
+        import time
+        def trim_cache(directory, keep, size, limit):
+            # Evict the least recently used files, until there are at most
+            # `limit` bytes, counting the `size` of the ones in `keep`.  Also
+            # anything left behind by an interrupted write.
+            entries = []
+            for entry in os.scandir(directory):
+                info = entry.stat()
+                if entry.name.startswith('.') and info.st_mtime < time.time() - 86400:
+                    os.unlink(entry.path)
+                elif (entry.is_file() and not entry.name.startswith('.')
+                        and entry.name not in keep):
+                    entries.append((info.st_mtime, info.st_size, entry.path))
+            total = size + sum(entry_size for _mtime, entry_size, _path in entries)
+            for _mtime, entry_size, entry_path in sorted(entries):
+                if total <= limit:
+                    break
+                os.unlink(entry_path)
+                total -= entry_size
+    """,
+    "boot_cached": r"""
+        import contextlib
+        import hashlib
+        import importlib
+        import os
+        import sys
+        import tempfile
+        def boot_cached(filename, fmt, size, digest, args=[], send_end=False,
+                        limit=64 << 20):
+            cache = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+            cache = os.path.join(cache, 'beipack')
+            path = os.path.join(cache, digest)
+            src_compressed = None
+            # a hit: check it, and mark it as recently used
+            with contextlib.suppress(OSError):
+                with open(path, 'rb') as file:
+                    data = file.read()
+                if hashlib.sha256(data).hexdigest() == digest:
+                    src_compressed = data
+                    os.utime(path)
+                else:
+                    os.unlink(path)
+            if src_compressed is None:
+                command('beiboot.provide', size)
+                src_compressed = sys.stdin.buffer.read(size)
+                if hashlib.sha256(src_compressed).hexdigest() != digest:
+                    raise ValueError('script corrupted in transit')
+                # the cache is optional: give up on any error
+                with contextlib.suppress(OSError):
+                    os.makedirs(cache, mode=0o700, exist_ok=True)
+                    fd, tmpname = tempfile.mkstemp(dir=cache, prefix='.tmp-')
+                    try:
+                        with open(fd, 'wb') as file:
+                            file.write(src_compressed)
+                            os.fsync(file.fileno())
+                        os.replace(tmpname, path)
+                    except OSError:
+                        os.unlink(tmpname)
+                        raise
+                    trim_cache(cache, {digest}, len(src_compressed), limit)
+            src = src_compressed
+            if fmt != 'none':
+                module = importlib.import_module({'xz': 'lzma'}.get(fmt, fmt))
+                src = module.decompress(src)
+            sys.argv = [filename, *args]
+            if send_end:
+                end()
+            exec(src, {
+                '__name__': '__main__',
+                '__self_source__': src_compressed,
+                '__file__': filename})
+            sys.exit()
+    """,
+    "boot_sync": r"""
+        import contextlib
+        import hashlib
+        import importlib
+        import os
+        import sys
+        import tempfile
+        def boot_sync(filename, manifest, skeleton, args=[], send_end=False,
+                limit=256 << 20):
+            cache = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+            store = os.path.join(cache, 'beipack', 'files')
+            files = {}
+            for digest in set(manifest.values()):
+                with contextlib.suppress(OSError):
+                    with open(os.path.join(store, digest), 'rb') as file:
+                        data = file.read()
+                    if hashlib.sha256(data).hexdigest() == digest:
+                        files[digest] = data
+                        os.utime(os.path.join(store, digest))
+            # ask for the rest: they're sent as one compressed block, after a
+            # header line
+            missing = sorted(set(manifest.values()) - set(files))
+            if missing:
+                command('beiboot.sync', missing)
+                fmt, size, *sizes = sys.stdin.buffer.readline().decode('ascii').split()
+                data = sys.stdin.buffer.read(int(size))
+                if fmt != 'none':
+                    module = importlib.import_module({'xz': 'lzma'}.get(fmt, fmt))
+                    data = module.decompress(data)
+                offset = 0
+                for digest, file_size in zip(missing, map(int, sizes)):
+                    files[digest] = data[offset:offset + file_size]
+                    offset += file_size
+                    if hashlib.sha256(files[digest]).hexdigest() != digest:
+                        raise ValueError('file corrupted in transit')
+                # the store is optional: give up on any error.  Files are
+                # checked when they're read, so there's no need to fsync.
+                with contextlib.suppress(OSError):
+                    os.makedirs(store, mode=0o700, exist_ok=True)
+                    for digest in missing:
+                        fd, tmpname = tempfile.mkstemp(dir=store, prefix='.tmp-')
+                        with open(fd, 'wb') as file:
+                            file.write(files[digest])
+                        os.replace(tmpname, os.path.join(store, digest))
+                    trim_cache(store, files, sum(map(len, files.values())), limit)
+            sys.argv = [filename, *args]
+            if send_end:
+                end()
+            exec(skeleton, {
+                '__name__': '__main__',
+                '__beipack_contents__': {
+                    name: files[digest] for name, digest in manifest.items()},
+                '__file__': filename})
+            sys.exit()
+    """,
+    "relay": r"""
+        import os
+        import subprocess
+        import sys
+        import threading
+        def relay(argv, bootloader):
+            # the next hop gets its bootloader, and then everything we receive,
+            # as we receive it
+            process = subprocess.Popen(argv, stdin=subprocess.PIPE)
+            process.stdin.write(bootloader.encode())
+            process.stdin.flush()
+            def forward():
+                try:
+                    while True:
+                        data = os.read(0, 1 << 16)
+                        if not data:
+                            break
+                        process.stdin.write(data)
+                        process.stdin.flush()
+                    process.stdin.close()
+                except OSError:
+                    pass
+            threading.Thread(target=forward, daemon=True).start()
+            status = process.wait()
+            sys.exit(status if status >= 0 else 128 - status)
+    """,
+    "agent": r"""
+        import atexit
+        import contextlib
+        import hashlib
+        import importlib
+        import json
+        import os
+        import selectors
+        import signal
+        import socket
+        import struct
+        import sys
+        import threading
+        import time
+        import traceback
+        def agent_send(conn, kind, data=b''):
+            conn.sendall(struct.pack('!BI', ord(kind), len(data)) + data)
+        def agent_parse(buffer):
+            # the first whole message in buffer, if there is one
+            if len(buffer) < 5:
+                return None
+            kind, size = struct.unpack_from('!BI', buffer)
+            if len(buffer) < 5 + size:
+                return None
+            data = bytes(buffer[5:5 + size])
+            del buffer[:5 + size]
+            return chr(kind), data
+        def agent_handshake(conn, state, programs, keep):
+            # returns (program, args) to run, None for 'Q', or ... while incomplete
+            while True:
+                message = agent_parse(state['buffer'])
+                if message is None:
+                    return ...
+                kind, data = message
+                request = state['request']
+                if request is None:
+                    if kind == 'Q':
+                        return None
+                    request = state['request'] = json.loads(data.decode())
+                    program = programs.pop(request['digest'], None)
+                    if program is None:
+                        agent_send(conn, 'N')
+                        continue
+                    programs[request['digest']] = program
+                else:
+                    digest, compressed = request['digest'], data
+                    if hashlib.sha256(compressed).hexdigest() != digest:
+                        raise ValueError('program does not match its digest')
+                    fmt, filename = request['fmt'], request['filename']
+                    source = compressed
+                    if fmt != 'none':
+                        module = importlib.import_module({'xz': 'lzma'}.get(fmt, fmt))
+                        source = module.decompress(source)
+                    program = filename, compressed, compile(source, filename, 'exec')
+                    programs[digest] = program
+                    while len(programs) > keep:
+                        del programs[next(iter(programs))]
+                agent_send(conn, 'S')
+                return program, request['args']
+        def agent_fail(conn, message):
+            with contextlib.suppress(OSError):
+                agent_send(conn, 'E', message.encode())
+                agent_send(conn, 'X', b'1')
+        def agent_fork(conn, request, inherited):
+            # only ever called from the main thread, with no other threads running
+            try:
+                pid = os.fork()
+            except OSError:
+                agent_fail(conn, traceback.format_exc())
+                return
+            if pid == 0:
+                try:
+                    for obj in inherited:
+                        obj.close()
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    conn.setblocking(True)
+                    agent_run(conn, *request)
+                finally:
+                    os._exit(0)
+        def agent_run(conn, program, args):
+            filename, compressed, code = program
+            stdin_r, stdin_w = os.pipe()
+            stdout_r, stdout_w = os.pipe()
+            stderr_r, stderr_w = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    conn.close()
+                    os.dup2(stdin_r, 0)
+                    os.dup2(stdout_w, 1)
+                    os.dup2(stderr_w, 2)
+                    pipes = (stdin_r, stdin_w, stdout_r, stdout_w, stderr_r, stderr_w)
+                    for fd in pipes:
+                        os.close(fd)
+                    sys.stdin = open(0, closefd=False)
+                    sys.stdout = open(1, 'w', closefd=False)
+                    sys.stderr = open(2, 'w', buffering=1, closefd=False)
+                    sys.argv = [filename, *args]
+                    try:
+                        exec(code, {
+                            '__name__': '__main__',
+                            '__self_source__': compressed,
+                            '__file__': filename})
+                        status = 0
+                    except SystemExit as exc:
+                        if exc.code is None or isinstance(exc.code, int):
+                            status = exc.code or 0
+                        else:
+                            sys.stderr.write(f'{exc.code}\n')
+                    except BaseException:
+                        traceback.print_exc()
+                    atexit._run_exitfuncs()
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                finally:
+                    os._exit(status)
+            for fd in (stdin_r, stdout_w, stderr_w):
+                os.close(fd)
+            def forward_stdin():
+                # after the request, the client sends its stdin as it is, until EOF
+                with open(stdin_w, 'wb') as pipe, contextlib.suppress(OSError):
+                    while True:
+                        data = conn.recv(1 << 16)
+                        if not data:
+                            break
+                        pipe.write(data)
+                        pipe.flush()
+            threading.Thread(target=forward_stdin, daemon=True).start()
+            selector = selectors.DefaultSelector()
+            selector.register(stdout_r, selectors.EVENT_READ, 'O')
+            selector.register(stderr_r, selectors.EVENT_READ, 'E')
+            while selector.get_map():
+                for key, _ in selector.select():
+                    data = os.read(key.fd, 1 << 16)
+                    if data:
+                        agent_send(conn, key.data, data)
+                    else:
+                        selector.unregister(key.fd)
+            _, status = os.waitpid(pid, 0)
+            if os.WIFEXITED(status):
+                status = os.WEXITSTATUS(status)
+            else:
+                status = 128 + os.WTERMSIG(status)
+            agent_send(conn, 'X', str(status).encode())
+        def agent(path, timeout=600, keep=8):
+            # everything happens in this thread, as the connections are forked from it:
+            # forking while other threads run could leave their locks held in the child
+            programs = {}
+            handshakes = {}
+            os.umask(0o077)
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(path)
+            listener.listen(16)
+            # the connection handlers are reaped automatically
+            signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+            selector = selectors.DefaultSelector()
+            selector.register(listener, selectors.EVENT_READ)
+            selector.register(0, selectors.EVENT_READ)
+            sys.stdout.write('beiboot.agent ready\n')
+            sys.stdout.flush()
+            def finish(conn):
+                selector.unregister(conn)
+                del handshakes[conn]
+                conn.close()
+            try:
+                while True:
+                    now = time.monotonic()
+                    deadlines = [
+                        state['deadline'] - now for state in handshakes.values()]
+                    events = selector.select(max(0, min([timeout, *deadlines])))
+                    # we're not idle while a connection is still being accepted
+                    if not events and not handshakes:
+                        break
+                    stop = False
+                    for key, _ in events:
+                        if key.fileobj is listener:
+                            conn, _ = listener.accept()
+                            conn.setblocking(False)
+                            selector.register(conn, selectors.EVENT_READ)
+                            handshakes[conn] = {
+                                'buffer': bytearray(), 'request': None,
+                                'deadline': time.monotonic() + 30}
+                        elif key.fd == 0:
+                            # EOF on stdin: whoever started us has gone away
+                            stop = stop or not os.read(0, 1 << 16)
+                        else:
+                            conn = key.fileobj
+                            state = handshakes[conn]
+                            try:
+                                data = conn.recv(1 << 16)
+                                if not data:
+                                    raise EOFError('connection closed')
+                                state['buffer'] += data
+                                request = agent_handshake(conn, state, programs, keep)
+                            except Exception:
+                                agent_fail(conn, traceback.format_exc())
+                                finish(conn)
+                                continue
+                            if request is ...:
+                                continue
+                            if request is None:
+                                stop = True
+                            else:
+                                inherited = [selector, listener, *handshakes]
+                                inherited.remove(conn)
+                                agent_fork(conn, request, inherited)
+                            finish(conn)
+                    now = time.monotonic()
+                    expired = [
+                        conn for conn, state in handshakes.items()
+                        if state['deadline'] <= now]
+                    for conn in expired:
+                        agent_fail(conn, 'beiboot agent: client timed out\n')
+                        finish(conn)
+                    if stop:
+                        break
+            finally:
+                os.unlink(path)
+            sys.exit()
+    """,
 }
 
 
+# The gadgets which the steps can use without naming them
+GADGET_DEPENDENCIES = {
+    'boot_cached': ('trim_cache',),
+    'boot_sync': ('trim_cache',),
+}
+
+# Typed into the REPL in front of a framed program.  It reads exactly `size`
+# bytes (sys.stdin.buffer would read ahead, past the end of the program) and
+# runs them, so the REPL never sees the program itself.
+FRAME_STUB = r"""
+def _beiboot_frame(size):
+    import sys
+    data = bytearray(size)
+    view = memoryview(data)
+    position = 0
+    while position < size:
+        count = sys.stdin.buffer.raw.readinto(view[position:])
+        if not count:
+            raise EOFError('program truncated after %d of %d bytes' % (position, size))
+        position += count
+    return bytes(data)
+
+exec(_beiboot_frame({size}))
+"""
+
+
 def split_code(code: str, imports: Set[str]) -> Iterable[Tuple[str, str]]:
     for line in textwrap.dedent(code).splitlines():
         text = line.lstrip(" ")
@@ -78,6 +618,7 @@ def yield_body(user_gadgets: Dict[str, str],
     # plus any referred to by the caller's list of steps.
     provided_gadgets = set(user_gadgets)
     step_gadgets = {name for name, _args in steps}
+    step_gadgets.update(*(GADGET_DEPENDENCIES.get(name, ()) for name in step_gadgets))
     for name in provided_gadgets | step_gadgets:
         yield from split_code(gadgets[name], imports)
 
@@ -99,3 +640,29 @@ def make_bootloader(steps: Sequence[Tuple[str, Sequence[object]]],
             lines.append(frame_spaces + frame_text)
 
     return "".join(f"{line}\n" for line in [*imports, *lines]) + "\n"
+
+
+def make_relay_bootloader(hops: Sequence[Sequence[str]],
+                          steps: Sequence[Tuple[str, Sequence[object]]],
+                          gadgets: Optional[Dict[str, str]] = None) -> str:
+    """Like `make_bootloader()`, but the steps are run at the end of a chain of relays.
+
+    Each of the `hops` is the command which the previous hop runs to reach the
+    next one.  Each relay forwards its stdin to the next hop as it arrives,
+    and the next hop inherits its stdout and stderr, so commands and data go
+    straight through.  With no `hops`, this is the same as `make_bootloader()`.
+    """
+    bootloader = make_bootloader(steps, gadgets)
+    for hop in reversed(hops):
+        bootloader = make_bootloader([('relay', (list(hop), bootloader))], gadgets)
+    return bootloader
+
+
+def make_framed(script: bytes) -> bytes:
+    """Prefixes `script` with a short stub which reads it from stdin and runs it.
+
+    The REPL only parses the stub: the script itself is read and compiled in
+    one go.  It doesn't need to be REPL-friendly, and anything which follows
+    it on stdin is left for it to read.
+    """
+    return FRAME_STUB.lstrip().format(size=len(script)).encode() + script
@@ -0,0 +1,169 @@
+# beipack - Remote bootloader for Python
+#
+# Copyright (C) 2023 Allison Karlitskaya <allison.karlitskaya@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compression formats supported for packs and by the bootloader gadgets.
+
+A format is given as a name, optionally followed by a colon and a level, for
+example `xz`, `xz:6`, `xz:9e` or `zlib:1`.  The default level is 9 for zlib
+and bz2, and `0e` (ie: `lzma.PRESET_EXTREME`) for xz.
+"""
+
+import bz2
+import concurrent.futures
+import io
+import lzma
+import zlib
+from typing import BinaryIO, Dict, Optional, Tuple, Union
+
+# Maps format names to the module which is used for decompression on the
+# remote side.  The bootloader gadgets use the same mapping.
+MODULES: Dict[str, Optional[str]] = {
+    'none': None,
+    'zlib': 'zlib',
+    'bz2': 'bz2',
+    'xz': 'lzma',
+}
+
+# The levels each format accepts (bz2 has no uncompressed level 0)
+LEVELS: Dict[str, range] = {
+    'none': range(0),
+    'zlib': range(10),
+    'bz2': range(1, 10),
+    'xz': range(10),
+}
+
+# Splitting the input into blocks smaller than this costs too much in ratio
+MIN_XZ_BLOCK_SIZE = 1 << 20
+
+
+def parse_format(fmt: str) -> Tuple[str, str]:
+    name, _, level = fmt.partition(':')
+    if name not in MODULES:
+        raise ValueError(f'unknown compression format {name!r}')
+    digit = level[:-1] if name == 'xz' and level.endswith('e') else level
+    if level and (len(digit) != 1 or not digit.isdigit()
+                  or int(digit) not in LEVELS[name]):
+        raise ValueError(f'invalid level {level!r} for compression format {name!r}')
+    return name, level
+
+
+def xz_preset(level: str) -> int:
+    if not level:
+        return lzma.PRESET_EXTREME
+    preset = int(level.rstrip('e'))
+    return preset | lzma.PRESET_EXTREME if level.endswith('e') else preset
+
+
+def compress_xz_block(data: bytes, preset: int = lzma.PRESET_EXTREME) -> bytes:
+    return lzma.compress(data, preset=preset)
+
+
+def compress_xz(data: bytes, preset: int = lzma.PRESET_EXTREME,
+                jobs: int = 1) -> bytes:
+    """Compresses `data` with xz using up to `jobs` processes.
+
+    With more than one job, the data is split into blocks which are compressed
+    as independent streams and concatenated.  `lzma.decompress()` (and thus
+    the bootloader gadgets) and `xz -d` both accept the result.
+    """
+    block_size = max(-(-len(data) // jobs), MIN_XZ_BLOCK_SIZE)
+    if len(data) <= block_size:
+        return compress_xz_block(data, preset)
+
+    blocks = [data[i:i + block_size] for i in range(0, len(data), block_size)]
+    with concurrent.futures.ProcessPoolExecutor(min(jobs, len(blocks))) as executor:
+        presets = [preset] * len(blocks)
+        return b''.join(executor.map(compress_xz_block, blocks, presets))
+
+
+def compress(data: bytes, fmt: str = 'xz', jobs: int = 1) -> bytes:
+    """Compresses `data` in the given format.
+
+    `jobs` is only used for xz (see `compress_xz()`).
+    """
+    name, level = parse_format(fmt)
+
+    if name == 'xz':
+        return compress_xz(data, xz_preset(level), jobs)
+    elif name == 'zlib':
+        return zlib.compress(data, int(level or 9))
+    elif name == 'bz2':
+        return bz2.compress(data, int(level or 9))
+    else:
+        return data
+
+
+class CompressingWriter(io.BufferedIOBase):
+    """A writable stream which compresses everything written to it.
+
+    The compressed data is written to `stream` as it is produced.  The result
+    is the same as from `compress()` with `jobs=1`.  `close()` writes the
+    remaining data, but doesn't close `stream`.
+    """
+    compressor: Union[None, 'lzma.LZMACompressor', 'zlib._Compress', bz2.BZ2Compressor]
+
+    def __init__(self, stream: BinaryIO, fmt: str) -> None:
+        super().__init__()
+        self.stream = stream
+
+        name, level = parse_format(fmt)
+        if name == 'xz':
+            self.compressor = lzma.LZMACompressor(preset=xz_preset(level))
+        elif name == 'zlib':
+            self.compressor = zlib.compressobj(int(level or 9))
+        elif name == 'bz2':
+            self.compressor = bz2.BZ2Compressor(int(level or 9))
+        else:
+            self.compressor = None
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:  # type: ignore[override]
+        self.stream.write(data if self.compressor is None
+                          else self.compressor.compress(data))
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed and self.compressor is not None:
+            self.stream.write(self.compressor.flush())
+        super().close()
+
+
+def decompress(data: bytes, fmt: str) -> bytes:
+    module = MODULES[parse_format(fmt)[0]]
+    if module == 'lzma':
+        return lzma.decompress(data)
+    elif module == 'zlib':
+        return zlib.decompress(data)
+    elif module == 'bz2':
+        return bz2.decompress(data)
+    else:
+        return data
+
+
+def detect_format(data: bytes) -> str:
+    """Guesses the compression format of `data` from its header."""
+    if data.startswith(b'\xfd7zXZ\0'):
+        return 'xz'
+    elif data.startswith(b'BZh'):
+        return 'bz2'
+    elif (len(data) >= 2 and data[0] == 0x78
+          and int.from_bytes(data[:2], 'big') % 31 == 0):
+        return 'zlib'
+    else:
+        return 'none'
@@ -1,62 +1,242 @@
 # beipack https://github.com/allisonkarlitskaya/beipack
 
 import importlib.abc
+import importlib.machinery
 import importlib.util
 import io
+import marshal
+import os
 import sys
-from types import ModuleType
-from typing import BinaryIO, Dict, Iterator, Optional, Sequence
+import time
+from types import CodeType, ModuleType
+from typing import (
+    IO,
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 
 class BeipackLoader(importlib.abc.SourceLoader, importlib.abc.MetaPathFinder):
     if sys.version_info >= (3, 11):
-        from importlib.resources.abc import ResourceReader as AbstractResourceReader
+        from importlib.resources.abc import Traversable as AbstractTraversable
+        from importlib.resources.abc import (
+            TraversableResources as AbstractResourceReader,
+        )
+    elif sys.version_info >= (3, 9):
+        from importlib.abc import Traversable as AbstractTraversable
+        from importlib.abc import TraversableResources as AbstractResourceReader
     else:
+        AbstractTraversable = object
         AbstractResourceReader = object
 
+    class Traversable(AbstractTraversable):
+        def __init__(self, loader: 'BeipackLoader', path: str) -> None:
+            self._loader = loader
+            self._path = path
+
+        @property
+        def name(self) -> str:
+            return self._path.rpartition('/')[2]
+
+        def iterdir(self) -> Iterator['BeipackLoader.Traversable']:
+            names = self._loader.directories.get(self._path, ())
+            return (self.joinpath(name) for name in names)
+
+        def is_dir(self) -> bool:
+            return self._path in self._loader.directories
+
+        def is_file(self) -> bool:
+            return self._path in self._loader.contents
+
+        def joinpath(self, *descendants: Union[str, 'os.PathLike[str]']
+                     ) -> 'BeipackLoader.Traversable':
+            path = '/'.join((self._path, *(os.fspath(name) for name in descendants)))
+            return BeipackLoader.Traversable(self._loader, path.lstrip('/'))
+
+        def __truediv__(self, child: Union[str, 'os.PathLike[str]']
+                        ) -> 'BeipackLoader.Traversable':
+            return self.joinpath(child)
+
+        def read_bytes(self) -> bytes:
+            if not self.is_file():
+                raise FileNotFoundError(self._path)
+            return self._loader.get_data(self._path)
+
+        def read_memoryview(self) -> memoryview:
+            # For callers which can use a buffer: no copies, even from the blob
+            path, loader = self._path, self._loader
+            if (self.is_file() and path not in loader.compressed
+                    and path not in loader.evicted):
+                return memoryview(loader.contents[path])
+            return memoryview(self.read_bytes())
+
+        def read_text(self, encoding: Optional[str] = None) -> str:
+            return self.read_bytes().decode(encoding or 'utf-8')
+
+        def open(
+            self,
+            mode: str = 'r',
+            encoding: Optional[str] = None,
+            errors: Optional[str] = None,
+            newline: Optional[str] = None,
+          ) -> IO[Any]:
+            if mode not in ('r', 'rb'):
+                raise ValueError(f'invalid mode {mode!r}: resources are read-only')
+            # BytesIO shares the data until someone writes to it
+            stream = io.BytesIO(self.read_bytes())
+            if mode == 'rb':
+                return stream
+            return io.TextIOWrapper(stream, encoding, errors, newline)
+
     class ResourceReader(AbstractResourceReader):
-        def __init__(self, contents: Dict[str, bytes], filename: str) -> None:
-            self._contents = contents
-            self._dir = f'{filename}/'
+        def __init__(self, loader: 'BeipackLoader', filename: str) -> None:
+            self._loader = loader
+            self._dir = filename
+
+        def files(self) -> 'BeipackLoader.Traversable':
+            return BeipackLoader.Traversable(self._loader, self._dir)
 
         def is_resource(self, resource: str) -> bool:
-            return f'{self._dir}{resource}' in self._contents
+            return f'{self._dir}/{resource}' in self._loader.contents
 
-        def open_resource(self, resource: str) -> BinaryIO:
-            return io.BytesIO(self._contents[f'{self._dir}{resource}'])
+        # typeshed wants a BufferedReader, but any binary stream will do
+        def open_resource(self, resource: str) -> BinaryIO:  # type: ignore[override]
+            return io.BytesIO(self._loader.get_data(f'{self._dir}/{resource}'))
 
         def resource_path(self, resource: str) -> str:
             raise FileNotFoundError
 
         def contents(self) -> Iterator[str]:
-            dir_length = len(self._dir)
-            result = set()
-
-            for filename in self._contents:
-                if filename.startswith(self._dir):
-                    try:
-                        next_slash = filename.index('/', dir_length)
-                    except ValueError:
-                        next_slash = None
-                    result.add(filename[dir_length:next_slash])
+            return iter(self._loader.directories.get(self._dir, ()))
 
-            return iter(result)
+    # The bootloader gives us our own source compressed in one of these
+    SELF_SOURCE_FORMATS = (
+        (b'\xfd7zXZ\0', 'lzma', 'LZMADecompressor'),
+        (b'BZh', 'bz2', 'BZ2Decompressor'),
+        (b'x\x01', 'zlib', 'decompressobj'), (b'x^', 'zlib', 'decompressobj'),
+        (b'x\x9c', 'zlib', 'decompressobj'), (b'x\xda', 'zlib', 'decompressobj'),
+    )
+    SELF_SOURCE_BLOCK_SIZE = 1 << 16
 
     contents: Dict[str, bytes]
+    directories: Dict[str, Set[str]]
     modules: Dict[str, str]
+    extensions: Dict[str, str]
+    extension_loaders: Dict[str, importlib.machinery.ExtensionFileLoader]
+    bytecode: Dict[str, bytes]
+    compressed: Set[str]
+    decompress: Optional[Callable[[bytes], bytes]]
+    self_source: Optional[bytes]
+    self_source_index: Optional[Dict[str, Tuple[int, int]]]
+    evict: bool
+    evicted: Set[str]
+    freed: int
+    rehydrated: int
+    profile: Optional[Callable[[List[Dict[str, Any]]], None]]
+    profile_find: Dict[str, float]
+    profile_records: List[Dict[str, Any]]
+    profile_stack: List[Dict[str, Any]]
 
-    def __init__(self, contents: Dict[str, bytes]) -> None:
+    def __init__(self,
+                 contents: Dict[str, bytes],
+                 bytecode: Optional[Dict[bytes, Dict[str, bytes]]] = None,
+                 compression: Optional[str] = None,
+                 aliases: Optional[Dict[str, str]] = None,
+                 index: Optional[Dict[str, Tuple[int, int]]] = None,
+                 blob: Union[bytes, bytearray] = b'',
+                 evict: bool = False) -> None:
+        # Files can also be slices of one large blob, copied out on first use
+        view = memoryview(blob)
+        for filename, (start, end) in (index or {}).items():
+            contents[filename] = view[start:end]  # type: ignore[assignment]
+        # Duplicate files are only stored once
+        for alias, target in (aliases or {}).items():
+            contents[alias] = contents[target]
+        # With per-file compression, each file is decompressed on first use
+        if compression is not None:
+            self.decompress = importlib.import_module(compression).decompress
+            self.compressed = set(contents)
+        else:
+            self.decompress = None
+            self.compressed = set()
         try:
-            contents[__file__] = __self_source__  # type: ignore[name-defined]
+            self.self_source = __self_source__  # type: ignore[name-defined]
+            contents[__file__] = self.self_source
         except NameError:
-            pass
+            self.self_source = None
+        self.self_source_index = None
+        # Files are dropped after they're read, if we can find them again
+        # (which needs the end positions from ast, in Python 3.8)
+        self.evict = (evict and self.self_source is not None
+                      and sys.version_info >= (3, 8))
+        self.evicted = set()
+        self.freed = 0
+        self.rehydrated = 0
 
         self.contents = contents
+        # The names in each directory ('' is the top-level)
+        self.directories = {'': set()}
+        for filename in contents:
+            directory, _, name = filename.rpartition('/')
+            while name and name not in self.directories.setdefault(directory, set()):
+                self.directories[directory].add(name)
+                directory, _, name = directory.rpartition('/')
         self.modules = {
             self.get_fullname(filename): filename
             for filename in contents
             if filename.endswith(".py")
         }
+        self.extensions = self.find_extensions(contents)
+        self.extension_loaders = {}
+        # Precompiled code is only useful if it matches our interpreter
+        self.bytecode = (bytecode or {}).get(importlib.util.MAGIC_NUMBER, {})
+        # Import profiling is enabled by the bootloader (see report_profile())
+        try:
+            self.profile = __beipack_profile__  # type: ignore[name-defined]
+        except NameError:
+            self.profile = None
+        self.profile_find = {}
+        self.profile_records = []
+        self.profile_stack = []
+
+    @staticmethod
+    def find_extensions(contents: Dict[str, bytes]) -> Dict[str, str]:
+        # Native extensions are loaded from memfds, and only if the platform
+        # tag matches.  Otherwise, we fall back to the .py module, if any.
+        extensions = {}
+        if hasattr(os, 'memfd_create'):
+            for filename in contents:
+                for suffix in importlib.machinery.EXTENSION_SUFFIXES:
+                    if filename.endswith(suffix):
+                        name = filename[:-len(suffix)]
+                        if '.' not in name.rpartition('/')[2]:
+                            extensions[name.replace('/', '.')] = filename
+                        break
+        return extensions
+
+    @staticmethod
+    def read_blob(size: int) -> bytearray:
+        # The blob follows the line which reads it, on the stdin of the REPL.
+        # sys.stdin.buffer would read ahead, past the end of the blob.
+        blob = bytearray(size)
+        view = memoryview(blob)
+        position = 0
+        while position < size:
+            count = os.readv(0, [view[position:]])
+            if not count:
+                raise EOFError(f'blob truncated after {position} of {size} bytes')
+            position += count
+        # not bytes(blob): that would be a second copy of everything
+        return blob
 
     def get_fullname(self, filename: str) -> str:
         assert filename.endswith(".py")
@@ -66,13 +246,216 @@ class BeipackLoader(importlib.abc.SourceLoader, importlib.abc.MetaPathFinder):
         return filename.replace("/", ".")
 
     def get_resource_reader(self, fullname: str) -> ResourceReader:
-        return BeipackLoader.ResourceReader(self.contents, fullname.replace('.', '/'))
+        return BeipackLoader.ResourceReader(self, fullname.replace('.', '/'))
+
+    def index_self_source(self) -> Dict[str, Tuple[int, int]]:
+        # Find where each file is in our own source, in the call which created us
+        import ast
+        source = self.self_source
+        assert source is not None
+        for magic, module, _decompressor in self.SELF_SOURCE_FORMATS:
+            if source.startswith(magic):
+                source = importlib.import_module(module).decompress(source)
+                break
+        for node in ast.walk(ast.parse(source)):
+            if (isinstance(node, ast.Call)
+                    and getattr(node.func, 'id', None) == 'BeipackLoader'):
+                break
+        else:
+            return {}
+        # ast gives us lines, and byte offsets within them
+        lines = [0]
+        for line in io.BytesIO(source):
+            lines.append(lines[-1] + len(line))
+        files = node.args[0]
+        assert isinstance(files, ast.Dict)
+        index = {
+            ast.literal_eval(key): (
+                lines[value.lineno - 1] + value.col_offset,
+                lines[value.end_lineno - 1]  # type: ignore[operator]
+                + value.end_col_offset)
+            # the loader also runs on Pythons before 3.10, which have no strict=
+            for key, value in zip(files.keys, files.values)  # noqa: B905
+            if key is not None
+        }
+        for keyword in node.keywords:
+            if keyword.arg == 'aliases':
+                for alias, target in ast.literal_eval(keyword.value).items():
+                    index[alias] = index[target]
+        return index
+
+    def read_self_source(self, start: int, end: int) -> bytes:
+        # Decompress our own source as far as `end`, but only keep [start:end]
+        source = self.self_source
+        assert source is not None
+        for magic, module, decompressor in self.SELF_SOURCE_FORMATS:
+            if source.startswith(magic):
+                new_decompressor = getattr(importlib.import_module(module),
+                                           decompressor)
+                break
+        else:
+            return source[start:end]
+        view = memoryview(source)
+        pieces = []
+        position = offset = 0
+        state = new_decompressor()
+        while position < end and offset < len(view):
+            block = view[offset:offset + self.SELF_SOURCE_BLOCK_SIZE]
+            data = state.decompress(block)
+            offset += len(block)
+            if state.eof:
+                # the next stream (eg: from a multi-threaded xz)
+                offset -= len(state.unused_data)
+                state = new_decompressor()
+            pieces.append(data[max(start - position, 0):max(end - position, 0)])
+            position += len(data)
+        return b''.join(pieces)
+
+    def rehydrate(self, path: str) -> None:
+        from binascii import a2b_base64
+        if self.self_source_index is None:
+            self.self_source_index = self.index_self_source()
+        if path not in self.self_source_index:
+            raise FileNotFoundError(path)
+        expression = self.read_self_source(*self.self_source_index[path])
+        self.contents[path] = eval(expression, {'a2b_base64': a2b_base64})
+        if self.decompress is not None:
+            self.compressed.add(path)
+        self.evicted.remove(path)
+        self.rehydrated += 1
 
     def get_data(self, path: str) -> bytes:
-        return self.contents[path]
+        if path in self.evicted:
+            self.rehydrate(path)
+        data = self.contents[path]
+        if path in self.compressed:
+            assert self.decompress is not None
+            start = time.perf_counter()
+            data = self.contents[path] = self.decompress(data)
+            self.compressed.remove(path)
+            if self.profile_stack:
+                self.profile_stack[-1]['decompress'] += time.perf_counter() - start
+        elif isinstance(data, memoryview):
+            data = self.contents[path] = data.tobytes()
+        if self.profile_stack:
+            self.profile_stack[-1]['size'] += len(data)
+        if self.evict and data is not self.self_source:
+            self.evict_file(path, len(data))
+        return data
+
+    def evict_file(self, path: str, size: int) -> None:
+        self.contents[path] = b''
+        self.compressed.discard(path)
+        self.evicted.add(path)
+        self.freed += size
+
+    def memory_usage(self) -> Dict[str, int]:
+        # aliases share their data
+        resident = {id(data): len(data) for data in self.contents.values()}
+        return {
+            'files': len(self.contents),
+            'evicted': len(self.evicted),
+            'resident': sum(resident.values()),
+            'bytecode': sum(len(code) for code in self.bytecode.values()),
+            'freed': self.freed,
+            'rehydrated': self.rehydrated,
+        }
 
     def get_filename(self, fullname: str) -> str:
-        return self.modules[fullname]
+        return self.extensions.get(fullname) or self.modules[fullname]
+
+    def create_module(self, spec: importlib.machinery.ModuleSpec
+                      ) -> Optional[ModuleType]:
+        filename = self.extensions.get(spec.name)
+        if filename is None:
+            return None
+        # The fd stays open: the dynamic linker reuses libraries by path, so
+        # a later extension mustn't get the same /proc/self/fd/N.
+        fd = os.memfd_create(filename.rpartition('/')[2], os.MFD_CLOEXEC)
+        with open(fd, 'wb', closefd=False) as file:
+            file.write(self.get_data(filename))
+        path = f'/proc/self/fd/{fd}'
+        loader = importlib.machinery.ExtensionFileLoader(spec.name, path)
+        try:
+            module = loader.create_module(
+                importlib.machinery.ModuleSpec(spec.name, loader, origin=path))
+            self.extension_loaders[spec.name] = loader
+            return module
+        except ImportError:
+            os.close(fd)
+            if spec.name not in self.modules:
+                raise
+        # Wrong libc, missing libraries, etc.
+        del self.extensions[spec.name]
+        spec.origin = self.modules[spec.name]
+        return None
+
+    def run_module(self, module: ModuleType) -> None:
+        loader = self.extension_loaders.pop(module.__name__, None)
+        if loader is not None:
+            loader.exec_module(module)
+        else:
+            super().exec_module(module)
+
+    def get_code(self, fullname: str) -> Optional[CodeType]:
+        filename = self.get_filename(fullname)
+        if filename in self.bytecode:
+            if self.evict:
+                code = self.bytecode.pop(filename)
+            else:
+                code = self.bytecode[filename]
+            # The source isn't read, but it's no more needed than if it was
+            if self.evict and filename not in self.evicted:
+                self.evict_file(filename, len(self.contents[filename]))
+            start = time.perf_counter()
+            if self.decompress is not None:
+                code = self.decompress(code)
+            result = marshal.loads(code)
+            if self.profile_stack:
+                self.profile_stack[-1]['size'] += len(code)
+                self.profile_stack[-1]['compile'] += time.perf_counter() - start
+            return result
+        return super().get_code(fullname)
+
+    def source_to_code(  # type: ignore[override]
+            self, data: bytes, path: str, *, _optimize: int = -1) -> CodeType:
+        start = time.perf_counter()
+        code = super().source_to_code(data, path, _optimize=_optimize)
+        if self.profile_stack:
+            self.profile_stack[-1]['compile'] += time.perf_counter() - start
+        return code
+
+    def exec_module(self, module: ModuleType) -> None:
+        if self.profile is None:
+            self.run_module(module)
+            return
+        name = module.__name__
+        record = {
+            'name': name,
+            'parent': self.profile_stack[-1]['name'] if self.profile_stack else None,
+            'find': self.profile_find.pop(name, 0.0),
+            'size': 0,
+            'decompress': 0.0,
+            'compile': 0.0,
+            'exec': 0.0,
+        }
+        self.profile_records.append(record)
+        self.profile_stack.append(record)
+        start = time.perf_counter()
+        try:
+            self.run_module(module)
+        finally:
+            # includes the nested imports, and our own compile time
+            record['exec'] = time.perf_counter() - start
+            self.profile_stack.pop()
+
+    @classmethod
+    def report_profile(cls) -> None:
+        # The pack calls this after importing the entrypoint
+        for finder in sys.meta_path:
+            if isinstance(finder, cls) and finder.profile is not None:
+                records, finder.profile_records = finder.profile_records, []
+                finder.profile(records)
 
     def find_spec(
         self,
@@ -80,6 +463,10 @@ class BeipackLoader(importlib.abc.SourceLoader, importlib.abc.MetaPathFinder):
         path: Optional[Sequence[str]],
         target: Optional[ModuleType] = None
       ) -> Optional[importlib.machinery.ModuleSpec]:
-        if fullname not in self.modules:
+        start = time.perf_counter()
+        if fullname not in self.modules and fullname not in self.extensions:
             return None
-        return importlib.util.spec_from_loader(fullname, self)
+        spec = importlib.util.spec_from_loader(fullname, self)
+        if self.profile is not None:
+            self.profile_find[fullname] = time.perf_counter() - start
+        return spec
@@ -0,0 +1,652 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import types
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import pytest
+
+from bei import beiboot, beipack, compression
+from bei.bootloader import make_bootloader, make_framed, make_relay_bootloader
+
+# Stand-ins for ferny's gadgets which are easier to drive from a test
+FAKE_GADGETS = {
+    "command": r"""
+        import json
+        import sys
+        def command(*args):
+            sys.stderr.write(json.dumps(args) + '\n')
+            sys.stderr.flush()
+    """,
+    "end": r"""
+        def end():
+            command('ferny.end')
+    """,
+}
+
+Responder = Callable[[str, List[object]], bytes]
+# A bootloader step: the name of a gadget, and its arguments
+Step = Tuple[str, Sequence[object]]
+
+
+def run_bootloader(steps: Sequence[Step],
+                   respond: Responder) -> Tuple[str, List[List]]:
+    process = subprocess.Popen(beiboot.get_python_command(local=True),
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    assert process.stdin is not None and process.stderr is not None
+
+    process.stdin.write(make_bootloader(steps, gadgets=FAKE_GADGETS).encode())
+    process.stdin.flush()
+
+    commands = []
+    for line in process.stderr:
+        name, *args = json.loads(line)
+        commands.append([name, *args])
+        if name == 'ferny.end':
+            break
+        process.stdin.write(respond(name, args))
+        process.stdin.flush()
+
+    stdout, _stderr = process.communicate()
+    return stdout.decode(), commands
+
+
+HELLO = beipack.pack({'hello.py': b'def main():\n    print("hello world")\n'},
+                     'hello:main').encode()
+
+
+@pytest.mark.parametrize('fmt', ['none', 'zlib', 'bz2', 'xz'])
+def test_boot_compressed(fmt: str) -> None:
+    script = compression.compress(HELLO, fmt)
+
+    def respond(command: str, args: List[object]) -> bytes:
+        assert command == 'beiboot.provide'
+        assert args == [len(script)]
+        return script
+
+    steps: List[Step] = [
+        ('boot_compressed', ('script.py', fmt, len(script), [], True))]
+    output, commands = run_bootloader(steps, respond)
+    assert output == 'hello world\n'
+    assert [name for name, *_args in commands] == ['beiboot.provide', 'ferny.end']
+
+
+def test_boot_compressed_auto() -> None:
+    samples = {fmt: compression.compress(HELLO, fmt) for fmt in ['zlib', 'xz']}
+    script = compression.compress(HELLO, 'bz2')
+
+    def respond(command: str, args: List[object]) -> bytes:
+        if command == 'beiboot.ping':
+            return b'\n'
+        elif command == 'beiboot.probe':
+            return b''.join(samples.values())
+        else:
+            assert command == 'beiboot.provide'
+            timings, = args
+            assert isinstance(timings, list) and len(timings) == 2
+            return f'bz2 {len(script)}\n'.encode() + script
+
+    sample_sizes = [(fmt, len(data)) for fmt, data in samples.items()]
+    steps: List[Step] = [
+        ('boot_compressed', ('script.py', None, 0, [], True, sample_sizes))]
+    output, _commands = run_bootloader(steps, respond)
+    assert output == 'hello world\n'
+
+
+@pytest.mark.parametrize('compress_files', [None, 'zlib'])
+def test_boot_compressed_profile(compress_files: Optional[str]) -> None:
+    script = beipack.pack({
+        'a/__init__.py': b'',
+        'a/b.py': b'from . import c\n'
+                  b'def main():\n'
+                  b'    import a.d\n'
+                  b'    print("hello world")\n',
+        'a/c.py': b'import time\ntime.sleep(0.1)\n',
+        'a/d.py': b'# imported later, so not reported\n',
+    }, 'a.b:main', compression=compress_files).encode()
+
+    profile: List[Dict[str, Any]] = []
+
+    def respond(command: str, args: List[object]) -> bytes:
+        if command == 'beiboot.profile':
+            assert isinstance(args[0], list)
+            profile.extend(args[0])
+            return b''
+        return script
+
+    steps: List[Step] = [
+        ('boot_compressed', ('script.py', 'none', len(script), [], True, None, True))]
+    output, commands = run_bootloader(steps, respond)
+    assert output == 'hello world\n'
+    assert [name for name, *_args in commands] == [
+        'beiboot.provide', 'beiboot.profile', 'ferny.end']
+
+    records = {record['name']: record for record in profile}
+    assert list(records) == ['a', 'a.b', 'a.c']
+    assert [records[name]['parent'] for name in records] == [None, None, 'a.b']
+    assert records['a.c']['size'] == len('import time\ntime.sleep(0.1)\n')
+    assert records['a.b']['exec'] > records['a.c']['exec'] > 0.1
+    assert (records['a.c']['decompress'] > 0) == (compress_files is not None)
+
+    report = beiboot.format_profile(profile).splitlines()
+    assert report[1].endswith(' a.c (from a.b)')
+
+
+def test_boot_compressed_progress() -> None:
+    # big enough to be split into two xz streams, and to be received in many pieces
+    data = os.urandom(1 << 20).hex()
+    script = compression.compress(beipack.pack({
+        'big.py': f'def main():\n    print(len({data!r}))\n'.encode(),
+    }, 'big:main').encode(), 'xz', jobs=2)
+    assert script.count(b'\xfd7zXZ\0') == 2
+
+    def respond(command: str, args: List[object]) -> bytes:
+        return script if command == 'beiboot.provide' else b''
+
+    steps: List[Step] = [
+        ('boot_compressed', ('script.py', 'xz', len(script), [], True, None, False,
+                             0))]
+    output, commands = run_bootloader(steps, respond)
+    assert output == f'{len(data)}\n'
+
+    reports = [args for name, *args in commands if name == 'beiboot.progress']
+    assert len(reports) > 2
+    received = [received for received, _size, _elapsed in reports]
+    assert received == sorted(received)
+    assert reports[-1][:2] == [len(script), len(script)]
+
+    assert beiboot.format_progress(512, 1024, 0.5).endswith(' 50% 0.0/0.0MB 0.0MB/s')
+    assert beiboot.format_progress(3 << 20, 3 << 20, 1.0) == (
+        f'[{"#" * 30}] 100% 3.1/3.1MB 3.1MB/s')
+
+
+def test_boot_xz() -> None:
+    # two streams, as from `beipack --jobs`
+    script = compression.compress(HELLO, 'xz') + compression.compress(b'\n', 'xz')
+
+    def respond(command: str, args: List[object]) -> bytes:
+        assert command == 'beiboot.provide'
+        return script
+
+    steps: List[Step] = [('boot_xz', ('script.py', len(script), [], True))]
+    output, _commands = run_bootloader(steps, respond)
+    assert output == 'hello world\n'
+
+
+def test_boot_cached(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    cache = tmp_path / 'beipack'
+    script = compression.compress(HELLO, 'xz')
+    digest = hashlib.sha256(script).hexdigest()
+
+    def respond(command: str, args: List[object]) -> bytes:
+        assert command == 'beiboot.provide'
+        return script
+
+    def boot(limit: int = 1 << 20) -> List[str]:
+        steps: List[Step] = [
+            ('boot_cached', ('script.py', 'xz', len(script), digest, [], True, limit))]
+        output, commands = run_bootloader(steps, respond)
+        assert output == 'hello world\n'
+        return [name for name, *_args in commands]
+
+    # a miss, then a hit
+    assert boot() == ['beiboot.provide', 'ferny.end']
+    assert (cache / digest).read_bytes() == script
+    assert boot() == ['ferny.end']
+    assert os.listdir(cache) == [digest]
+
+    # a corrupted entry is replaced
+    (cache / digest).write_bytes(b'garbage')
+    assert boot() == ['beiboot.provide', 'ferny.end']
+    assert (cache / digest).read_bytes() == script
+
+    # the least recently used entries go first, and leftovers from interrupted
+    # writes are removed
+    for i, name in enumerate(['old', 'older', 'recent', '.tmp-stale']):
+        (cache / name).write_bytes(b'x' * 1000)
+        os.utime(cache / name, (1000 - i, 1000 - i) if name != 'recent' else None)
+    (cache / digest).unlink()
+    assert boot(limit=len(script) + 2000) == ['beiboot.provide', 'ferny.end']
+    assert sorted(os.listdir(cache)) == sorted([digest, 'old', 'recent'])
+
+
+def test_boot_cached_corrupted(tmp_path: Path,
+                               monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    script = compression.compress(HELLO, 'xz')
+
+    def respond(command: str, args: List[object]) -> bytes:
+        return script[:-1] + b'\0' if command == 'beiboot.provide' else b''
+
+    digest = hashlib.sha256(script).hexdigest()
+    steps: List[Step] = [
+        ('boot_cached', ('script.py', 'xz', len(script), digest, [], True))]
+    output, commands = run_bootloader(steps, respond)
+    assert output == ''
+    assert commands[-1][0] == 'beiboot.exc' and 'corrupted' in commands[-1][1]
+    assert not (tmp_path / 'beipack').exists()
+
+
+def test_boot_sync(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    store = tmp_path / 'beipack' / 'files'
+    contents = {
+        'x/__init__.py': b'',
+        'x/main.py': b'from . import version\n'
+                     b'def main():\n'
+                     b'    print(version.VERSION)\n',
+        'x/version.py': b'VERSION = 1\n',
+    }
+    sent: List[List[str]] = []
+
+    def boot() -> str:
+        files = {hashlib.sha256(data).hexdigest(): data for data in contents.values()}
+        manifest = {filename: hashlib.sha256(data).hexdigest()
+                    for filename, data in contents.items()}
+
+        def respond(command: str, args: List[object]) -> bytes:
+            assert command == 'beiboot.sync'
+            missing, = args
+            assert isinstance(missing, list)
+            sent.append(missing)
+            data = compression.compress(b''.join(files[digest] for digest in missing),
+                                        'xz')
+            sizes = ' '.join(str(len(files[digest])) for digest in missing)
+            return f'xz {len(data)} {sizes}\n'.encode() + data
+
+        skeleton = beipack.pack_skeleton('from x.main import main\nmain()\n')
+        steps: List[Step] = [
+            ('boot_sync', ('script.py', manifest, skeleton, [], True))]
+        output, _commands = run_bootloader(steps, respond)
+        return output
+
+    digests = {filename: hashlib.sha256(data).hexdigest()
+               for filename, data in contents.items()}
+    assert boot() == '1\n'
+    assert sent == [sorted(digests.values())]
+    assert sorted(os.listdir(store)) == sorted(digests.values())
+
+    # nothing changed: nothing is sent
+    assert boot() == '1\n'
+    assert len(sent) == 1
+
+    # one file changed: only that one is sent
+    contents['x/version.py'] = b'VERSION = 2\n'
+    assert boot() == '2\n'
+    assert sent[1:] == [[hashlib.sha256(b'VERSION = 2\n').hexdigest()]]
+
+    # a corrupted file in the store is sent again
+    (store / digests['x/main.py']).write_bytes(b'garbage')
+    assert boot() == '2\n'
+    assert sent[2:] == [[digests['x/main.py']]]
+
+
+@pytest.mark.parametrize('hops', [1, 3])
+def test_relay(hops: int) -> None:
+    script = compression.compress(HELLO, 'xz')
+
+    def respond(command: str, args: List[object]) -> bytes:
+        assert command == 'beiboot.provide'
+        return script
+
+    # the first hop is run by run_bootloader()
+    python = list(beiboot.get_python_command(local=True))
+    steps: List[Step] = [
+        ('boot_compressed', ('script.py', 'xz', len(script), [], True))]
+    inner = make_relay_bootloader([python] * (hops - 1), steps, gadgets=FAKE_GADGETS)
+    output, commands = run_bootloader([('relay', (python, inner))], respond)
+    assert output == 'hello world\n'
+    assert [name for name, *_args in commands] == ['beiboot.provide', 'ferny.end']
+
+    # errors come back through the chain
+    steps = [('boot_compressed', ('script.py', 'xz', 10, [], True))]
+    inner = make_relay_bootloader([python] * (hops - 1), steps, gadgets=FAKE_GADGETS)
+    output, commands = run_bootloader([('relay', (python, inner))],
+                                      lambda command, args: b'not xz....')
+    assert commands[-1][0] == 'beiboot.exc' and 'LZMAError' in commands[-1][1]
+
+
+def test_framed() -> None:
+    # not REPL-friendly (a blank line in the function), and reads the rest of stdin
+    script = (b'import sys\n'
+              b'def main():\n'
+              b'    line = sys.stdin.readline()\n'
+              b'\n'
+              b'    print("got", line.strip())\n'
+              b'main()\n')
+    process = subprocess.run([sys.executable, '-iq'],
+                             input=make_framed(script) + b'more\n',
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             check=True)
+    assert process.stdout == b'got more\n'
+    # the REPL only saw the stub
+    assert process.stderr.count(b'...') < 20
+
+    process = subprocess.run([sys.executable, '-iq'], input=make_framed(script)[:-10],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert b'EOFError: program truncated' in process.stderr
+
+
+@pytest.mark.parametrize('option', ['--cache', '--sync', '--via=host',
+                                    '--compression=xz', '--agent=path'])
+def test_framed_conflicts(option: str, capsys: pytest.CaptureFixture[str]) -> None:
+    parser = beiboot.make_parser()
+    args = parser.parse_args(['--script=script.py', '--framed', option])
+    with pytest.raises(SystemExit):
+        beiboot.check_options(parser, args)
+    assert '--framed can not be used with' in capsys.readouterr().err
+
+
+def test_boot_compressed_trace() -> None:
+    script = compression.compress(HELLO, 'zlib')
+
+    def respond(command: str, args: List[object]) -> bytes:
+        responses = {'beiboot.ping': b'\n', 'beiboot.provide': script}
+        return responses.get(command, b'')
+
+    steps: List[Step] = [
+        ('boot_compressed', ('script.py', 'zlib', len(script), [], True, None, False,
+                             None, True))]
+    output, commands = run_bootloader(steps, respond)
+    assert output == 'hello world\n'
+    assert [name for name, *_args in commands] == [
+        'beiboot.ping', 'beiboot.provide', 'beiboot.trace', 'ferny.end']
+
+    phases = commands[2][1]
+    names = [name for name, *_times in phases]
+    assert names[-4:] == ['clock sync', 'wait for script', 'receive and decompress',
+                          'exec and import entrypoint']
+    # each one starts after the last one
+    for i, (_name, start, end, _details) in enumerate(phases[:-1]):
+        assert start <= end <= phases[i + 1][1] + 0.001
+
+
+@pytest.mark.parametrize('profile, trace', [(True, False), (False, True)])
+def test_boot_compressed_report_script(profile: bool, trace: bool) -> None:
+    # not a beipack, so nothing calls the profile hook: the report can't wait for it
+    script = b'import sys\nprint("read", len(sys.stdin.read()))\n'
+
+    def respond(command: str, args: List[object]) -> bytes:
+        responses = {'beiboot.ping': b'\n', 'beiboot.provide': script}
+        return responses.get(command, b'')
+
+    steps: List[Step] = [
+        ('boot_compressed', ('script.py', 'none', len(script), [], True, None,
+                             profile, None, trace)),
+    ]
+    output, commands = run_bootloader(steps, respond)
+    assert output == 'read 0\n'
+    assert commands[-1] == ['ferny.end']
+    if profile:
+        assert commands[-2] == ['beiboot.profile', []]
+    else:
+        assert commands[-2][0] == 'beiboot.trace'
+        assert commands[-2][1][-1][0] == 'receive and decompress'
+
+
+def test_trace() -> None:
+    # the remote's clock is 100s ahead, and the ping takes 1ms each way
+    assert beiboot.clock_offset(1100.0, 1000.001, 1100.002) == pytest.approx(-100.0)
+
+    trace = beiboot.make_trace([('spawn', 1000.0, 1000.5)],
+                               [['exec', 1100.5, 1101.0, {'x': 1}]], -100.0)
+    json.dumps(trace)
+    phases = [event for event in trace['traceEvents'] if event['ph'] == 'X']
+    assert [(event['pid'], event['ts'], event['dur'], event['args'])
+            for event in phases] == [
+        (1, 0, 500000, {}),
+        (2, 500000, 500000, {'x': 1}),
+    ]
+    assert beiboot.format_trace(trace).splitlines()[1:] == [
+        '      0.0     500.0  beiboot  spawn',
+        '    500.0     500.0  remote   exec',
+    ]
+
+
+def test_choose_compression() -> None:
+    samples = {
+        'none': (1000, 1000, 0.0, 0.0),
+        'zlib': (1000, 400, 0.00001, 0.000002),
+        'xz': (1000, 250, 0.0002, 0.00002),
+    }
+    # slow link: size matters most
+    assert beiboot.choose_compression(10 ** 6, samples, 10 ** 4) == 'xz'
+    # medium: zlib is a good compromise
+    assert beiboot.choose_compression(10 ** 6, samples, 10 ** 6) == 'zlib'
+    # fast local link: don't bother
+    assert beiboot.choose_compression(10 ** 6, samples, 10 ** 10) == 'none'
+
+
+def test_agent(tmp_path: Path) -> None:
+    path = str(tmp_path / 'agent.sock')
+    script = tmp_path / 'script.py'
+    script.write_text('import sys\n'
+                      'print(sys.stdin.read().upper())\n'
+                      'print("stderr", file=sys.stderr)\n'
+                      'sys.exit(3)\n')
+    beiboot_command = [sys.executable, '-m', 'bei.beiboot', '--agent', path]
+
+    try:
+        # the first run starts the agent, and the second one reuses it
+        for text in ['hello', 'again']:
+            process = subprocess.run([*beiboot_command, '--agent-timeout=60',
+                                      '--script', str(script)],
+                                     input=text.encode(), stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE, timeout=30)
+            assert process.returncode == 3
+            assert process.stdout == text.upper().encode() + b'\n'
+            assert process.stderr == b'stderr\n'
+
+        # ...without sending the program again
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(path)
+            digest = hashlib.sha256(script.read_bytes()).hexdigest()
+            request = {'digest': digest, 'fmt': 'none', 'filename': 'script.py',
+                       'args': []}
+            beiboot.agent_send(sock, 'R', json.dumps(request).encode())
+            assert beiboot.agent_recv(sock.makefile('rb')) == ('S', b'')
+
+        # a client which never sends its request doesn't hold up the others
+        with socket.socket(socket.AF_UNIX) as stalled:
+            stalled.connect(path)
+            process = subprocess.run([*beiboot_command, '--script', str(script)],
+                                     input=b'stalled', stdout=subprocess.PIPE,
+                                     timeout=10)
+            assert (process.returncode, process.stdout) == (3, b'STALLED\n')
+    finally:
+        subprocess.run([*beiboot_command, '--agent-exit'], check=True)
+
+
+def make_fd_pair(kind: str) -> Tuple[int, int]:
+    if kind == 'socket':
+        reader, writer = (sock.detach() for sock in socket.socketpair())
+        return reader, writer
+    return os.pipe()
+
+
+@pytest.mark.parametrize('slow', [False, True])
+@pytest.mark.parametrize('dest', ['pipe', 'socket'])
+@pytest.mark.parametrize('source', ['pipe', 'file', 'socket'])
+def test_forward(source: str, dest: str, slow: bool, tmp_path: Path) -> None:
+    data = os.urandom(3 << 20)
+    if source == 'file':
+        (tmp_path / 'data').write_bytes(data)
+        src = os.open(tmp_path / 'data', os.O_RDONLY)
+    else:
+        src, src_writer = make_fd_pair(source)
+
+        def write() -> None:
+            os.write(src_writer, data)
+            os.close(src_writer)
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+
+    dst_reader, dst = make_fd_pair(dest)
+    os.set_blocking(dst, False)
+    output: List[bytes] = []
+
+    def read_dst() -> None:
+        if slow:
+            # let dst fill up, then keep it full
+            time.sleep(0.2)
+        for block in iter(lambda: os.read(dst_reader, 1 << 16), b''):
+            output.append(block)
+            if slow:
+                time.sleep(0.001)
+
+    reader = threading.Thread(target=read_dst, daemon=True)
+    reader.start()
+
+    assert asyncio.run(beiboot.forward(src, dst)) == len(data)
+    os.close(src)
+    os.close(dst)
+    reader.join()
+    assert b''.join(output) == data
+
+
+class FakeResponder:
+    commands: Tuple[str, ...] = ()
+
+    async def do_custom_command(self, command: str, args: Tuple, fds: List[int],
+                                stderr: str) -> None:
+        raise NotImplementedError
+
+
+class FakeAgent:
+    """Speaks the protocol of FAKE_GADGETS, in place of ferny.InteractionAgent."""
+    def __init__(self, responder: FakeResponder) -> None:
+        self.responder = responder
+        self.reader, self.writer = os.pipe()
+
+    def fileno(self) -> int:
+        return self.writer
+
+    async def communicate(self) -> None:
+        os.close(self.writer)
+        stderr = open(self.reader, 'rb')
+        loop = asyncio.get_running_loop()
+        while True:
+            line = await loop.run_in_executor(None, stderr.readline)
+            if not line:
+                stderr.close()
+                return
+            try:
+                name, *args = json.loads(line)
+            except ValueError:
+                sys.stderr.buffer.write(line)
+                continue
+            if name == 'ferny.end':
+                break
+            if name in self.responder.commands:
+                await self.responder.do_custom_command(name, tuple(args), [], '')
+        # the rest of stderr is the program's
+        def copy_stderr() -> None:
+            sys.stderr.buffer.write(stderr.read())
+            stderr.close()
+        threading.Thread(target=copy_stderr, daemon=True).start()
+
+
+@pytest.fixture
+def fake_ferny(monkeypatch: pytest.MonkeyPatch) -> None:
+    module = types.ModuleType('ferny')
+    module.BEIBOOT_GADGETS = FAKE_GADGETS  # type: ignore[attr-defined]
+    module.InteractionAgent = FakeAgent  # type: ignore[attr-defined]
+    module.InteractionResponder = FakeResponder  # type: ignore[attr-defined]
+    monkeypatch.setitem(sys.modules, 'ferny', module)
+
+
+@pytest.mark.usefixtures('fake_ferny')
+def test_boot() -> None:
+    async def run() -> None:
+        script = compression.compress(HELLO, 'zlib')
+        python = beiboot.get_python_command(local=True)
+        booted = await beiboot.boot(python, script, 'zlib')
+        booted.stdin.close()
+        assert booted.stdout is not None
+        assert await booted.stdout.read() == b'hello world\n'
+        assert await booted.wait() == 0
+
+        with pytest.raises(beiboot.BootError, match='incorrect header check'):
+            await beiboot.boot(python, b'not zlib', 'zlib')
+
+    asyncio.run(run())
+
+
+@pytest.mark.usefixtures('fake_ferny')
+def test_boot_hosts(tmp_path: Path, capfd: pytest.CaptureFixture[str],
+                    monkeypatch: pytest.MonkeyPatch) -> None:
+    # One host is unreachable, and the other has no working lzma module
+    (tmp_path / 'python3').symlink_to(sys.executable)
+    (tmp_path / 'nolzma').mkdir()
+    lzma = tmp_path / 'nolzma' / 'lzma.py'
+    lzma.write_text('def __getattr__(name):\n'
+                    '    raise ImportError("no lzma here")\n')
+    ssh = tmp_path / 'ssh'
+    ssh.write_text(f"""#!/bin/sh
+host="$1"
+shift
+case "$host" in
+    unreachable)
+        echo "ssh: connect to host unreachable: No route to host" >&2
+        exit 255;;
+    broken) export PYTHONPATH={tmp_path / 'nolzma'};;
+esac
+export HOST="$host"
+exec sh -c "$*"
+""")
+    ssh.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{tmp_path}:{os.environ["PATH"]}')
+
+    hosts = ['one', 'unreachable', 'two', 'broken']
+    script = compression.compress(beipack.pack({
+        # a line which is longer than a StreamReader allows
+        'host.py': b'import os\n'
+                   b'def main():\n'
+                   b'    print("hello from", os.environ["HOST"], "x" * 100000)\n',
+    }, 'host:main').encode(), 'xz')
+    assert asyncio.run(beiboot.boot_hosts(hosts, [], script, 'xz', 2)) == 1
+
+    stdout, stderr = capfd.readouterr()
+    assert sorted(stdout.splitlines()) == [f'{host}: hello from {host} {"x" * 100000}'
+                                           for host in ['one', 'two']]
+    assert 'beiboot: one: exited with status 0' in stderr
+    # ...depending on whether ssh exits before the bootloader is written
+    assert re.search('beiboot: unreachable: (exited with status 255|failed to boot)',
+                     stderr)
+    assert 'beiboot: broken: failed to boot:' in stderr and 'no lzma here' in stderr
+    assert 'beiboot: succeeded on 2 of 4 hosts' in stderr
+    assert stderr.endswith('beiboot: failed on: unreachable broken\n')
+
+
+def test_copy_prefixed(capfdbinary: pytest.CaptureFixture[bytes],
+                       monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(beiboot, 'COPY_BLOCK_SIZE', 3)
+
+    async def copy() -> None:
+        stream = asyncio.StreamReader()
+        stream.feed_data(b'one\ntwo\n\nthree and four')
+        stream.feed_eof()
+        await beiboot.copy_prefixed(stream, b'> ')
+
+    asyncio.run(copy())
+    assert capfdbinary.readouterr().out == b'> one\n> two\n> \n> three and four\n'
+
+
+def test_read_hosts(tmp_path: Path) -> None:
+    (tmp_path / 'hosts').write_text('# web servers\n'
+                                    'web1\n'
+                                    '  web2  # the new one\n'
+                                    '\n'
+                                    'user@db:2222\n')
+    assert beiboot.read_hosts(str(tmp_path / 'hosts')) == [
+        'web1', 'web2', 'user@db:2222']
@@ -1,11 +1,16 @@
+import importlib.machinery
+import importlib.util
+import io
+import lzma
 import os
 import subprocess
 import sys
-from typing import List
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import pytest
 
-from bei import beipack
+from bei import beipack, compression
 
 
 @pytest.fixture
@@ -69,8 +74,10 @@ def test_cmdline(python_command: List[str],
 
 
 @pytest.mark.skipif(sys.version_info < (3, 11), reason="requires python3.11 or higher")
+@pytest.mark.parametrize('compression', [None, 'zlib', 'bz2', 'xz'])
 def test_resources(python_command: List[str],
-                   pytestconfig: pytest.Config) -> None:
+                   pytestconfig: pytest.Config,
+                   compression: Optional[str]) -> None:
     pack = beipack.pack(
         {
             'x/subdir/__init__.py': b'',
@@ -82,7 +89,8 @@ def test_resources(python_command: List[str],
                 b'    print((resources.files("x") / "y.py").read_text())\n'
                 b'    print([item.name for item in resources.files("x").iterdir()])\n'
         },
-        entrypoint='x.y:main'
+        entrypoint='x.y:main',
+        compression=compression
     )
     print(pack)
     result = run_pack(pack)
@@ -93,8 +101,508 @@ def test_resources(python_command: List[str],
     assert "'y.py'" in result
 
 
+@pytest.mark.skipif(sys.version_info < (3, 11), reason="requires python3.11 or higher")
+def test_traversable() -> None:
+    pack = beipack.pack({
+        'x/__init__.py': b'',
+        'x/data/a/b.txt': b'hello',
+        'x/data/c.txt': b'world',
+        'x/y.py': b'''
+import pathlib
+from importlib import resources
+def main():
+    data = resources.files("x") / "data"
+    print(data.is_dir(), data.is_file(), sorted(item.name for item in data.iterdir()))
+    view = (data / "a/b.txt").read_memoryview()
+    print(data.joinpath("a", "b.txt").read_bytes(), view[1:3].tobytes())
+    with (data / "c.txt").open() as file:
+        print(file.read())
+    path = data.joinpath(pathlib.PurePosixPath("c.txt"))
+    with path.open("r", encoding="ascii", newline="") as file:
+        print(file.read().upper())
+    with resources.as_file(data / "c.txt") as path:
+        print(path.read_text())
+    print(sorted(resources.contents("x")),
+          resources.is_resource("x", "y.py"), resources.is_resource("x", "data"))
+    try:
+        (data / "missing").read_bytes()
+    except FileNotFoundError as exc:
+        print(exc)
+'''
+    }, entrypoint='x.y:main')
+    assert run_pack(pack) == '''\
+True False ['a', 'c.txt']
+b'hello' b'el'
+world
+WORLD
+world
+['__init__.py', 'data', 'y.py'] True False
+x/data/missing
+'''
+
+
+@pytest.mark.skipif(not hasattr(os, 'memfd_create'), reason="requires memfd_create()")
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_extension(compression: Optional[str]) -> None:
+    import _heapq
+    suffix = importlib.machinery.EXTENSION_SUFFIXES[0]
+    with open(_heapq.__file__, 'rb') as file:
+        heapq = file.read()
+    pack = beipack.pack({
+        f'x/_heapq{suffix}': heapq,
+        # native extensions take precedence, if they work
+        'x/_heapq.py': b'raise AssertionError',
+        # ...otherwise, the source module is used instead
+        'x/broken.so': b'not an elf file',
+        'x/broken.py': b'working = True',
+        # and extensions for other interpreters are ignored
+        'x/other.cpython-10-foo.so': b'not an elf file',
+        'x/other.py': b'working = True',
+        'x/__init__.py': b'',
+        'x/y.py': b"""
+import types
+def main():
+    from x import _heapq, broken, other
+    assert isinstance(_heapq.heapify, types.BuiltinFunctionType)
+    data = [3, 1, 2]
+    _heapq.heapify(data)
+    print(data[0], broken.working, broken.__file__, other.working)
+"""
+    }, entrypoint='x.y:main', compression=compression)
+    assert run_pack(pack) == '1 True x/broken.py True\n'
+
+
 @pytest.mark.skipif(sys.version_info < (3, 11), reason="requires python3.11 or higher")
 def test_collect_module() -> None:
     # See if we can find ourselves
     all_tests = beipack.collect_module('test', recursive=True)
     assert b'woh, this is so meta' in all_tests['test/test_beipack.py']
+
+
+def test_bytecode() -> None:
+    contents = {'x.py': b'def main():\n    print("from source")\n'}
+    compiled = {'x.py': b'def main():\n    print("from bytecode")\n'}
+    bytecode = beipack.compile_bytecode(compiled, [sys.executable])
+    assert list(bytecode) == [importlib.util.MAGIC_NUMBER]
+    pack = beipack.pack(contents, 'x:main', bytecode=bytecode)
+    assert run_pack(pack) == 'from bytecode\n'
+
+    # an interpreter with a different magic number gets the source
+    bytecode = {b'\0\0\r\n': bytecode[importlib.util.MAGIC_NUMBER]}
+    pack = beipack.pack(contents, 'x:main', bytecode=bytecode)
+    assert run_pack(pack) == 'from source\n'
+
+
+@pytest.mark.parametrize('compression', ['zlib', 'bz2', 'xz:0'])
+def test_compress_files(compression: str) -> None:
+    pack = beipack.pack({
+        'x.py': b'import sys\n'
+                b'def main():\n'
+                b'    print(sorted(sys.meta_path[0].compressed))\n',
+        'y.py': b'# never imported\n',
+    }, 'x:main', compression=compression)
+    assert run_pack(pack) == "['y.py']\n"
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_aliases(compression: Optional[str]) -> None:
+    module = (b'import sys\n'
+              b'def main():\n'
+              b'    print(__name__, sorted(sys.meta_path[0].contents))\n')
+    contents = {'x.py': module, 'a/x.py': module,
+                'a/__init__.py': b'', 'b/__init__.py': b''}
+
+    stream = io.BytesIO()
+    aliases = beipack.pack_to(stream, contents.items(), 'a.x:main',
+                              compression=compression)
+    assert aliases == {'a/x.py': 'x.py'}
+    assert stream.getvalue().count(b"'x.py'") == 2  # the file and the alias
+    output = run_pack(stream.getvalue().decode())
+    assert output == "a.x ['a/__init__.py', 'a/x.py', 'b/__init__.py', 'x.py']\n"
+
+
+def test_aliases_rewritten() -> None:
+    first, second = (f'def main():\n    print({n})\n# {"padding" * 10}\n'.encode()
+                     for n in (1, 2))
+
+    def run(files: List[Tuple[str, bytes]]) -> Tuple[Dict[str, str], str]:
+        stream = io.BytesIO()
+        aliases = beipack.pack_to(stream, files, 'b:main')
+        return aliases, run_pack(stream.getvalue().decode())
+
+    # the last copy of a.py wins, so b.py can't be an alias of the first one
+    assert run([('a.py', first), ('a.py', second), ('b.py', first)]) == ({}, '1\n')
+    # the same file twice is only written once, and isn't an alias of itself
+    assert run([('b.py', first), ('b.py', first)]) == ({}, '1\n')
+    # an alias which is written again is no longer an alias
+    assert run([('a.py', first), ('b.py', first), ('b.py', second)]) == ({}, '2\n')
+    assert run([('a.py', first), ('b.py', second), ('b.py', first)]) == (
+        {'b.py': 'a.py'}, '1\n')
+    # a file which is replaced leaves its aliases with the old contents
+    assert run([('a.py', first), ('b.py', first), ('a.py', second)]) == ({}, '1\n')
+
+    # ...and the others become aliases of the first of them
+    files = {name: f'print({name!r})\n# {"padding" * 10}\n'.encode()
+             for name in 'abcd'}
+    sequence = [('x/a.py', 'a'), ('x/b.py', 'a'), ('x/c.py', 'a'),
+                ('x/a.py', 'b'), ('x/d.py', 'a'), ('x/b.py', 'd')]
+    stream = io.BytesIO()
+    aliases = beipack.pack_to(stream, [(name, files[data]) for name, data in sequence])
+    assert aliases == {'x/d.py': 'x/c.py'}
+    contents, _code = beipack.unpack(stream.getvalue().decode())
+    assert contents == {name: files[data] for name, data in sequence}
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_unpack(compression: Optional[str]) -> None:
+    module = (b'import sys\n'
+              b'def main(*args):\n'
+              b'    print(args, sorted(sys.meta_path[0].contents))\n')
+    contents = {'x.py': module, 'a/x.py': module, 'a/__init__.py': b'',
+                'bin': bytes(range(256))}
+    bytecode = beipack.compile_bytecode(contents, [sys.executable])
+    pack = beipack.pack(contents, 'a.x:main', '1, 2', bytecode=bytecode,
+                        compression=compression)
+
+    unpacked, code = beipack.unpack(pack)
+    assert unpacked == contents
+    assert code == ('from a.x import main as main\n'
+                    'BeipackLoader.report_profile()\n'
+                    'main(1, 2)\n')
+
+    skeleton = beipack.pack_skeleton(code)
+    output = run_pack(f'__beipack_contents__ = {unpacked!r}\n' + skeleton)
+    assert output == f"(1, 2) {sorted(contents)}\n"
+
+    stream = io.BytesIO()
+    beipack.pack_to(stream, contents.items(), blob=True)
+    blob = stream.getvalue()
+    with pytest.raises(ValueError, match='blob'):
+        end = blob.index(b'\n', blob.index(b'=BeipackLoader.read_blob(')) + 1
+        beipack.unpack(blob[:end].decode())
+    with pytest.raises(ValueError, match='evict'):
+        beipack.unpack(beipack.pack(contents, evict=True))
+    with pytest.raises(ValueError, match='not a beipack'):
+        beipack.unpack('print("hello")\n')
+
+
+def test_sort_contents() -> None:
+    names = ['b/x.py', 'README', 'a/y.txt', 'a/z.py', 'a/x.txt', 'c.py']
+    contents = dict.fromkeys(names, b'')
+    assert list(beipack.sort_contents(contents)) == [
+        'README', 'a/z.py', 'b/x.py', 'c.py', 'a/x.txt', 'a/y.txt']
+
+
+MINIFY_SOURCE = b"""\
+# -*- coding: utf-8 -*-
+\"\"\"The module.\"\"\"
+import sys  # a comment
+
+
+def main(argv: 'list[str]' = sys.argv,
+         *args: (int),  # another comment
+         **kwargs: bool) -> None:
+    \"\"\"The main function.
+
+    It doesn't do very much.
+    \"\"\"
+    print(__doc__, main.__doc__, main.__annotations__, '# not a comment')
+    raise SystemExit(sys._getframe().f_lineno)
+"""
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason="requires python3.8 or higher")
+def test_minify() -> None:
+    minified = beipack.minify_source(MINIFY_SOURCE, annotations=True)
+    assert minified == b"""\
+# -*- coding: utf-8 -*-
+
+import sys
+
+
+def main(argv = sys.argv,
+         *args,
+         **kwargs):
+
+
+
+
+    print(__doc__, main.__doc__, main.__annotations__, '# not a comment')
+    raise SystemExit(sys._getframe().f_lineno)
+"""
+
+    # docstrings are kept if requested
+    ((_, kept),) = beipack.minify_contents([('x.py', MINIFY_SOURCE)],
+                                           keep_docstrings=['x'])
+    assert b'"""The module."""' in kept
+    assert b'# a comment' not in kept
+
+    # line numbers are unchanged
+    pack = beipack.pack({'x.py': minified}, 'x:main')
+    run_process = subprocess.run([sys.executable, '-iq'], input=pack,
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                 universal_newlines=True)
+    assert run_process.stdout == "None None {} # not a comment\n"
+    assert run_process.returncode == 14
+
+    # things which don't parse are left alone
+    python2 = b'print "hello"  # python2\n'
+    assert beipack.minify_source(python2) == python2
+
+
+@pytest.mark.parametrize('separator', ['\x0c', '\x1c', '\x85', '\u2028', '\u2029'])
+def test_minify_line_separators(separator: str) -> None:
+    # only \n ends a line for the tokenizer, whatever str.splitlines() thinks
+    # a form feed is also allowed as indentation
+    indent = separator if separator == '\x0c' else ''
+    source = (f'x = "a{separator}b"  # c{separator}d\n'
+              f'{indent}def f(a: int) -> str:\n'
+              f'    """doc{separator}string"""\n'
+              f'    return x * a  # {separator}\n').encode()
+    minified = beipack.minify_source(source, annotations=True)
+    assert b'#' not in minified and b'doc' not in minified
+
+    namespace: Dict[str, Any] = {}
+    exec(compile(minified, 'x.py', 'exec'), namespace)
+    assert namespace['f'](2) == f'a{separator}b' * 2
+
+
+def test_prune() -> None:
+    contents = {
+        'x/__init__.py': b'',
+        'x/main.py': b'from . import y\n'
+                     b'from .z import func\n'
+                     b'import importlib\n'
+                     b'importlib.import_module("x.dyn")\n',
+        'x/y.py': b'import json, x.sub.deep\n',
+        'x/z.py': b'',
+        'x/dyn.py': b'',
+        'x/unused.py': b'import x.unused2\n',
+        'x/unused2.py': b'',
+        'x/data.txt': b'resource',
+        'x/sub/__init__.py': b'',
+        'x/sub/deep.py': b'',
+        'x/sub/deeper/__init__.py': b'',
+        'x/sub/deeper/data.txt': b'unreachable resource',
+        'toplevel.txt': b'',
+    }
+
+    pruned = beipack.prune_contents(contents, ['x.main'])
+    assert set(contents) - set(pruned) == {
+        'x/unused.py', 'x/unused2.py',
+        'x/sub/deeper/__init__.py', 'x/sub/deeper/data.txt'
+    }
+
+    pruned = beipack.prune_contents(contents, ['x.main', 'x.sub'])
+    assert set(contents) - set(pruned) == {'x/unused.py', 'x/unused2.py'}
+
+
+def test_cache(python_command: List[str],
+               pytestconfig: pytest.Config,
+               tmp_path: Path) -> None:
+    def run_beipack(*args: str) -> bytes:
+        return subprocess.run([*python_command, '-m', 'bei.beipack', '--xz',
+                               '--main', 'hello:main', '--topdir=test/files',
+                               'test/files/hello.py', *args],
+                              env=dict(os.environ, XDG_CACHE_HOME=str(tmp_path)),
+                              cwd=pytestconfig.rootpath,
+                              stdout=subprocess.PIPE, check=True).stdout
+
+    cold = run_beipack()
+    assert run_beipack('--cache') == cold
+    assert len(os.listdir(tmp_path / 'beipack' / 'build' / 'compressed')) == 1
+    assert run_beipack('--cache') == cold
+
+
+def test_watch(python_command: List[str], tmp_path: Path) -> None:
+    source = tmp_path / 'hello.py'
+    output = tmp_path / 'hello.beipack'
+    source.write_text('def main():\n    print("one")\n')
+
+    process = subprocess.Popen([*python_command, '-m', 'bei.beipack', '--watch',
+                                '--main', 'hello:main', f'--topdir={tmp_path}',
+                                f'--output={output}', str(source)],
+                               env=dict(os.environ,
+                                        XDG_CACHE_HOME=str(tmp_path / 'cache')),
+                               stderr=subprocess.PIPE, universal_newlines=True)
+    try:
+        assert process.stderr is not None
+        assert 'wrote' in process.stderr.readline()
+        assert run_pack(output.read_text()) == 'one\n'
+
+        # editors sometimes delete the file before writing the new one
+        source.unlink()
+        assert 'build failed' in process.stderr.readline()
+
+        source.write_text('def main():\n    print("two")\n')
+        os.utime(source, ns=(0, 0))  # make sure the mtime changes
+        assert 'wrote' in process.stderr.readline()
+        assert run_pack(output.read_text()) == 'two\n'
+    finally:
+        process.terminate()
+        process.wait()
+        assert process.stderr is not None
+        process.stderr.close()
+
+
+def test_compress_xz_jobs() -> None:
+    data = b''.join(b'%d\n' % i for i in range(300000))
+    single = compression.compress(data, 'xz')
+    multi = compression.compress(data, 'xz', jobs=4)
+    assert single == lzma.compress(data, preset=lzma.PRESET_EXTREME)
+    assert multi != single
+    assert lzma.decompress(multi) == data
+
+
+@pytest.mark.parametrize('fmt', ['none', 'zlib', 'zlib:0', 'zlib:1', 'bz2', 'bz2:1',
+                                 'xz', 'xz:0', 'xz:6e'])
+def test_compression_formats(fmt: str) -> None:
+    data = b'# beipack\n' * 1000
+    compressed = compression.compress(data, fmt)
+    assert compression.detect_format(compressed) == fmt.partition(':')[0]
+    assert compression.decompress(compressed, fmt) == data
+
+
+@pytest.mark.parametrize('fmt',
+                         ['gzip', 'none:1', 'zlib:10', 'xz:e', 'bz2:9e', 'bz2:0'])
+def test_compression_bad_formats(fmt: str) -> None:
+    with pytest.raises(ValueError):
+        compression.parse_format(fmt)
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_blob(compression: Optional[str]) -> None:
+    contents = {
+        'x.py': b'import sys\n'
+                b'def main():\n'
+                b'    for name in sorted(sys.meta_path[0].contents):\n'
+                b'        print(name, sys.meta_path[0].get_data(name).hex())\n',
+        'binary': bytes(range(256)),
+        'crlf': b'\r\n',
+        'no-newline': b'print("not code")',
+        'empty': b'',
+        'dup1': bytes(range(100)),
+        'dup2': bytes(range(100)),
+    }
+    stream = io.BytesIO()
+    beipack.pack_to(stream, contents.items(), 'x:main', compression=compression,
+                    blob=True)
+    pack = stream.getvalue()
+    assert b"blob=BeipackLoader.read_blob(" in pack
+
+    # the blob is read directly from stdin, and the REPL continues afterwards
+    run_process = subprocess.run([sys.executable, '-iq'], input=pack,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 check=True)
+    assert run_process.stdout.decode() == ''.join(f'{name} {contents[name].hex()}\n'
+                                                  for name in sorted(contents))
+    assert run_process.stderr.strip(b'.> \n') == b''
+
+
+# Runs a compressed pack the way the bootloader does
+EXEC_SELF_SOURCE = """
+import lzma, sys
+data = sys.stdin.buffer.read()
+exec(lzma.decompress(data),
+     {'__name__': '__main__', '__self_source__': data, '__file__': 'x.py.xz'})
+"""
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason="requires python3.8 or higher")
+@pytest.mark.parametrize('streams', [1, 2])
+@pytest.mark.parametrize('compress_files', [None, 'zlib'])
+def test_evict(compress_files: Optional[str], streams: int) -> None:
+    contents = {
+        # with two streams, the rest of the files are in the second one
+        'x/filler.txt': os.urandom(1 << 20).hex().encode() if streams > 1 else b'',
+        'x/__init__.py': b'',
+        'x/a.py': b'def fail():\n    raise ValueError("from a")\n',
+        'x/data.bin': bytes(range(256)),
+        'x/copy.bin': bytes(range(256)),
+        'x/main.py': b"""
+import sys, traceback
+from x import a
+def main():
+    loader = a.__loader__
+    assert (loader.contents['x/a.py'] == b'') == loader.evict
+    assert loader.get_data('x/data.bin') == bytes(range(256))
+    assert (loader.contents['x/data.bin'] == b'') == loader.evict
+    assert loader.get_data('x/copy.bin') == bytes(range(256))
+    assert loader.get_data('x/data.bin') == bytes(range(256))
+    try:
+        a.fail()
+    except ValueError:
+        print(traceback.format_exc().splitlines()[-2].strip())
+    usage = loader.memory_usage()
+    print(usage['evicted'], usage['freed'], usage['rehydrated'])
+"""
+    }
+    pack = beipack.pack(contents, 'x.main:main', compression=compress_files,
+                        evict=True)
+    script = compression.compress(pack.encode(), 'xz', jobs=streams)
+    assert script.count(b'\xfd7zXZ\0') == streams
+
+    process = subprocess.run([sys.executable, '-c', EXEC_SELF_SOURCE], input=script,
+                             stdout=subprocess.PIPE, check=True)
+    # data.bin is read twice, and the traceback reads both modules again
+    freed = 2 * (len(contents['x/a.py']) + len(contents['x/main.py'])) + 3 * 256
+    assert process.stdout.decode() == f'raise ValueError("from a")\n5 {freed} 3\n'
+
+    # Without __self_source__, nothing is evicted
+    assert run_pack(pack).endswith('0 0 0\n')
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason="requires python3.8 or higher")
+def test_evict_bytecode() -> None:
+    contents = {
+        'x/__init__.py': b'',
+        'x/a.py': b'def fail():\n    raise ValueError("from a")\n',
+        'x/main.py': b"""
+import traceback
+from x import a
+def main():
+    loader = a.__loader__
+    print(len(loader.contents['x/a.py']), sorted(loader.evicted))
+    try:
+        a.fail()
+    except ValueError:
+        print(traceback.format_exc().splitlines()[-2].strip())
+    usage = loader.memory_usage()
+    print(usage['evicted'], usage['freed'], usage['rehydrated'])
+"""
+    }
+    bytecode = beipack.compile_bytecode(contents, [sys.executable])
+    pack = beipack.pack(contents, 'x.main:main', bytecode=bytecode, evict=True)
+    process = subprocess.run([sys.executable, '-c', EXEC_SELF_SOURCE],
+                             input=compression.compress(pack.encode(), 'xz'),
+                             stdout=subprocess.PIPE, check=True)
+    # the sources are freed even though they're never read, and the
+    # traceback reads both modules again
+    freed = 2 * (len(contents['x/a.py']) + len(contents['x/main.py']))
+    assert process.stdout.decode() == (
+        "0 ['x/__init__.py', 'x/a.py', 'x/main.py']\n"
+        'raise ValueError("from a")\n'
+        f'3 {freed} 2\n'
+    )
+
+
+def test_pack_to() -> None:
+    contents = {'x.py': b'print("x")\n', 'bin': bytes(range(256)),
+                'utf8': 'ü'.encode()}
+
+    def generate() -> Iterator[Tuple[str, bytes]]:
+        yield from contents.items()
+
+    stream = io.BytesIO()
+    beipack.pack_to(stream, generate(), 'x:main')
+    assert stream.getvalue() == beipack.pack(contents, 'x:main').encode()
+
+
+@pytest.mark.parametrize('fmt', ['none', 'zlib', 'bz2:1', 'xz', 'xz:6'])
+def test_compressing_writer(fmt: str) -> None:
+    data = [b'%d\n' % i for i in range(100000)]
+    stream = io.BytesIO()
+    with compression.CompressingWriter(stream, fmt) as writer:
+        for chunk in data:
+            writer.write(chunk)
+    assert stream.getvalue() == compression.compress(b''.join(data), fmt)